@@ -2,6 +2,7 @@ from flask import Flask
 from flask_bootstrap import Bootstrap5
 import logging
 import os
+import threading
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -28,4 +29,9 @@ def create_app(test_config=None):
     from app.routes import register_routes
     register_routes(app)
 
+    # Build the local zone index in the background so the first signup doesn't wait for it
+    from app.zone_lookup import ZONE_DATA_DIR, get_zone_index
+    if ZONE_DATA_DIR and not app.config.get("TESTING"):
+        threading.Thread(target=get_zone_index, daemon=True).start()
+
     return app
\ No newline at end of file
@@ -1,13 +1,10 @@
 from flask import render_template, redirect, url_for
 import requests
 import logging
-import os
-from dotenv import load_dotenv
 from app.forms import UserForm
 from azfunc.helpers import create_user
-
-load_dotenv()
-MY_EMAIL = os.getenv("MY_EMAIL")
+from app.zone_lookup import lookup_zone_ids
+from azfunc.helpers.http_client import nws_get
 
 
 def register_routes(app):
@@ -53,18 +50,19 @@ def register_routes(app):
         return redirect(url_for('home'))
 
 
-# Get and return new user's NWS zone ID based on their coordinates
+# Get and return new user's NWS zone ID based on their coordinates, from the local zone index when it covers them
 def get_zone_ids(lat, lng, email):
 
-    headers = {
-        "User-Agent": f"(KevinWeatherAlertApp, {MY_EMAIL})",
-        "Accept": "application/geo+json"
-    }
+    zone_ids = lookup_zone_ids(lat, lng)
+    if zone_ids:
+        logging.info(f"Found zone ID(s) locally: {zone_ids} for {email}")
+        return zone_ids
+
     get_zone_url = "https://api.weather.gov/zones"
     params = {"point": f"{lat},{lng}"}
 
     logging.info(f"Fetching NWS zone ID(s) for coordinates: ({lat}, {lng})")
-    response = requests.get(get_zone_url, params=params, headers=headers)
+    response = nws_get(get_zone_url, params=params)
     response.raise_for_status()
 
     zones_returned = response.json().get("features", [])
@@ -0,0 +1,161 @@
+import glob
+import json
+import logging
+import math
+import os
+import threading
+
+# Directory of NWS zone boundary GeoJSON files (forecast, county and fire zones, to match what /zones?point= returns).
+# NWS shapefiles can be converted with: ogr2ogr -f GeoJSON z_05mr24.geojson z_05mr24.shp
+ZONE_DATA_DIR = os.getenv("ZONE_DATA_DIR")
+# Grid cell size in degrees, each cell lists the polygons whose bounding box overlaps it
+ZONE_GRID_CELL_DEGREES = float(os.getenv("ZONE_GRID_CELL_DEGREES", "0.5"))
+# Zone types (third letter of the id) a local answer must include: /zones?point= returns both, alerts use either,
+# so a point missing one of them (its file wasn't loaded, or it's only in one layer) is asked of the NWS API
+REQUIRED_ZONE_TYPES = {"C": "county", "Z": "forecast/fire"}
+
+_zone_index = {"index": None, "loaded": False}
+_zone_index_lock = threading.Lock()
+
+
+# NWS zone id for a feature: API GeoJSON has it as "id", shapefile attributes are STATE + ZONE or STATE + FIPS
+def feature_zone_id(properties):
+
+    if properties.get("id"):
+        return properties["id"].rsplit("/", 1)[-1]
+    if properties.get("STATE") and properties.get("ZONE"):
+        return f"{properties['STATE']}Z{properties['ZONE']}"
+    if properties.get("STATE") and properties.get("FIPS"):
+        return f"{properties['STATE']}C{str(properties['FIPS'])[-3:]}"
+    return None
+
+
+# "C" for county zones, "Z" for forecast and fire zones (FLC127, FLZ141)
+def zone_type(zone_id):
+
+    return zone_id[2:3].upper()
+
+
+# Even-odd ray casting over every ring of a polygon, so holes are excluded without special handling
+def point_in_rings(lng, lat, rings):
+
+    inside = False
+    for ring in rings:
+        previous_lng, previous_lat = ring[-1][0], ring[-1][1]
+        for point in ring:
+            point_lng, point_lat = point[0], point[1]
+            if (point_lat > lat) != (previous_lat > lat):
+                crossing_lng = (previous_lng - point_lng) * (lat - point_lat) / (previous_lat - point_lat) + point_lng
+                if lng < crossing_lng:
+                    inside = not inside
+            previous_lng, previous_lat = point_lng, point_lat
+    return inside
+
+
+"""
+In-memory zone lookup: polygons bucketed into a lat/lng grid by bounding box.
+A lookup checks only the polygons in the point's cell, bounding box first, then point-in-polygon.
+"""
+class ZoneIndex:
+
+    def __init__(self, cell_degrees=ZONE_GRID_CELL_DEGREES):
+        self.cell_degrees = cell_degrees
+        self._polygons = []  # (zone_id, (min_lng, min_lat, max_lng, max_lat), rings)
+        self._grid = {}      # (cell_x, cell_y) -> [polygon index]
+        self.zone_types = {}  # zone type letter -> polygons loaded
+
+    def __len__(self):
+        return len(self._polygons)
+
+    def _cell(self, lng, lat):
+        return math.floor(lng / self.cell_degrees), math.floor(lat / self.cell_degrees)
+
+    def add_polygon(self, zone_id, rings):
+        points = [point for ring in rings for point in ring]
+        bbox = (min(p[0] for p in points), min(p[1] for p in points), max(p[0] for p in points), max(p[1] for p in points))
+        position = len(self._polygons)
+        self._polygons.append((zone_id, bbox, rings))
+        self.zone_types[zone_type(zone_id)] = self.zone_types.get(zone_type(zone_id), 0) + 1
+
+        min_x, min_y = self._cell(bbox[0], bbox[1])
+        max_x, max_y = self._cell(bbox[2], bbox[3])
+        for cell_x in range(min_x, max_x + 1):
+            for cell_y in range(min_y, max_y + 1):
+                self._grid.setdefault((cell_x, cell_y), []).append(position)
+
+    def add_feature(self, feature):
+        zone_id = feature_zone_id(feature.get("properties") or {})
+        geometry = feature.get("geometry") or {}
+        if not zone_id:
+            return
+        if geometry.get("type") == "Polygon":
+            self.add_polygon(zone_id, geometry["coordinates"])
+        elif geometry.get("type") == "MultiPolygon":
+            for polygon in geometry["coordinates"]:
+                self.add_polygon(zone_id, polygon)
+
+    def lookup(self, lat, lng):
+        zone_ids = set()
+        for position in self._grid.get(self._cell(lng, lat), ()):
+            zone_id, (min_lng, min_lat, max_lng, max_lat), rings = self._polygons[position]
+            if zone_id in zone_ids or not (min_lng <= lng <= max_lng and min_lat <= lat <= max_lat):
+                continue
+            if point_in_rings(lng, lat, rings):
+                zone_ids.add(zone_id)
+        return sorted(zone_ids)
+
+
+def load_zone_index(data_dir=ZONE_DATA_DIR):
+
+    index = ZoneIndex()
+    paths = sorted(glob.glob(os.path.join(data_dir, "*.json")) + glob.glob(os.path.join(data_dir, "*.geojson")))
+    for path in paths:
+        with open(path, encoding="utf-8") as f:
+            data = json.load(f)
+        for feature in data.get("features", [data] if data.get("type") == "Feature" else []):
+            index.add_feature(feature)
+    logging.info(f"Loaded {len(index)} zone polygons from {len(paths)} files in {data_dir}, "
+                 f"by zone type: {index.zone_types}")
+    missing = [name for zone_type, name in REQUIRED_ZONE_TYPES.items() if zone_type not in index.zone_types]
+    if missing:
+        logging.warning(f"No {' or '.join(missing)} zones in {data_dir}, every signup will use the NWS API")
+    return index
+
+
+"""
+Built on first use and kept for the process, None when ZONE_DATA_DIR isn't set or couldn't be loaded.
+With wait=False it also returns None while another thread (the startup load) is still building it, instead of
+blocking on the lock for the whole load.
+"""
+def get_zone_index(wait=True):
+
+    if not _zone_index["loaded"]:
+        if not _zone_index_lock.acquire(blocking=wait):
+            return None
+        try:
+            if not _zone_index["loaded"]:
+                if ZONE_DATA_DIR:
+                    try:
+                        _zone_index["index"] = load_zone_index(ZONE_DATA_DIR)
+                    except (OSError, ValueError) as e:
+                        logging.error(f"Failed to load zone data from {ZONE_DATA_DIR}: {e}")
+                _zone_index["loaded"] = True
+        finally:
+            _zone_index_lock.release()
+    return _zone_index["index"]
+
+
+"""
+Zone ids covering the point from the local index, an empty list when there's no local data for it (yet), so a
+signup during the startup load asks the NWS API rather than waiting. A partial answer is also empty: a point
+matching a forecast zone but no county zone would otherwise never get the county-coded warnings.
+"""
+def lookup_zone_ids(lat, lng):
+
+    index = get_zone_index(wait=False)
+    if index is None:
+        return []
+    zone_ids = index.lookup(float(lat), float(lng))
+    if not set(REQUIRED_ZONE_TYPES) <= {zone_type(zone_id) for zone_id in zone_ids}:
+        return []
+    return zone_ids
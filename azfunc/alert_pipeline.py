@@ -0,0 +1,205 @@
+import asyncio
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+from alert_worker import fetch_changed_alerts, resolve_subscribers, build_alert_index, build_pending_checks, \
+    build_messages, log_failed_checks, release_unqueued, store_alert_snapshot
+from helpers import alert_check_bulk, get_user_emails, send_messages_to_queue
+from helpers.subscriber_cache import SUBSCRIBER_CACHE_ENABLED
+from helpers.telemetry import stage, record_pairs
+
+# Alerts (and message groups) allowed to wait between stages, keeps memory flat on big outbreaks
+PIPELINE_QUEUE_SIZE = int(os.getenv("PIPELINE_QUEUE_SIZE", "8"))
+# Alerts whose dedup writes run at once, each in its own thread on the blocking Cosmos client
+PIPELINE_DEDUP_WORKERS = int(os.getenv("PIPELINE_DEDUP_WORKERS", "4"))
+# Send as soon as this many messages are waiting, or earlier when the dedup stage has nothing more ready
+PIPELINE_SEND_THRESHOLD = int(os.getenv("PIPELINE_SEND_THRESHOLD", "500"))
+# Subscriber lookup started as soon as the feed being parsed has turned up this many new zones
+PIPELINE_LOOKUP_ZONES = int(os.getenv("PIPELINE_LOOKUP_ZONES", "250"))
+# Subscriber lookups running at once, each in its own thread on the blocking Cosmos client
+PIPELINE_LOOKUP_WORKERS = int(os.getenv("PIPELINE_LOOKUP_WORKERS", "4"))
+
+_DONE = object()
+
+
+# One chunk of zones: (zone_to_users, user_emails), emails the zone lookup didn't bring are read from users
+def lookup_subscribers(zone_ids):
+
+    zone_to_users, user_emails = resolve_subscribers(zone_ids)
+    if user_emails is None:
+        user_emails = get_user_emails({user_id for user_ids in zone_to_users.values() for user_id in user_ids})
+    return zone_to_users, user_emails
+
+
+"""
+Subscriber lookups started while the feed is still being parsed: the parse thread hands over each changed alert and
+every PIPELINE_LOOKUP_ZONES new zones are looked up on a worker thread, so the reads overlap with the download.
+The subscriber cache answers from memory, so with it on there's a single lookup once the parse is done.
+"""
+class SubscriberLookahead:
+
+    def __init__(self):
+        self._executor = ThreadPoolExecutor(max_workers=PIPELINE_LOOKUP_WORKERS)
+        self._seen_zone_ids = set()
+        self._pending_zone_ids = []
+        self._futures = []
+
+    # Called from the parse thread for each new or superseded alert
+    def add_alert(self, alert):
+        for zone_id in alert["properties"]["geocode"].get("UGC", []):
+            if zone_id not in self._seen_zone_ids:
+                self._seen_zone_ids.add(zone_id)
+                self._pending_zone_ids.append(zone_id)
+        if not SUBSCRIBER_CACHE_ENABLED and len(self._pending_zone_ids) >= PIPELINE_LOOKUP_ZONES:
+            self._submit()
+
+    def _submit(self):
+        if self._pending_zone_ids:
+            self._futures.append(self._executor.submit(lookup_subscribers, self._pending_zone_ids))
+            self._pending_zone_ids = []
+
+    # Merged (zone_to_users, user_emails) of every lookup, the zones of the last partial chunk are looked up now
+    async def results(self):
+        self._submit()
+        zone_to_users, user_emails = {}, {}
+        for chunk_zone_to_users, chunk_user_emails in await asyncio.gather(
+                *[asyncio.wrap_future(future) for future in self._futures]):
+            zone_to_users.update(chunk_zone_to_users)
+            user_emails.update(chunk_user_emails)
+        return zone_to_users, user_emails
+
+    # Lookups not started yet are dropped when the tick stops early
+    def close(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+
+"""
+First half of an async tick, returns what prepare_tick() does: the feed is fetched and diffed in a thread while
+SubscriberLookahead resolves the zones it has turned up so far, instead of querying zones and then emails after
+the whole feed is read. The zone_query stage is only the wait for lookups still running once the parse is done.
+"""
+async def prepare_tick_async():
+
+    lookahead = SubscriberLookahead()
+    try:
+        changed = await asyncio.to_thread(fetch_changed_alerts, lookahead.add_alert)
+        if changed is None:
+            return None
+        all_alerts, current_alerts, affected_zone_ids = changed
+        try:
+            with stage("zone_query", zones=len(affected_zone_ids)):
+                zone_to_users, user_emails = await lookahead.results()
+        except Exception as e:
+            logging.error(f"Failed to query zone subscriptions: {e}")
+            return None
+    finally:
+        lookahead.close()
+
+    logging.info(f"{len(zone_to_users)} of {len(affected_zone_ids)} affected zones have subscribers.")
+    _, user_to_alerts = build_alert_index(all_alerts, zone_to_users)
+    return all_alerts, current_alerts, user_to_alerts, user_emails
+
+
+"""
+Dedup stage: record one alert's (alert, user) pairs and hand the messages for the new ones to the send stage.
+alert_check_bulk() runs in a thread, so the writes for one alert overlap with sending the previous alert's messages.
+"""
+async def dedup_stage(checks_queue, messages_queue, payloads, retry_alert_ids):
+
+    while True:
+        item = await checks_queue.get()
+        if item is _DONE:
+            return
+        alert_id, pending_checks = item
+        try:
+            with stage("dedup", pairs=len(pending_checks)):
+                created, existing, failed = await asyncio.to_thread(alert_check_bulk, pending_checks)
+        except Exception as e:
+            logging.error(f"Failed to record sent alerts for {alert_id}: {e}")
+            retry_alert_ids.add(alert_id)
+            continue
+        record_pairs(len(created), len(existing), len(failed))
+
+        retry_alert_ids.update(log_failed_checks(failed))
+        messages = build_messages(created, payloads)
+        if messages:
+            await messages_queue.put(messages)
+
+
+# Send stage: batch up whatever the dedup stage has produced and queue it, releasing what doesn't get queued
+async def send_stage(messages_queue, retry_alert_ids, counts):
+
+    pending, done = [], False
+    while not done:
+        item = await messages_queue.get()
+        if item is _DONE:
+            done = True
+        else:
+            pending.extend(item)
+        if pending and (done or len(pending) >= PIPELINE_SEND_THRESHOLD or messages_queue.empty()):
+            await send_pending(pending, retry_alert_ids, counts)
+            pending = []
+
+
+async def send_pending(messages, retry_alert_ids, counts):
+
+    try:
+        with stage("enqueue", messages=len(messages)):
+            failures = await send_messages_to_queue(messages)
+    except Exception as e:
+        logging.error(f"Failed to queue messages: {e}")
+        failures = [{"messages": messages, "error": e}]
+
+    unqueued = []
+    for failure in failures:
+        logging.error(f"Failed to queue a batch of {len(failure['messages'])} messages: {failure['error']}")
+        unqueued.extend(failure["messages"])
+    if unqueued:
+        await asyncio.to_thread(release_unqueued, unqueued)
+        retry_alert_ids.update(msg["alert_id"] for msg in unqueued)
+    counts["queued"] += len(messages) - len(unqueued)
+
+
+"""
+Async version of get_alerts(): the subscriber lookups overlap with the streaming parse (prepare_tick_async), then the
+fan-out streams alert by alert through bounded queues: pending checks -> dedup workers -> sender.
+With many alerts a tick takes about as long as its slowest stage instead of the sum of all of them.
+Must run on run_on_worker_loop() so the cached Service Bus sender stays on one event loop.
+"""
+async def get_alerts_async():
+
+    with stage("tick", mode="async"):
+        tick = await prepare_tick_async()
+        if tick is None:
+            return
+        all_alerts, current_alerts, user_to_alerts, user_email_list = tick
+        payloads, pending_checks = build_pending_checks(all_alerts, user_to_alerts, user_email_list)
+
+        checks_by_alert = {}
+        for alert_details in pending_checks:
+            checks_by_alert.setdefault(alert_details["alert_id"], []).append(alert_details)
+
+        checks_queue = asyncio.Queue(maxsize=PIPELINE_QUEUE_SIZE)
+        messages_queue = asyncio.Queue(maxsize=PIPELINE_QUEUE_SIZE)
+        retry_alert_ids = set()  # alerts left out of the snapshot so they're retried
+        counts = {"queued": 0}
+
+        dedup_workers = [asyncio.create_task(dedup_stage(checks_queue, messages_queue, payloads, retry_alert_ids))
+                         for _ in range(min(PIPELINE_DEDUP_WORKERS, max(1, len(checks_by_alert))))]
+        sender = asyncio.create_task(send_stage(messages_queue, retry_alert_ids, counts))
+
+        try:
+            for item in checks_by_alert.items():
+                await checks_queue.put(item)
+            for _ in dedup_workers:
+                await checks_queue.put(_DONE)
+            await asyncio.gather(*dedup_workers)
+            await messages_queue.put(_DONE)
+            await sender
+        except BaseException:
+            for task in dedup_workers + [sender]:
+                task.cancel()
+            raise
+
+        logging.info(f"Queued {counts['queued']} messages successfully.")
+        store_alert_snapshot(current_alerts, retry_alert_ids)
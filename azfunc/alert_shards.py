@@ -0,0 +1,100 @@
+import json
+import logging
+import os
+import zlib
+from alert_worker import fetch_changed_alerts, resolve_recipients, fan_out, store_alert_snapshot
+from helpers import send_messages_to_queue, run_on_worker_loop
+from helpers.telemetry import stage
+
+# Work queue the coordinator fills with shard jobs, the process_shard function listens on it
+SHARD_QUEUE_NAME = os.getenv("SHARD_QUEUE_NAME", "weather_alert_shards")
+# Alerts carried by one job, in JSON bytes, kept under the 256 KB Service Bus message limit
+SHARD_JOB_MAX_BYTES = int(os.getenv("SHARD_JOB_MAX_BYTES", str(192 * 1024)))
+
+
+# Stable across processes and Python versions (unlike hash()), so a zone always lands on the same shard
+def shard_for_zone(zone_id, shards):
+
+    return zlib.crc32(zone_id.encode("utf-8")) % shards
+
+
+"""
+Split a tick into shard jobs: affected zones are grouped by shard and each job carries the alerts touching its zones.
+A shard with more alerts than fit in one message becomes several jobs, each listing only the zones its alerts cover.
+"""
+def build_shard_jobs(all_alerts, affected_zone_ids, shards):
+
+    alerts_by_shard = {}  # shard -> [(alert, its zones in that shard)]
+    for alert in all_alerts:
+        zones_by_shard = {}
+        for zone_id in alert["properties"]["geocode"].get("UGC", []):
+            if zone_id in affected_zone_ids:
+                zones_by_shard.setdefault(shard_for_zone(zone_id, shards), set()).add(zone_id)
+        for shard, zone_ids in zones_by_shard.items():
+            alerts_by_shard.setdefault(shard, []).append((alert, zone_ids))
+
+    jobs = []
+    for shard in sorted(alerts_by_shard):
+        alerts, zone_ids, size = [], set(), 0
+        for alert, alert_zone_ids in alerts_by_shard[shard]:
+            alert_size = len(json.dumps(alert))
+            if alerts and size + alert_size > SHARD_JOB_MAX_BYTES:
+                jobs.append({"shard": shard, "shards": shards, "zone_ids": sorted(zone_ids), "alerts": alerts})
+                alerts, zone_ids, size = [], set(), 0
+            alerts.append(alert)
+            zone_ids.update(alert_zone_ids)
+            size += alert_size
+        jobs.append({"shard": shard, "shards": shards, "zone_ids": sorted(zone_ids), "alerts": alerts})
+    return jobs
+
+
+"""
+Coordinator half of a sharded tick: fetch and diff the feed, then queue one job per shard instead of fanning out here.
+The snapshot is saved once the jobs are queued, Service Bus redelivery retries a job whose worker fails.
+Alerts in jobs that couldn't be queued are left out of the snapshot so the next tick queues them again.
+"""
+@stage("tick", mode="coordinator")
+def coordinate_tick(shards):
+
+    changed = fetch_changed_alerts()
+    if changed is None:
+        return
+    all_alerts, current_alerts, affected_zone_ids = changed
+
+    jobs = build_shard_jobs(all_alerts, affected_zone_ids, shards)
+    try:
+        with stage("dispatch", jobs=len(jobs)):
+            failures = run_on_worker_loop(send_messages_to_queue(jobs, queue_name=SHARD_QUEUE_NAME))
+    except Exception as e:
+        logging.error(f"Failed to queue shard jobs: {e}")
+        return
+
+    retry_alert_ids = set()
+    unqueued = 0
+    for failure in failures:
+        logging.error(f"Failed to queue {len(failure['messages'])} shard jobs: {failure['error']}")
+        unqueued += len(failure["messages"])
+        for job in failure["messages"]:
+            retry_alert_ids.update(alert["properties"]["id"] for alert in job["alerts"])
+    logging.info(f"Queued {len(jobs) - unqueued} shard jobs for {len(affected_zone_ids)} zones across {shards} shards.")
+
+    store_alert_snapshot(current_alerts, retry_alert_ids)
+
+
+"""
+Worker half: resolve the subscribers of one job's zones, record the pairs and queue the emails.
+Raises when any of it needs another go so Service Bus redelivers the job, the sent_alerts records keep a
+redelivered job from emailing the users it already reached. A user subscribed in two shards is also deduped there.
+"""
+def run_shard_job(job):
+
+    with stage("shard", shard=job["shard"], zones=len(job["zone_ids"]), alerts=len(job["alerts"])):
+        recipients = resolve_recipients(job["alerts"], job["zone_ids"])
+        if recipients is None:
+            raise RuntimeError(f"Shard {job['shard']}: subscriber lookup failed")
+
+        retry_alert_ids = fan_out(job["alerts"], *recipients)
+        if retry_alert_ids is None:
+            raise RuntimeError(f"Shard {job['shard']}: no pairs were recorded or queued")
+        if retry_alert_ids:
+            raise RuntimeError(f"Shard {job['shard']}: {len(retry_alert_ids)} alerts need a retry")
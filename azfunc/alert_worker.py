@@ -1,25 +1,273 @@
 import requests
 import logging
-import asyncio
-from datetime import datetime, timezone
-from azure.cosmos.exceptions import CosmosResourceExistsError, CosmosHttpResponseError
+import os
+from datetime import datetime, timedelta, timezone
+from azure.cosmos.exceptions import CosmosHttpResponseError
+from helpers.cosmos_helpers import ZONE_SUBSCRIBERS_ENABLED
+from helpers.subscriber_cache import SUBSCRIBER_CACHE_ENABLED, subscriber_cache
+from helpers.telemetry import stage, record_alerts, record_pairs, debug_payload
 from helpers import (
     get_zone_to_users,
     get_user_emails,
-    alert_check,
+    get_zone_subscribers,
+    alert_check_bulk,
+    release_alert_checks,
+    get_alert_snapshot,
+    save_alert_snapshot,
     get_active_alerts,
-    send_messages_to_queue
+    send_messages_to_queue,
+    run_on_worker_loop
 )
 
+# Alert properties used by the fan-out and the queued messages, everything else is dropped while streaming
+ALERT_FIELDS = (
+    "id", "areaDesc", "geocode", "sent", "effective", "severity", "certainty", "urgency", "event",
+    "senderName", "headline", "description", "instruction", "response", "web", "expires", "ends"
+)
+
+
+"""
+"per_alert" is only used where a chunk of recipients can't be emailed twice: the batch dispatcher re-queues just the
+recipients that failed, and track mode only submits each send so the chunk goes out in seconds. send_emails in wait
+mode blocks on every delivery in turn, and a timeout part way through has Service Bus redeliver the whole chunk.
+"""
+def queue_message_format(message_format, dispatch_mode, send_mode):
+
+    if message_format == "per_alert" and dispatch_mode != "batch" and send_mode != "track":
+        logging.warning("QUEUE_MESSAGE_FORMAT=per_alert needs EMAIL_DISPATCH_MODE=batch or EMAIL_SEND_MODE=track, "
+                        "queueing per_user messages")
+        return "per_user"
+    return message_format
+
+
+# "per_user" queues one message per (alert, user), "per_alert" one copy of the alert per chunk of recipients.
+# The email settings are read here rather than imported, so the poller doesn't load the ACS SDK
+QUEUE_MESSAGE_FORMAT = queue_message_format(os.getenv("QUEUE_MESSAGE_FORMAT", "per_user"),
+                                            os.getenv("EMAIL_DISPATCH_MODE", "trigger"),
+                                            os.getenv("EMAIL_SEND_MODE", "wait"))
+RECIPIENTS_PER_MESSAGE = int(os.getenv("RECIPIENTS_PER_MESSAGE", "50"))
+
+# An unchanged alert is fanned out again this long after its last fan-out, so users who signed up since still get it
+ALERT_SNAPSHOT_MAX_AGE = timedelta(minutes=int(os.getenv("ALERT_SNAPSHOT_MAX_AGE_MINUTES", "30")))
+
+
+# Split the feed into alerts that are new or superseded since the previous tick and the snapshot to save
+# on_changed(alert) is called for each of them as soon as it's read, while the rest of the feed is still streaming
+def diff_alerts(all_alerts, previous_alerts, on_changed=None):
+
+    changed_alerts = []
+    current_alerts = {}
+    for alert in all_alerts:
+        alert_properties = alert["properties"]
+        alert_id = alert_properties.get("id")
+        sent = alert_properties.get("sent")
+        current_alerts[alert_id] = sent
+        if previous_alerts.get(alert_id) != sent:
+            changed_alerts.append(alert)
+            if on_changed is not None:
+                on_changed(alert)
+    return changed_alerts, current_alerts
+
+
+"""
+Previous tick's {alert_id: sent}, keeping only the alerts fanned out within ALERT_SNAPSHOT_MAX_AGE so the others
+go out again. Returns (previous_alerts, {alert_id: fanned out at} for those, whether any alert is due again)
+"""
+def load_previous_alerts():
+
+    try:
+        snapshot = get_alert_snapshot()
+    except Exception as e:
+        logging.warning(f"Failed to load alert snapshot, processing all alerts: {e}")
+        return {}, {}, True
+
+    now = datetime.now(timezone.utc)
+    saved_fanned_out_at = snapshot.get("fanned_out_at") or {}
+    previous_alerts, fanned_out_at = {}, {}
+    for alert_id, sent in snapshot["alerts"].items():
+        fanned_out = saved_fanned_out_at.get(alert_id)
+        if fanned_out and now - datetime.fromisoformat(fanned_out) <= ALERT_SNAPSHOT_MAX_AGE:
+            previous_alerts[alert_id] = sent
+            fanned_out_at[alert_id] = fanned_out
+    return previous_alerts, fanned_out_at, len(previous_alerts) < len(snapshot["alerts"])
+
+
+# Alert fields shared by every message queued for that alert
+def alert_payload(alert_properties):
+
+    return {
+        "alert_id": alert_properties.get("id"),
+        "areaDesc": alert_properties.get("areaDesc"),
+        "created_at": alert_properties.get("sent"),
+        "effective_at": alert_properties.get("effective"),
+        "severity": alert_properties.get("severity"),
+        "certainty": alert_properties.get("certainty"),
+        "urgency": alert_properties.get("urgency"),
+        "event": alert_properties.get("event"),
+        "senderName": alert_properties.get("senderName"),
+        "headline": alert_properties.get("headline"),
+        "description": alert_properties.get("description"),
+        "instruction": alert_properties.get("instruction"),
+        "response": alert_properties.get("response"),
+        "link": alert_properties.get("web"),
+        "expires_at": alert_properties.get("expires"),
+        "ends_at": alert_properties.get("ends")
+    }
+
+
+"""
+Build the fan-out indexes for one tick:
+zone_to_alerts maps each subscribed zone to the indexes of the alerts covering it
+user_to_alerts maps each subscriber to {alert index: first matching zone}, which also drops duplicate (alert, user) pairs
+"""
+def build_alert_index(all_alerts, zone_to_users):
+
+    zone_to_alerts = {}
+    for alert_index, alert in enumerate(all_alerts):
+        for zone_id in alert["properties"].get("geocode", {}).get("UGC", []):
+            if zone_id not in zone_to_users:
+                continue
+            zone_alerts = zone_to_alerts.setdefault(zone_id, [])
+            if not zone_alerts or zone_alerts[-1] != alert_index:
+                zone_alerts.append(alert_index)
+
+    user_to_alerts = {}
+    for zone_id, alert_indexes in zone_to_alerts.items():
+        for user_id in zone_to_users[zone_id]:
+            user_alerts = user_to_alerts.setdefault(user_id, {})
+            for alert_index in alert_indexes:
+                user_alerts.setdefault(alert_index, zone_id)
+    return zone_to_alerts, user_to_alerts
+
+
+# Turn newly recorded (alert, user) pairs into queue messages in the configured format
+def build_messages(created, payloads):
+
+    if QUEUE_MESSAGE_FORMAT != "per_alert":
+        return [{
+            "user_id": alert_sent_details["user_id"],
+            "email": alert_sent_details["email"],
+            "zone_id": alert_sent_details["zone_id"],
+            **payloads[alert_sent_details["alert_id"]]
+        } for alert_sent_details in created]
+
+    recipients_by_alert = {}
+    for alert_sent_details in created:
+        recipients_by_alert.setdefault(alert_sent_details["alert_id"], []).append({
+            "user_id": alert_sent_details["user_id"],
+            "email": alert_sent_details["email"],
+            "zone_id": alert_sent_details["zone_id"]
+        })
+
+    messages = []
+    for alert_id, recipients in recipients_by_alert.items():
+        for start in range(0, len(recipients), RECIPIENTS_PER_MESSAGE):
+            messages.append({**payloads[alert_id], "recipients": recipients[start:start + RECIPIENTS_PER_MESSAGE]})
+    return messages
+
+
+# The (alert, user) pairs a queue message covers, in either format
+def message_pairs(messages):
+
+    pairs = []
+    for msg in messages:
+        for recipient in msg.get("recipients") or [msg]:
+            pairs.append({"alert_id": msg["alert_id"], "user_id": recipient["user_id"]})
+    return pairs
+
+
+# Undo the dedup records of messages that weren't queued so they're sent on a later tick
+def release_unqueued(messages):
+
+    try:
+        not_released = release_alert_checks(message_pairs(messages))
+    except Exception as e:
+        logging.error(f"Failed to release sent alert records: {e}")
+        return
+    if not_released:
+        logging.error(f"Failed to release {len(not_released)} sent alert records, those users won't be retried.")
+
+
+# (zone_to_users, user_emails) for the affected zones, user_emails is None when it still needs a users query
+def resolve_subscribers(affected_zone_ids):
+
+    if SUBSCRIBER_CACHE_ENABLED:
+        try:
+            return subscriber_cache.resolve(affected_zone_ids)
+        except Exception as e:
+            # Reloaded from scratch on the next tick
+            logging.error(f"Subscriber cache failed, querying Cosmos instead: {e}")
+            subscriber_cache.clear()
+    if ZONE_SUBSCRIBERS_ENABLED:
+        # Zone documents carry their subscribers' emails, no separate users lookup
+        return get_zone_subscribers(affected_zone_ids)
+    return get_zone_to_users(affected_zone_ids), None
+
+
+# Whether the last tick in this process ran to completion, so an unchanged feed is safe to skip,
+# and when the alerts this tick isn't fanning out again were last fanned out
+_tick_state = {"complete": False, "fanned_out_at": {}}
 
-def get_alerts():
+
+"""
+Alerts fanned out this tick are stamped now, the others keep the time of their last fan-out.
+Alerts that need a retry are left out, and the tick only counts as complete without them: the feed is unchanged
+on the next tick's request, so skipping it would leave them out until the NWS feed changes.
+"""
+def store_alert_snapshot(current_alerts, retry_alert_ids=()):
+
+    for alert_id in retry_alert_ids:
+        current_alerts.pop(alert_id, None)
+    _tick_state["complete"] = not retry_alert_ids
+    now = datetime.now(timezone.utc).isoformat()
+    previous = _tick_state.get("fanned_out_at", {})
+    fanned_out_at = {alert_id: previous.get(alert_id, now) for alert_id in current_alerts}
+    try:
+        save_alert_snapshot(current_alerts, fanned_out_at)
+    except Exception as e:
+        logging.error(f"Failed to save alert snapshot: {e}")
+
+
+"""
+Fetch and diff the feed, shared by every tick mode (the sharded coordinator stops here).
+Returns (all_alerts, current_alerts, affected_zone_ids), or None when there's nothing to fan out
+"""
+def fetch_changed_alerts(on_changed=None):
+
+    # An unchanged feed is only skipped when no alert is due to be fanned out again
+    previous_alerts, fanned_out_at, refresh_due = load_previous_alerts()
 
     # Fetch active alerts from the NWS API
+    skip_unchanged = _tick_state["complete"] and not refresh_due
+    _tick_state["complete"] = False
     try:
-        all_alerts = get_active_alerts()
+        with stage("fetch"):
+            all_alerts = get_active_alerts(skip_unchanged=skip_unchanged, stream=True, fields=ALERT_FIELDS)
     except requests.RequestException as e:
         logging.error(f"Failed to fetch NWS alerts: {e}")
-        return
+        return None
+    if all_alerts is None:
+        logging.info("NWS alerts unchanged since last poll.")
+        _tick_state["complete"] = True
+        return None
+
+    # Read the streamed feed in one pass, keeping only new, superseded or due alerts for the fan-out
+    try:
+        with stage("parse"):
+            all_alerts, current_alerts = diff_alerts(all_alerts, previous_alerts, on_changed)
+    except (requests.RequestException, ValueError) as e:
+        logging.error(f"Failed to read NWS alerts: {e}")
+        return None
+    record_alerts(len(current_alerts), len(all_alerts))
+    _tick_state["fanned_out_at"] = {alert_id: fanned_out for alert_id, fanned_out in fanned_out_at.items()
+                                    if current_alerts.get(alert_id) == previous_alerts[alert_id]}
+    if not all_alerts:
+        logging.info("No new or updated NWS alerts since last poll.")
+        if refresh_due:
+            store_alert_snapshot(current_alerts)  # drops the due alerts that have since expired
+        else:
+            _tick_state["complete"] = True
+        return None
 
     # Collect affected zone IDs
     affected_zone_ids = set()
@@ -28,95 +276,157 @@ def get_alerts():
             affected_zone_ids.add(zone)
     if not affected_zone_ids:
         logging.info("No affected zones in current NWS alerts.")
-        return
+        store_alert_snapshot(current_alerts)
+        return None
+
+    return all_alerts, current_alerts, affected_zone_ids
+
+
+"""
+Resolve who gets which alert: subscribers of the affected zones and their emails (a shard job resolves its own zones).
+Returns (user_to_alerts, user_email_list), or None when a lookup failed
+"""
+def resolve_recipients(all_alerts, affected_zone_ids):
 
     # Query only the zone_id that are present in the NWS alerts
     try:
-        zone_to_users = get_zone_to_users(list(affected_zone_ids))
-        logging.info(f"All zone ids: {zone_to_users}")
+        with stage("zone_query", zones=len(affected_zone_ids)):
+            zone_to_users, user_email_list = resolve_subscribers(list(affected_zone_ids))
+        logging.info(f"{len(zone_to_users)} of {len(affected_zone_ids)} affected zones have subscribers.")
+        debug_payload("All zone ids", lambda: zone_to_users)
     except Exception as e:
         logging.error(f"Failed to query zone subscriptions: {e}")
-        return
+        return None
+
+    # Index zones -> alerts and users -> alerts once, so each user is visited once per tick
+    _, user_to_alerts = build_alert_index(all_alerts, zone_to_users)
+
+    # Batch-query users' emails when the zone lookup didn't already bring them
+    if user_email_list is None:
+        try:
+            with stage("email_lookup", users=len(user_to_alerts)):
+                user_email_list = get_user_emails(set(user_to_alerts))
+        except Exception as e:
+            logging.error(f"Failed to query user emails: {e}")
+            return None
+
+    return user_to_alerts, user_email_list
+
+
+"""
+First half of a tick, shared by get_alerts() and the async pipeline: fetch and diff the feed, then resolve subscribers.
+Returns (all_alerts, current_alerts, user_to_alerts, user_email_list), or None when there's nothing to fan out
+"""
+def prepare_tick():
+
+    changed = fetch_changed_alerts()
+    if changed is None:
+        return None
+    all_alerts, current_alerts, affected_zone_ids = changed
+
+    recipients = resolve_recipients(all_alerts, affected_zone_ids)
+    if recipients is None:
+        return None
+    return all_alerts, current_alerts, *recipients
 
-    # Batch-query users' emails
-    all_user_ids = set()
-    for users in zone_to_users.values():
-        for user in users:
-            all_user_ids.add(user)
+
+# Walk every user's alerts from the index, reusing each alert's payload for all of its recipients
+def build_pending_checks(all_alerts, user_to_alerts, user_email_list):
+
+    payloads = {}  # alert_id -> shared message fields
+    pending_checks = []
+    sent_at = datetime.now(timezone.utc).isoformat()
+    for user_id, user_alerts in user_to_alerts.items():
+        email = user_email_list.get(user_id)
+        if not email:
+            continue
+
+        for alert_index, zone_id in user_alerts.items():
+            alert_properties = all_alerts[alert_index]["properties"]
+            payload = payloads.get(alert_properties.get("id"))
+            if payload is None:
+                payload = payloads[alert_properties.get("id")] = alert_payload(alert_properties)
+
+            pending_checks.append({
+                "alert_id": payload["alert_id"],
+                "user_id": user_id,
+                "email": email,
+                "created_at": payload["created_at"],
+                "sent_at": sent_at,
+                "zone_id": zone_id,
+                "event": payload["event"],
+                "link": payload["link"],
+                "expires_at": payload["expires_at"],
+                "ends_at": payload["ends_at"]
+            })
+    return payloads, pending_checks
+
+
+# Log dedup writes that didn't go through, returns the alerts to leave out of the snapshot so they're retried
+def log_failed_checks(failed):
+
+    retry_alert_ids = set()
+    for alert_sent_details, error in failed:
+        alert_id, user_id = alert_sent_details["alert_id"], alert_sent_details["user_id"]
+        if isinstance(error, CosmosHttpResponseError):
+            logging.error(f"Cosmos DB error when processing alert {alert_id} for user {user_id}: {error}")
+        else:
+            logging.error(f"Unexpected error when processing alert {alert_id} for user {user_id}: {error}")
+        retry_alert_ids.add(alert_id)
+    return retry_alert_ids
+
+
+"""
+Second half of a tick, shared by get_alerts() and the shard workers: record the (alert, user) pairs and queue emails.
+Returns the ids of alerts that need another go, or None when nothing could be recorded or queued
+"""
+def fan_out(all_alerts, user_to_alerts, user_email_list):
+
+    # Record the (alert, user) pairs in bulk and queue only the ones that weren't sent before
+    payloads, pending_checks = build_pending_checks(all_alerts, user_to_alerts, user_email_list)
     try:
-        user_email_list = get_user_emails(all_user_ids)
+        with stage("dedup", pairs=len(pending_checks)):
+            created, existing, failed = alert_check_bulk(pending_checks)
     except Exception as e:
-        logging.error(f"Failed to query user emails: {e}")
-        return
+        logging.error(f"Failed to record sent alerts: {e}")
+        return None
+    record_pairs(len(created), len(existing), len(failed))
 
-    """
-    Loop through all alerts and find the users that are associated with that zone so they can be alerted
-    Call service_bus_sender to send messages to queue
-    """
-    all_messages = []
-    seen_alerts = set() # (alert_id, user_id)
-    for alert in all_alerts:
-        alert_properties = alert["properties"]
-        alert_id = alert_properties.get("id")
-        ugc = alert_properties.get("geocode", {}).get("UGC", [])
-
-        for zone_id in ugc:
-            users = zone_to_users.get(zone_id, [])
-            if users:
-                for user_id in users:
-                    if (alert_id, user_id) in seen_alerts:
-                        continue # already processed this user for this alert
-                    seen_alerts.add((alert_id, user_id))
-
-                    email = user_email_list.get(user_id)
-                    if not email:
-                        continue
-
-                    alert_sent_details = {
-                        "alert_id": alert_id,
-                        "user_id": user_id,
-                        "email": email,
-                        "created_at": alert_properties.get("sent"),
-                        "sent_at": datetime.now(timezone.utc).isoformat(),
-                        "zone_id": zone_id,
-                        "event": alert_properties.get("event"),
-                        "link": alert_properties.get("web")
-                    }
-
-                    try:
-                        alert_check(alert_sent_details)
-                        all_messages.append({
-                            "user_id": user_id,
-                            "email": email,
-                            "alert_id": alert_properties.get("id"),
-                            "zone_id": zone_id,
-                            "areaDesc": alert_properties.get("areaDesc"),
-                            "created_at": alert_properties.get("sent"),
-                            "effective_at": alert_properties.get("effective"),
-                            "severity": alert_properties.get("severity"),
-                            "certainty": alert_properties.get("certainty"),
-                            "urgency": alert_properties.get("urgency"),
-                            "event": alert_properties.get("event"),
-                            "senderName": alert_properties.get("senderName"),
-                            "headline": alert_properties.get("headline"),
-                            "description": alert_properties.get("description"),
-                            "instruction": alert_properties.get("instruction"),
-                            "response": alert_properties.get("response"),
-                            "link": alert_properties.get("web")
-                        })
-                    except CosmosResourceExistsError:
-                        continue
-                    except CosmosHttpResponseError as e:
-                        logging.error(f"Cosmos DB error when processing alert {alert_id} for user {user_id}: {e}")
-                        continue
-                    except Exception as e:
-                        logging.error(f"Unexpected error when processing alert {alert_id} for user {user_id}: {e}")
-                        continue
+    retry_alert_ids = log_failed_checks(failed)
+
+    all_messages = build_messages(created, payloads)
 
     # Send messages to Service Bus
     if all_messages:
         try:
-            asyncio.run(send_messages_to_queue(all_messages))
-            logging.info(f"Queued {len(all_messages)} messages successfully.")
+            with stage("enqueue", messages=len(all_messages)):
+                failures = run_on_worker_loop(send_messages_to_queue(all_messages))
         except Exception as e:
-            logging.error(f"Failed to queue messages: {e}")
\ No newline at end of file
+            logging.error(f"Failed to queue messages: {e}")
+            release_unqueued(all_messages)
+            return None
+
+        unqueued = []
+        for failure in failures:
+            logging.error(f"Failed to queue a batch of {len(failure['messages'])} messages: {failure['error']}")
+            unqueued.extend(failure["messages"])
+        if unqueued:
+            release_unqueued(unqueued)
+            retry_alert_ids.update(msg["alert_id"] for msg in unqueued)
+        logging.info(f"Queued {len(all_messages) - len(unqueued)} messages successfully.")
+    return retry_alert_ids
+
+
+# One span per tick, the stage spans are its children
+@stage("tick", mode="sync")
+def get_alerts():
+
+    tick = prepare_tick()
+    if tick is None:
+        return
+    all_alerts, current_alerts, user_to_alerts, user_email_list = tick
+
+    retry_alert_ids = fan_out(all_alerts, user_to_alerts, user_email_list)
+    if retry_alert_ids is None:
+        return
+    store_alert_snapshot(current_alerts, retry_alert_ids)
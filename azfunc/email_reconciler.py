@@ -0,0 +1,63 @@
+import logging
+import os
+from datetime import datetime, timedelta, timezone
+from azure.core.exceptions import HttpResponseError
+from helpers import (
+    get_pending_email_operations,
+    update_email_operation,
+    get_email_send_status
+)
+from helpers.email_sender import ACS_FINAL_STATUSES
+
+RECONCILE_BATCH_SIZE = int(os.getenv("EMAIL_RECONCILE_BATCH_SIZE", "500"))
+# Sends still not final after this long are given up on, ACS doesn't keep operation status forever
+EMAIL_OPERATION_MAX_AGE = timedelta(hours=int(os.getenv("EMAIL_OPERATION_MAX_AGE_HOURS", "24")))
+
+
+def reconcile_email_sends():
+
+    try:
+        pending = get_pending_email_operations(RECONCILE_BATCH_SIZE)
+    except Exception as e:
+        logging.error(f"Failed to query pending email sends: {e}")
+        return
+
+    counts = {"Succeeded": 0, "Failed": 0, "Running": 0}
+    for operation in pending:
+        operation_id = operation["id"]
+        try:
+            result = get_email_send_status(operation_id)
+            status, error = result.get("status"), result.get("error")
+        except HttpResponseError as e:
+            # raise_for_status() raises a plain HttpResponseError for a 404 too
+            if e.status_code == 404:
+                status, error = "Unknown", "ACS no longer has this operation"
+            else:
+                logging.error(f"ACS error when checking email send {operation_id}: {e}")
+                status, error = None, str(e)
+
+        # Sends that can't be settled are given up on at some point, or they'd fill every batch ahead of newer ones
+        if status not in ACS_FINAL_STATUSES and status != "Unknown":
+            submitted_at = datetime.fromisoformat(operation["submitted_at"])
+            if datetime.now(timezone.utc) - submitted_at < EMAIL_OPERATION_MAX_AGE:
+                if status is not None:
+                    counts["Running"] += 1
+                continue
+            if status is None:
+                status, error = "Unknown", f"No status after {EMAIL_OPERATION_MAX_AGE}: {error}"
+            else:
+                status, error = "Unknown", f"Still {status} after {EMAIL_OPERATION_MAX_AGE}"
+
+        try:
+            update_email_operation(operation_id, status, error)
+        except Exception as e:
+            logging.error(f"Failed to update email send {operation_id}: {e}")
+            continue
+
+        if status == "Succeeded":
+            counts["Succeeded"] += 1
+        else:
+            counts["Failed"] += 1
+            logging.error(f"Email send {operation_id} to {operation.get('to')} ended as {status}: {error}")
+
+    logging.info(f"Reconciled email sends: {counts}")
@@ -1,38 +1,113 @@
-import json
-import logging
-import azure.functions as func
-from alert_worker import get_alerts
-from helpers.email_sender import format_email, send_email_via_acs
-
-app = func.FunctionApp()
-
-
-@app.timer_trigger(schedule="0 */2 * * * *", arg_name="mytimer", run_on_startup=False,
-              use_monitor=False)
-def poll_alerts(mytimer: func.TimerRequest) -> None:
-    
-    logging.info("Timer trigger fired -> running get_alerts()")
-    try:
-        get_alerts()
-        logging.info("get_alerts() completed successfully.")
-
-    except Exception as e:
-        logging.error(f"Error in get_alerts(): {e}", exc_info=True)
-
-
-@app.service_bus_queue_trigger(arg_name="msg", queue_name="weather_alerts_queue", connection="ServiceBusConnection")
-def send_emails(msg: func.ServiceBusMessage):
-    logging.info('Python ServiceBus Queue trigger processed a message: %s', msg.get_body().decode('utf-8'))
-    try:
-        message_body = msg.get_body().decode('utf-8')
-        alert_data = json.loads(message_body)
-        subject, plain_body, html_body = format_email(alert_data)
-        send_email_via_acs(
-            to_email=alert_data["email"],
-            subject=subject,
-            plain_body=plain_body,
-            html_body=html_body
-        )
-        logging.info(f"Processing email for {alert_data['email']}")
-    except Exception as e:
-        logging.error(f"Function error: {e}")
+import json
+import logging
+import os
+import azure.functions as func
+
+# Each handler imports what it uses, so a worker indexing this module (and every cold start of one function)
+# only loads the SDKs that function needs. Budgets are checked by benchmarks/import_time.py
+
+# "sync" runs a tick stage by stage, "async" streams alerts through the overlapping stages of alert_pipeline
+ALERT_PIPELINE_MODE = os.getenv("ALERT_PIPELINE_MODE", "sync")
+# Above 0 poll_alerts only coordinates: affected zones are split into this many shards and queued as jobs
+# for process_shard, so the fan-out scales out across instances. 0 keeps the whole fan-out in poll_alerts
+FANOUT_SHARDS = int(os.getenv("FANOUT_SHARDS", "0"))
+SHARD_QUEUE_NAME = os.getenv("SHARD_QUEUE_NAME", "weather_alert_shards")
+# "trigger" sends one queue message per invocation, "batch" drains the queue on a timer with the async dispatcher
+EMAIL_DISPATCH_MODE = os.getenv("EMAIL_DISPATCH_MODE", "trigger")
+# "track" only submits each send, reconcile_emails then checks how the sends ended (same setting as helpers.email_sender)
+EMAIL_SEND_MODE = os.getenv("EMAIL_SEND_MODE", "wait")
+
+app = func.FunctionApp()
+
+
+@app.timer_trigger(schedule="0 */2 * * * *", arg_name="mytimer", run_on_startup=False,
+              use_monitor=False)
+def poll_alerts(mytimer: func.TimerRequest) -> None:
+    
+    logging.info("Timer trigger fired -> running get_alerts()")
+    try:
+        if FANOUT_SHARDS > 0:
+            from alert_shards import coordinate_tick
+            coordinate_tick(FANOUT_SHARDS)
+        elif ALERT_PIPELINE_MODE == "async":
+            from alert_pipeline import get_alerts_async
+            from helpers.service_bus_sender import run_on_worker_loop
+            run_on_worker_loop(get_alerts_async())
+        else:
+            from alert_worker import get_alerts
+            get_alerts()
+        logging.info("get_alerts() completed successfully.")
+
+    except Exception as e:
+        logging.error(f"Error in get_alerts(): {e}", exc_info=True)
+
+
+if FANOUT_SHARDS > 0:
+
+    @app.service_bus_queue_trigger(arg_name="msg", queue_name=SHARD_QUEUE_NAME, connection="ServiceBusConnection")
+    def process_shard(msg: func.ServiceBusMessage):
+
+        # Errors aren't caught: a failed shard job is redelivered by Service Bus, then dead-lettered
+        # Jobs running at once on one instance each queue emails on their own thread's event loop
+        from alert_shards import run_shard_job
+        job = json.loads(msg.get_body().decode('utf-8'))
+        logging.info(f"Processing shard {job['shard']}/{job['shards']} with {len(job['zone_ids'])} zones")
+        run_shard_job(job)
+
+
+if EMAIL_DISPATCH_MODE == "batch":
+
+    @app.timer_trigger(schedule="*/30 * * * * *", arg_name="mytimer", run_on_startup=False,
+                  use_monitor=False)
+    def dispatch_emails(mytimer: func.TimerRequest) -> None:
+
+        try:
+            from helpers.email_dispatcher import drain_email_queue
+            from helpers.service_bus_sender import run_on_worker_loop
+            run_on_worker_loop(drain_email_queue())
+        except Exception as e:
+            logging.error(f"Error in drain_email_queue(): {e}", exc_info=True)
+
+else:
+
+    @app.service_bus_queue_trigger(arg_name="msg", queue_name="weather_alerts_queue", connection="ServiceBusConnection")
+    def send_emails(msg: func.ServiceBusMessage):
+        logging.info('Python ServiceBus Queue trigger processed a message: %s', msg.get_body().decode('utf-8'))
+        try:
+            from helpers.email_sender import format_email, send_email_via_acs
+            message_body = msg.get_body().decode('utf-8')
+            alert_data = json.loads(message_body)
+            subject, plain_body, html_body = format_email(alert_data)
+            # Alert-level messages carry a chunk of recipients, the email is rendered once for all of them
+            recipients = alert_data.get("recipients") or [{"email": alert_data["email"]}]
+            for recipient in recipients:
+                operation_id = send_email_via_acs(
+                    to_email=recipient["email"],
+                    subject=subject,
+                    plain_body=plain_body,
+                    html_body=html_body
+                )
+                # Track mode: the send was only submitted, reconcile_emails checks how it ended
+                if operation_id:
+                    try:
+                        # Cosmos is only loaded by the email function in track mode
+                        from helpers.cosmos_helpers import record_email_operation
+                        record_email_operation(operation_id, recipient["email"], alert_data.get("alert_id"))
+                    except Exception as e:
+                        logging.error(f"Failed to record email send {operation_id}: {e}")
+                logging.info(f"Processing email for {recipient['email']}")
+        except Exception as e:
+            logging.error(f"Function error: {e}")
+
+
+if EMAIL_SEND_MODE == "track":
+
+    @app.timer_trigger(schedule="0 */5 * * * *", arg_name="mytimer", run_on_startup=False,
+                  use_monitor=False)
+    def reconcile_emails(mytimer: func.TimerRequest) -> None:
+
+        try:
+            from email_reconciler import reconcile_email_sends
+            reconcile_email_sends()
+        except Exception as e:
+            logging.error(f"Error in reconcile_email_sends(): {e}", exc_info=True)
@@ -1,4 +1,40 @@
-from .cosmos_helpers import create_user, get_zone_to_users, get_user_emails, alert_check
-from .nws_client import get_active_alerts
-from .service_bus_sender import send_messages_to_queue
-from .email_sender import format_email, send_email_via_acs
\ No newline at end of file
+import importlib
+
+# Public helper -> submodule that defines it. Submodules are only imported when one of their names is first used,
+# so an entry point that needs the email sender doesn't pay for the Cosmos SDK and the other way round (PEP 562)
+_EXPORTS = {
+    "create_user": "cosmos_helpers",
+    "get_zone_to_users": "cosmos_helpers",
+    "get_user_emails": "cosmos_helpers",
+    "get_zone_subscribers": "cosmos_helpers",
+    "alert_check": "cosmos_helpers",
+    "alert_check_bulk": "cosmos_helpers",
+    "release_alert_checks": "cosmos_helpers",
+    "get_alert_snapshot": "cosmos_helpers",
+    "save_alert_snapshot": "cosmos_helpers",
+    "record_email_operation": "cosmos_helpers",
+    "get_pending_email_operations": "cosmos_helpers",
+    "update_email_operation": "cosmos_helpers",
+    "get_active_alerts": "nws_client",
+    "send_messages_to_queue": "service_bus_sender",
+    "run_on_worker_loop": "service_bus_sender",
+    "format_email": "email_sender",
+    "send_email_via_acs": "email_sender",
+    "get_email_send_status": "email_sender",
+}
+
+__all__ = list(_EXPORTS)
+
+
+def __getattr__(name):
+
+    if name not in _EXPORTS:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    value = getattr(importlib.import_module(f".{_EXPORTS[name]}", __name__), name)
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+
+    return sorted(set(globals()) | set(_EXPORTS))
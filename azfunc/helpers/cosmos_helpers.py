@@ -1,30 +1,121 @@
+import json
 import logging
 import os
+import sys
+import threading
+import time
 import uuid
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timezone
+from azure.core import MatchConditions
 from azure.cosmos import CosmosClient, PartitionKey, exceptions
+from .dedup_cache import sent_alert_cache
+from .telemetry import debug_payload, record_request_charge
 
 # Azure secrets and endpoints
 AZURE_ENDPOINT = os.getenv("AZURE_ENDPOINT")
 AZURE_KEY = os.getenv("AZURE_KEY")
 
-# Initialize client and create DB
-client = CosmosClient(AZURE_ENDPOINT, AZURE_KEY)
-database = client.create_database_if_not_exists(id="weather_app_db")
-
-# Set up containers
-users_container = database.create_container_if_not_exists(
-    id="users",
-    partition_key=PartitionKey(path="/id")
-)
-zones_container = database.create_container_if_not_exists(
-    id="zone_subscriptions",
-    partition_key=PartitionKey(path="/id")
-)
-alerts_container = database.create_container_if_not_exists(
-    id="sent_alerts",
-    partition_key=PartitionKey(path="/alert_id")
-)
+COSMOS_DATABASE_ID = "weather_app_db"
+
+# Module attribute -> (container id, partition key path, extra create options), provision_cosmos() creates them all
+CONTAINERS = {
+    "users_container": ("users", "/id", {}),
+    "zones_container": ("zone_subscriptions", "/id", {}),
+    # -1 turns TTL on without a default, each dedup record carries its own ttl
+    "alerts_container": ("sent_alerts", "/alert_id", {"default_ttl": -1}),
+    "state_container": ("poll_state", "/id", {}),
+    # ACS sends submitted without waiting, kept for a week after their last update
+    "email_operations_container": ("email_operations", "/id", {"default_ttl": 7 * 24 * 60 * 60}),
+}
+
+# Client and container proxies are created on first use and kept for the life of the process,
+# so importing this module (and code paths that never touch Cosmos) makes no network calls
+client = None
+database = None
+users_container = None
+zones_container = None
+alerts_container = None
+state_container = None
+email_operations_container = None
+_cosmos_lock = threading.RLock()
+
+# Transactional batches are capped at 100 operations per partition key
+DEDUP_BATCH_SIZE = 100
+DEDUP_MAX_WORKERS = int(os.getenv("DEDUP_MAX_WORKERS", "8"))
+
+# Ids per read_items call and parallel partition reads within one call
+READ_CHUNK_SIZE = int(os.getenv("COSMOS_READ_CHUNK_SIZE", "1000"))
+READ_MAX_CONCURRENCY = int(os.getenv("COSMOS_READ_MAX_CONCURRENCY", "8"))
+# Container name -> RU charge and latency of the last read_by_ids() call
+read_stats = {}
+
+# Zone documents also store [{"id", "email"}] per subscriber so the worker resolves recipients in one read
+ZONE_SUBSCRIBERS_ENABLED = os.getenv("ZONE_SUBSCRIBERS_ENABLED", "false").lower() == "true"
+
+# A new zone can race with another signup creating it, the retry then patches the existing document
+ZONE_SUBSCRIBE_ATTEMPTS = 3
+
+# "per_user" writes one sent_alerts doc per (alert, user), "compact" one doc per alert holding its recipients' user ids.
+# Switch modes between outbreaks, records written in the other mode aren't seen
+SENT_ALERTS_MODE = os.getenv("SENT_ALERTS_MODE", "per_user")
+# User ids per compact doc, well under the 2 MB item size. Bigger alerts spill over into "{alert_id}~1", "~2"... pages
+SENT_ALERT_COMPACT_PAGE_SIZE = int(os.getenv("SENT_ALERT_COMPACT_PAGE_SIZE", "20000"))
+# Dedup records are kept until the alert expires plus this grace window, alerts without an expiry use the default
+SENT_ALERT_TTL_GRACE = int(os.getenv("SENT_ALERT_TTL_GRACE_SECONDS", str(2 * 24 * 60 * 60)))
+SENT_ALERT_DEFAULT_TTL = int(os.getenv("SENT_ALERT_DEFAULT_TTL_SECONDS", str(14 * 24 * 60 * 60)))
+# Compact records are rewritten with if_match, concurrent writers retry this many times
+SENT_ALERT_WRITE_ATTEMPTS = 5
+
+# Id of the poll_state document holding the alerts seen on the previous tick
+ALERT_SNAPSHOT_ID = "active_alerts_snapshot"
+
+
+# Thread-safe, the client is only built once even when the dedup workers race for it
+def get_database():
+
+    global client, database
+    if database is None:
+        with _cosmos_lock:
+            if database is None:
+                client = CosmosClient(AZURE_ENDPOINT, AZURE_KEY)
+                database = client.get_database_client(COSMOS_DATABASE_ID)
+    return database
+
+
+# name is a key of CONTAINERS, the proxy is cached in the module attribute of the same name
+def get_container(name):
+
+    container = globals()[name]
+    if container is None:
+        with _cosmos_lock:
+            container = globals()[name]
+            if container is None:
+                container = get_database().get_container_client(CONTAINERS[name][0])
+                globals()[name] = container
+    return container
+
+
+# One-time setup: create the database and containers. Run with `python -m helpers.cosmos_helpers` from azfunc/
+# (`python -m helpers.cosmos_helpers backfill-subscribers` runs backfill_zone_subscribers() instead)
+def provision_cosmos():
+
+    provisioning_client = CosmosClient(AZURE_ENDPOINT, AZURE_KEY)
+    provisioned_database = provisioning_client.create_database_if_not_exists(id=COSMOS_DATABASE_ID)
+    for container_id, partition_key_path, options in CONTAINERS.values():
+        container = provisioned_database.create_container_if_not_exists(
+            id=container_id,
+            partition_key=PartitionKey(path=partition_key_path),
+            **options
+        )
+        # create_container_if_not_exists leaves an existing container's settings alone
+        if "default_ttl" in options and container.read().get("defaultTtl") != options["default_ttl"]:
+            provisioned_database.replace_container(
+                container,
+                partition_key=PartitionKey(path=partition_key_path),
+                default_ttl=options["default_ttl"]
+            )
+        logging.info(f"Container ready: {container_id}")
 
 
 # Create new user in the Cosmos DB container
@@ -39,60 +130,178 @@ def create_user(first_name, email, lat, lng, zone_ids):
         "zone_ids": zone_ids,
         "registered_at": datetime.now(timezone.utc).isoformat()
     }
-    users_container.create_item(body=new_user)
+    get_container("users_container").create_item(body=new_user)
 
     for zone_id in new_user["zone_ids"]:
-        update_zone_subscriptions(zone_id, new_user["id"])
+        update_zone_subscriptions(zone_id, new_user["id"], new_user["email"])
 
 
-def update_zone_subscriptions(zone_id, user_id):
+"""
+Add user_id to the zone's subscriber list with a server-side patch instead of read-modify-replace.
+The filter predicate makes the append conditional on the user not being listed yet, so concurrent signups
+can't drop each other's writes and the client never downloads or re-uploads the growing document.
+With ZONE_SUBSCRIBERS_ENABLED the same patch also appends {"id", "email"} to the zone's subscribers.
+A zone created before the flag was turned on and not backfilled has no subscribers array to append to (Cosmos
+answers 400), that one gets an array holding just this subscriber and the backfill adds the others.
+"""
+def update_zone_subscriptions(zone_id, user_id, email=None):
 
-    try:
-        zone_data = zones_container.read_item(item=zone_id, partition_key=zone_id)
-        if user_id not in zone_data["user_ids"]:
-            zone_data["user_ids"].append(user_id)
-            zones_container.replace_item(item=zone_id, body=zone_data)
-    except exceptions.CosmosResourceNotFoundError:
-        zones_container.create_item({
-            "id": zone_id,
-            "user_ids": [user_id]
-        })
+    user_predicate = f"FROM c WHERE NOT ARRAY_CONTAINS(c.user_ids, {json.dumps(user_id)})"
+    patch_operations = [{"op": "add", "path": "/user_ids/-", "value": user_id}]
+    # New zones always carry the array, so turning the flag on later doesn't depend on a backfill
+    new_zone = {"id": zone_id, "user_ids": [user_id], "subscribers": []}
+    if ZONE_SUBSCRIBERS_ENABLED:
+        subscriber = {"id": user_id, "email": email}
+        patch_operations.append({"op": "add", "path": "/subscribers/-", "value": subscriber})
+        new_zone["subscribers"] = [subscriber]
+
+    zones_container = get_container("zones_container")
+    subscribers_missing = False
+    for _ in range(ZONE_SUBSCRIBE_ATTEMPTS):
+        operations, predicate = patch_operations, user_predicate
+        if subscribers_missing:
+            # Only while the array is still missing, so a backfill that lands in between isn't overwritten
+            operations = patch_operations[:1] + [{"op": "set", "path": "/subscribers", "value": [subscriber]}]
+            predicate += " AND NOT IS_DEFINED(c.subscribers)"
+        try:
+            zones_container.patch_item(
+                item=zone_id,
+                partition_key=zone_id,
+                patch_operations=operations,
+                filter_predicate=predicate
+            )
+            return
+        except exceptions.CosmosAccessConditionFailedError:
+            if not subscribers_missing:
+                return  # predicate failed: already subscribed
+            subscribers_missing = False  # subscribed or backfilled in the meantime, the append decides which
+            continue
+        except exceptions.CosmosResourceNotFoundError:
+            pass
+        except exceptions.CosmosHttpResponseError as e:
+            if e.status_code != 400 or not ZONE_SUBSCRIBERS_ENABLED or subscribers_missing:
+                raise
+            subscribers_missing = True
+            continue
+
+        try:
+            zones_container.create_item(new_zone)
+            return
+        except exceptions.CosmosResourceExistsError:
+            continue  # another signup created the zone first, patch it instead
+    raise RuntimeError(f"Could not subscribe user {user_id} to zone {zone_id}")
 
 
-# Query only the zone_id that are present in the NWS alerts to get a list of users and the zone ids that they are in
+# Only the zone ids present in the NWS alerts are read, zones without subscribers are dropped
 def get_zone_to_users(affected_zone_ids):
 
-    query = """
-        SELECT c.id, c.user_ids 
-        FROM c 
-        WHERE ARRAY_LENGTH(c.user_ids) > 0 
-        AND ARRAY_CONTAINS(@affected_zone_ids, c.id)
-    """
-    params = [{"name": "@affected_zone_ids", "value": affected_zone_ids}]
-    results = zones_container.query_items(
-        query=query,
-        parameters=params,
-        enable_cross_partition_query=True
-    )
-    test = {i["id"]: i["user_ids"] for i in results}
-    logging.info(f"Here's the list: {test}")
-    return test
+    zones = read_by_ids("zones_container", affected_zone_ids)
+    zone_to_users = {zone["id"]: zone["user_ids"] for zone in zones if zone.get("user_ids")}
+    debug_payload("Zone subscriptions", lambda: zone_to_users)
+    return zone_to_users
 
 
-# Batch query users to get emails
 def get_user_emails(all_user_ids):
 
-    query = "SELECT c.id, c.email FROM c WHERE ARRAY_CONTAINS(@ids, c.id)"
-    params = [{"name": "@ids", "value": list(all_user_ids)}]
-    results = users_container.query_items(query=query, parameters=params, enable_cross_partition_query=True)
-    return {user["id"]: user["email"] for user in results}
+    users = read_by_ids("users_container", all_user_ids)
+    return {user["id"]: user["email"] for user in users}
 
 
-def alert_check(alert_details):
+"""
+One read for the denormalized schema: returns (zone_to_users, user_emails) like get_zone_to_users() plus get_user_emails().
+user_ids stays the source of truth, subscribers missing from a zone that wasn't backfilled yet are looked up in users.
+"""
+def get_zone_subscribers(affected_zone_ids):
+
+    zone_to_users, user_emails = {}, {}
+    for zone in read_by_ids("zones_container", affected_zone_ids):
+        if not zone.get("user_ids"):
+            continue
+        zone_to_users[zone["id"]] = zone["user_ids"]
+        for subscriber in zone.get("subscribers") or []:
+            user_emails[subscriber["id"]] = subscriber["email"]
+
+    missing = {user_id for user_ids in zone_to_users.values() for user_id in user_ids} - set(user_emails)
+    if missing:
+        logging.warning(f"{len(missing)} subscribers have no email on their zone document, run the subscribers backfill")
+        user_emails.update(get_user_emails(missing))
+    return zone_to_users, user_emails
+
+
+"""
+Migration to the denormalized schema: give every zone document a subscribers array matching its user_ids.
+Each zone is replaced with if_match on its ETag and re-read on conflict, so it's safe to run while users sign up.
+Run it when setting ZONE_SUBSCRIBERS_ENABLED: zones it hasn't reached yet only list the users who signed up since.
+Returns the number of zone documents updated.
+"""
+def backfill_zone_subscribers():
+
+    zones_container = get_container("zones_container")
+    updated = 0
+    for zone in zones_container.query_items(query="SELECT * FROM c", enable_cross_partition_query=True):
+        if _backfill_zone(zones_container, zone):
+            updated += 1
+    return updated
 
-    doc_id = f"{alert_details["alert_id"]}-{alert_details["user_id"]}"
-    alerts_container.create_item(body={
-        "id": doc_id,
+
+def _backfill_zone(zones_container, zone):
+
+    for _ in range(ZONE_SUBSCRIBE_ATTEMPTS):
+        subscribers = zone.get("subscribers")
+        known = {subscriber["id"] for subscriber in subscribers or []}
+        missing = [user_id for user_id in zone.get("user_ids", []) if user_id not in known]
+        emails = get_user_emails(missing) if missing else {}
+        new_subscribers = [{"id": user_id, "email": emails[user_id]} for user_id in missing if user_id in emails]
+        if subscribers is not None and not new_subscribers:
+            return False
+
+        zone["subscribers"] = (subscribers or []) + new_subscribers
+        try:
+            zones_container.replace_item(item=zone["id"], body=zone, etag=zone["_etag"],
+                                         match_condition=MatchConditions.IfNotModified)
+            return True
+        except exceptions.CosmosAccessConditionFailedError:
+            zone = zones_container.read_item(item=zone["id"], partition_key=zone["id"])
+    raise RuntimeError(f"Zone {zone['id']} kept changing during the subscribers backfill")
+
+
+"""
+Point-read documents by id from a container partitioned by /id, READ_CHUNK_SIZE ids per read_items call.
+The SDK groups each chunk by physical partition and reads them in parallel, which costs far fewer RUs than
+one cross-partition ARRAY_CONTAINS query over the whole id list. RU charge and latency are logged and kept in read_stats.
+"""
+def read_by_ids(container_name, ids):
+
+    ids = list(dict.fromkeys(ids))
+    if not ids:
+        return []
+
+    container = get_container(container_name)
+    docs, request_charge = [], 0.0
+    started = time.perf_counter()
+    for start in range(0, len(ids), READ_CHUNK_SIZE):
+        chunk = ids[start:start + READ_CHUNK_SIZE]
+        results = container.read_items(items=[(doc_id, doc_id) for doc_id in chunk], max_concurrency=READ_MAX_CONCURRENCY)
+        request_charge += float(results.get_response_headers().get("x-ms-request-charge") or 0)
+        docs.extend(results)
+    elapsed_ms = (time.perf_counter() - started) * 1000
+    record_request_charge(container_name, request_charge)
+
+    read_stats[container_name] = {"requested": len(ids), "found": len(docs), "request_charge": request_charge,
+                                  "elapsed_ms": elapsed_ms}
+    logging.info(f"Read {len(docs)}/{len(ids)} docs from {container_name} in {elapsed_ms:.0f} ms, {request_charge:.2f} RU")
+    return docs
+
+
+def sent_alert_id(alert_details):
+
+    return f"{alert_details["alert_id"]}-{alert_details["user_id"]}"
+
+
+def sent_alert_doc(alert_details):
+
+    return {
+        "id": sent_alert_id(alert_details),
         "alert_id": alert_details["alert_id"],
         "user_id": alert_details["user_id"],
         "email": alert_details["email"],
@@ -100,5 +309,312 @@ def alert_check(alert_details):
         "sent_at": alert_details["sent_at"],
         "zone_id": alert_details["zone_id"],
         "event": alert_details["event"],
-        "link": alert_details["link"]
-    })
\ No newline at end of file
+        "link": alert_details["link"],
+        "ttl": sent_alert_ttl(alert_details)
+    }
+
+
+# Seconds until the dedup record can go: the later of the alert's expires/ends time plus the grace window
+def sent_alert_ttl(alert_details, now=None):
+
+    end_times = []
+    for field in ("expires_at", "ends_at"):
+        try:
+            end_times.append(datetime.fromisoformat(alert_details[field]))
+        except (KeyError, TypeError, ValueError):
+            continue
+    if not end_times:
+        return SENT_ALERT_DEFAULT_TTL
+
+    remaining = (max(end_times) - (now or datetime.now(timezone.utc))).total_seconds()
+    return max(0, int(remaining)) + SENT_ALERT_TTL_GRACE
+
+
+# Raises CosmosResourceExistsError if the pair was already recorded, without a round trip when it's cached
+def alert_check(alert_details):
+
+    doc = sent_alert_doc(alert_details)
+    if sent_alert_cache is not None and doc["id"] in sent_alert_cache:
+        raise exceptions.CosmosResourceExistsError(message=f"{doc["id"]} already recorded (cached)")
+    if SENT_ALERTS_MODE == "compact":
+        _, existing = _compact_alert_check([alert_details])
+        remember_sent_alerts([doc["id"]])
+        if existing:
+            raise exceptions.CosmosResourceExistsError(message=f"{doc["id"]} already recorded")
+        return
+    try:
+        get_container("alerts_container").create_item(body=doc)
+    except exceptions.CosmosResourceExistsError:
+        remember_sent_alerts([doc["id"]])
+        raise
+    remember_sent_alerts([doc["id"]])
+
+
+def remember_sent_alerts(doc_ids):
+
+    if sent_alert_cache is not None:
+        for doc_id in doc_ids:
+            sent_alert_cache.add(doc_id)
+
+
+"""
+Record many (alert, user) pairs at once, one partition (alert_id) per worker thread.
+Returns (created, existing, failed): created pairs are safe to queue, existing ones were already sent,
+and failed holds (alert_details, error) for pairs whose write didn't go through.
+"""
+def alert_check_bulk(alert_details_list):
+
+    created, existing, failed = [], [], []
+    by_alert = {}
+    for alert_details in alert_details_list:
+        # Pairs confirmed on an earlier tick are known duplicates, Cosmos isn't asked again
+        if sent_alert_cache is not None and sent_alert_id(alert_details) in sent_alert_cache:
+            existing.append(alert_details)
+            continue
+        by_alert.setdefault(alert_details["alert_id"], []).append(alert_details)
+
+    if not by_alert:
+        return created, existing, failed
+
+    with ThreadPoolExecutor(max_workers=min(DEDUP_MAX_WORKERS, len(by_alert))) as executor:
+        for group_created, group_existing, group_failed in executor.map(_alert_check_group, by_alert.values()):
+            created.extend(group_created)
+            existing.extend(group_existing)
+            failed.extend(group_failed)
+            remember_sent_alerts(sent_alert_id(alert_details) for alert_details in group_created + group_existing)
+    return created, existing, failed
+
+
+# Skip users already recorded for this alert, then create the rest in transactional batches
+def _alert_check_group(alert_details_list):
+
+    alert_id = alert_details_list[0]["alert_id"]
+    if SENT_ALERTS_MODE == "compact":
+        try:
+            return (*_compact_alert_check(alert_details_list), [])
+        except Exception as e:
+            return [], [], [(alert_details, e) for alert_details in alert_details_list]
+
+    alerts_container = get_container("alerts_container")
+    created, existing, failed = [], [], []
+    try:
+        recorded_user_ids = set(alerts_container.query_items(
+            query="SELECT VALUE c.user_id FROM c WHERE c.alert_id = @alert_id",
+            parameters=[{"name": "@alert_id", "value": alert_id}],
+            partition_key=alert_id
+        ))
+    except Exception as e:
+        return created, existing, [(alert_details, e) for alert_details in alert_details_list]
+
+    pending = []
+    for alert_details in alert_details_list:
+        if alert_details["user_id"] in recorded_user_ids:
+            existing.append(alert_details)
+        else:
+            pending.append(alert_details)
+
+    for start in range(0, len(pending), DEDUP_BATCH_SIZE):
+        chunk = pending[start:start + DEDUP_BATCH_SIZE]
+        try:
+            alerts_container.execute_item_batch(
+                batch_operations=[("create", (sent_alert_doc(alert_details),)) for alert_details in chunk],
+                partition_key=alert_id
+            )
+            created.extend(chunk)
+        except exceptions.CosmosBatchOperationError:
+            # Another writer recorded some of these first, settle each pair on its own
+            for alert_details in chunk:
+                try:
+                    alert_check(alert_details)
+                    created.append(alert_details)
+                except exceptions.CosmosResourceExistsError:
+                    existing.append(alert_details)
+                except Exception as e:
+                    failed.append((alert_details, e))
+        except Exception as e:
+            failed.extend((alert_details, e) for alert_details in chunk)
+    return created, existing, failed
+
+
+def compact_page_id(alert_id, page):
+
+    return alert_id if page == 0 else f"{alert_id}~{page}"
+
+
+# Every page of an alert's compact record, in order. Pages are created one after the other, so the first miss ends it
+def _read_compact_pages(alerts_container, alert_id):
+
+    pages = []
+    while True:
+        try:
+            pages.append(alerts_container.read_item(item=compact_page_id(alert_id, len(pages)), partition_key=alert_id))
+        except exceptions.CosmosResourceNotFoundError:
+            return pages
+
+
+"""
+Compact sent_alerts record: {"id": alert_id, "alert_id", "user_ids": [...], "ttl", ...} holding up to
+SENT_ALERT_COMPACT_PAGE_SIZE recipients, followed by more pages like it when an alert has more.
+Only the last page is appended to (with if_match on its ETag) and a full one is followed by a newly created page,
+so two writers adding the same user always collide on one document. Conflicts re-read every page and try again.
+"""
+def _compact_alert_check(alert_details_list):
+
+    first = alert_details_list[0]
+    alert_id = first["alert_id"]
+    user_ids = list(dict.fromkeys(alert_details["user_id"] for alert_details in alert_details_list))
+    alerts_container = get_container("alerts_container")
+
+    written = set()  # user ids this call recorded, kept across retries
+    for _ in range(SENT_ALERT_WRITE_ATTEMPTS):
+        pages = _read_compact_pages(alerts_container, alert_id)
+        recorded = {user_id for doc in pages for user_id in doc["user_ids"]}
+        new_user_ids = [user_id for user_id in user_ids if user_id not in recorded]
+        try:
+            if pages and new_user_ids and len(pages[-1]["user_ids"]) < SENT_ALERT_COMPACT_PAGE_SIZE:
+                doc = pages[-1]
+                added = new_user_ids[:SENT_ALERT_COMPACT_PAGE_SIZE - len(doc["user_ids"])]
+                doc["user_ids"].extend(added)
+                alerts_container.replace_item(item=doc["id"], body=doc, etag=doc["_etag"],
+                                              match_condition=MatchConditions.IfNotModified)
+                written.update(added)
+                new_user_ids = new_user_ids[len(added):]
+            page = len(pages)
+            for start in range(0, len(new_user_ids), SENT_ALERT_COMPACT_PAGE_SIZE):
+                added = new_user_ids[start:start + SENT_ALERT_COMPACT_PAGE_SIZE]
+                alerts_container.create_item(body={
+                    "id": compact_page_id(alert_id, page),
+                    "alert_id": alert_id,
+                    "user_ids": added,
+                    "created_at": first["created_at"],
+                    "event": first["event"],
+                    "link": first["link"],
+                    "ttl": sent_alert_ttl(first)
+                })
+                written.update(added)
+                page += 1
+        except (exceptions.CosmosAccessConditionFailedError, exceptions.CosmosResourceExistsError):
+            continue  # another writer changed the last page first
+
+        created = [alert_details for alert_details in alert_details_list if alert_details["user_id"] in written]
+        existing = [alert_details for alert_details in alert_details_list if alert_details["user_id"] not in written]
+        return created, existing
+    raise exceptions.CosmosAccessConditionFailedError(message=f"sent_alerts record {alert_id} kept changing")
+
+
+# Delete dedup records for pairs that never made it onto the queue so the next tick picks them up again
+def release_alert_checks(alert_details_list):
+
+    if SENT_ALERTS_MODE == "compact":
+        return _release_compact_alert_checks(alert_details_list)
+
+    not_released = []
+    for alert_details in alert_details_list:
+        doc_id = sent_alert_id(alert_details)
+        if sent_alert_cache is not None:
+            sent_alert_cache.discard(doc_id)
+        try:
+            get_container("alerts_container").delete_item(item=doc_id, partition_key=alert_details["alert_id"])
+        except exceptions.CosmosResourceNotFoundError:
+            continue
+        except exceptions.CosmosHttpResponseError:
+            not_released.append(doc_id)
+    return not_released
+
+
+def _release_compact_alert_checks(alert_details_list):
+
+    by_alert = {}
+    for alert_details in alert_details_list:
+        if sent_alert_cache is not None:
+            sent_alert_cache.discard(sent_alert_id(alert_details))
+        by_alert.setdefault(alert_details["alert_id"], set()).add(alert_details["user_id"])
+
+    alerts_container = get_container("alerts_container")
+    not_released = []
+    for alert_id, user_ids in by_alert.items():
+        try:
+            for doc in _read_compact_pages(alerts_container, alert_id):
+                _remove_from_compact_page(alerts_container, doc, user_ids)
+        except exceptions.CosmosHttpResponseError:
+            not_released.extend(f"{alert_id}-{user_id}" for user_id in sorted(user_ids))
+    return not_released
+
+
+# Drop user ids from one page, re-reading it when another writer changed it first
+def _remove_from_compact_page(alerts_container, doc, user_ids):
+
+    for _ in range(SENT_ALERT_WRITE_ATTEMPTS):
+        kept = [user_id for user_id in doc["user_ids"] if user_id not in user_ids]
+        if len(kept) == len(doc["user_ids"]):
+            return
+        doc["user_ids"] = kept
+        try:
+            alerts_container.replace_item(item=doc["id"], body=doc, etag=doc["_etag"],
+                                          match_condition=MatchConditions.IfNotModified)
+            return
+        except exceptions.CosmosAccessConditionFailedError:
+            doc = alerts_container.read_item(item=doc["id"], partition_key=doc["alert_id"])
+    raise exceptions.CosmosAccessConditionFailedError(message=f"sent_alerts record {doc['id']} kept changing")
+
+
+# Read the {alert_id: sent} map saved by the previous poll and when each alert was last fanned out,
+# or an empty snapshot on the first run
+def get_alert_snapshot():
+
+    try:
+        snapshot = get_container("state_container").read_item(item=ALERT_SNAPSHOT_ID, partition_key=ALERT_SNAPSHOT_ID)
+    except exceptions.CosmosResourceNotFoundError:
+        return {"alerts": {}, "fanned_out_at": {}, "taken_at": None}
+    return {"alerts": snapshot.get("alerts", {}), "fanned_out_at": snapshot.get("fanned_out_at", {}),
+            "taken_at": snapshot.get("taken_at")}
+
+
+def save_alert_snapshot(alerts, fanned_out_at):
+
+    get_container("state_container").upsert_item(body={
+        "id": ALERT_SNAPSHOT_ID,
+        "alerts": alerts,
+        "fanned_out_at": fanned_out_at,
+        "taken_at": datetime.now(timezone.utc).isoformat()
+    })
+
+
+# Track an ACS send submitted without waiting so email_reconciler can check how it ended
+def record_email_operation(operation_id, to_email, alert_id=None):
+
+    get_container("email_operations_container").create_item(body={
+        "id": operation_id,
+        "to": to_email,
+        "alert_id": alert_id,
+        "status": "Running",
+        "submitted_at": datetime.now(timezone.utc).isoformat()
+    })
+
+
+def get_pending_email_operations(max_items=500):
+
+    query = "SELECT TOP @max_items * FROM c WHERE c.status = 'Running' ORDER BY c.submitted_at"
+    params = [{"name": "@max_items", "value": max_items}]
+    return list(get_container("email_operations_container").query_items(query=query, parameters=params, enable_cross_partition_query=True))
+
+
+def update_email_operation(operation_id, status, error=None):
+
+    get_container("email_operations_container").patch_item(
+        item=operation_id,
+        partition_key=operation_id,
+        patch_operations=[
+            {"op": "set", "path": "/status", "value": status},
+            {"op": "set", "path": "/error", "value": error},
+            {"op": "set", "path": "/checked_at", "value": datetime.now(timezone.utc).isoformat()}
+        ]
+    )
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    if sys.argv[1:] == ["backfill-subscribers"]:
+        logging.info(f"Backfilled subscribers on {backfill_zone_subscribers()} zone documents")
+    else:
+        provision_cosmos()
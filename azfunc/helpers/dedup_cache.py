@@ -0,0 +1,128 @@
+import hashlib
+import math
+import os
+import threading
+import time
+from collections import OrderedDict
+
+# "lru" (exact), "bloom" (compact, may skip a new pair on a false positive) or "off"
+DEDUP_CACHE_MODE = os.getenv("DEDUP_CACHE_MODE", "lru")
+DEDUP_CACHE_SIZE = int(os.getenv("DEDUP_CACHE_SIZE", "100000"))
+DEDUP_CACHE_TTL_SECONDS = float(os.getenv("DEDUP_CACHE_TTL_SECONDS", str(6 * 60 * 60)))
+DEDUP_BLOOM_ERROR_RATE = float(os.getenv("DEDUP_BLOOM_ERROR_RATE", "0.0001"))
+
+
+"""
+Bounded LRU of sent_alerts ids ({alert_id}-{user_id}) already confirmed in Cosmos.
+Entries expire ttl seconds after they were added. Safe to share between threads.
+"""
+class SentAlertCache:
+
+    def __init__(self, max_size=DEDUP_CACHE_SIZE, ttl=DEDUP_CACHE_TTL_SECONDS, clock=time.monotonic):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._clock = clock
+        self._entries = OrderedDict()  # doc_id -> expiry
+        self._lock = threading.Lock()
+
+    def __contains__(self, doc_id):
+        with self._lock:
+            expires = self._entries.get(doc_id)
+            if expires is None:
+                return False
+            if expires <= self._clock():
+                del self._entries[doc_id]
+                return False
+            self._entries.move_to_end(doc_id)
+            return True
+
+    def __len__(self):
+        return len(self._entries)
+
+    def add(self, doc_id):
+        if self.max_size <= 0:
+            return
+        with self._lock:
+            self._entries[doc_id] = self._clock() + self.ttl
+            self._entries.move_to_end(doc_id)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def discard(self, doc_id):
+        with self._lock:
+            self._entries.pop(doc_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+"""
+Bloom filter version of SentAlertCache for very large subscriber counts: a fixed bit array instead of one entry per id.
+Two generations are kept and rotated every ttl seconds, so an id is remembered for one to two ttl periods.
+A false positive (rate set by error_rate) makes a new pair look sent, so only use it where that trade-off is acceptable.
+Single ids can't be removed from a Bloom filter, so discard() forgets everything.
+"""
+class BloomSentAlertCache:
+
+    def __init__(self, capacity=DEDUP_CACHE_SIZE, error_rate=DEDUP_BLOOM_ERROR_RATE,
+                 ttl=DEDUP_CACHE_TTL_SECONDS, clock=time.monotonic):
+        self.num_bits = max(8, math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.num_hashes = max(1, round(self.num_bits / capacity * math.log(2)))
+        self.ttl = ttl
+        self._clock = clock
+        self._current = bytearray((self.num_bits + 7) // 8)
+        self._previous = bytearray(len(self._current))
+        self._rotated_at = clock()
+        self._lock = threading.Lock()
+
+    # Double hashing: k bit positions from two 64-bit halves of one digest
+    def _positions(self, doc_id):
+        digest = hashlib.blake2b(doc_id.encode("utf-8"), digest_size=16).digest()
+        first, second = int.from_bytes(digest[:8], "little"), int.from_bytes(digest[8:], "little") | 1
+        return [(first + i * second) % self.num_bits for i in range(self.num_hashes)]
+
+    def _rotate(self):
+        if self._clock() - self._rotated_at >= self.ttl:
+            self._previous = self._current
+            self._current = bytearray(len(self._previous))
+            self._rotated_at = self._clock()
+
+    @staticmethod
+    def _has_all(bits, positions):
+        return all(bits[position >> 3] & (1 << (position & 7)) for position in positions)
+
+    def __contains__(self, doc_id):
+        positions = self._positions(doc_id)
+        with self._lock:
+            self._rotate()
+            return self._has_all(self._current, positions) or self._has_all(self._previous, positions)
+
+    def add(self, doc_id):
+        positions = self._positions(doc_id)
+        with self._lock:
+            self._rotate()
+            for position in positions:
+                self._current[position >> 3] |= 1 << (position & 7)
+
+    def discard(self, doc_id):
+        self.clear()
+
+    def clear(self):
+        with self._lock:
+            self._current = bytearray(len(self._current))
+            self._previous = bytearray(len(self._current))
+            self._rotated_at = self._clock()
+
+
+def build_sent_alert_cache(mode=DEDUP_CACHE_MODE):
+
+    if mode == "off":
+        return None
+    if mode == "bloom":
+        return BloomSentAlertCache()
+    return SentAlertCache()
+
+
+# Lives for the whole worker process, so warm invocations skip pairs confirmed on earlier ticks
+sent_alert_cache = build_sent_alert_cache()
@@ -0,0 +1,248 @@
+import asyncio
+import json
+import logging
+import os
+import time
+import uuid
+from azure.communication.email.aio import EmailClient as AsyncEmailClient
+from azure.core.exceptions import HttpResponseError
+from azure.servicebus.aio import ServiceBusClient, AutoLockRenewer
+from azure.servicebus.exceptions import ServiceBusError
+from .cosmos_helpers import record_email_operation
+from .email_sender import ACS_CONNECTION_STRING, EMAIL_SEND_MODE, format_email, build_acs_message
+from .service_bus_sender import NAMESPACE_CONNECTION_STR, QUEUE_NAME, send_messages_to_queue
+
+# Messages pulled from the queue per receive call
+EMAIL_DISPATCH_BATCH_SIZE = int(os.getenv("EMAIL_DISPATCH_BATCH_SIZE", "100"))
+# ACS sends in flight at once
+EMAIL_DISPATCH_CONCURRENCY = int(os.getenv("EMAIL_DISPATCH_CONCURRENCY", "10"))
+# Token bucket tuned to the ACS email quota of the resource (default matches the standard per-minute limit)
+ACS_EMAILS_PER_MINUTE = float(os.getenv("ACS_EMAILS_PER_MINUTE", "30"))
+ACS_BURST = int(os.getenv("ACS_BURST", "10"))
+ACS_MAX_ATTEMPTS = int(os.getenv("ACS_MAX_ATTEMPTS", "5"))
+# No email is started after this long, so one timer run finishes within the function timeout (5 minutes on consumption)
+EMAIL_DISPATCH_TIME_BUDGET = float(os.getenv("EMAIL_DISPATCH_TIME_BUDGET_SECONDS", "240"))
+
+
+"""
+Async token bucket: rate tokens per second, up to capacity banked for bursts.
+pause() empties the bucket and holds every caller until the given delay has passed, used for Retry-After on 429.
+With a deadline (on the bucket's clock) acquire() returns False instead of waiting for a token that comes after it.
+"""
+class TokenBucket:
+
+    def __init__(self, rate, capacity, clock=time.monotonic):
+        self.rate = rate
+        self.capacity = capacity
+        self._clock = clock
+        self._tokens = float(capacity)
+        self._updated_at = clock()
+        self._paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def _refill(self):
+        now = self._clock()
+        self._tokens = min(self.capacity, self._tokens + max(0.0, now - self._updated_at) * self.rate)
+        self._updated_at = max(now, self._updated_at)
+
+    async def acquire(self, deadline=None):
+        async with self._lock:
+            while True:
+                wait = self._paused_until - self._clock()
+                if wait <= 0:
+                    self._refill()
+                    if self._tokens >= 1:
+                        self._tokens -= 1
+                        return True
+                    wait = (1 - self._tokens) / self.rate
+                if deadline is not None and self._clock() + wait > deadline:
+                    return False
+                await asyncio.sleep(wait)
+
+    # Tokens handed out between now and deadline if every one is taken as soon as it's there
+    def tokens_before(self, deadline):
+        self._refill()
+        start = max(self._clock(), self._paused_until)
+        return int(self._tokens + max(0.0, deadline - start) * self.rate)
+
+    def pause(self, seconds):
+        self._paused_until = max(self._paused_until, self._clock() + seconds)
+        self._tokens = 0.0
+        # Refill starts when the pause ends, so sends resume at the steady rate instead of a burst
+        self._updated_at = self._paused_until
+
+
+# Seconds to wait from a throttled ACS response, falling back to exponential backoff
+def retry_after_seconds(error, attempt):
+
+    headers = getattr(getattr(error, "response", None), "headers", None) or {}
+    if headers.get("retry-after-ms"):
+        return float(headers["retry-after-ms"]) / 1000
+    if headers.get("Retry-After"):
+        try:
+            return float(headers["Retry-After"])
+        except ValueError:
+            pass
+    return min(60.0, 2.0 ** attempt)
+
+
+# Send one email through the rate limiter, retrying 429s. Returns (sent, operation_id), not sent when the deadline
+# comes before the limiter lets it start
+async def send_email_async(email_client, limiter, semaphore, acs_message, deadline=None):
+
+    for attempt in range(ACS_MAX_ATTEMPTS):
+        if not await limiter.acquire(deadline):
+            return False, None
+        async with semaphore:
+            try:
+                if EMAIL_SEND_MODE == "track":
+                    operation_id = str(uuid.uuid4())
+                    await email_client.begin_send(acs_message, operation_id=operation_id, polling=False)
+                    return True, operation_id
+                poller = await email_client.begin_send(acs_message)
+                result = await poller.result()
+                return result.get("status") == "Succeeded", None
+            except HttpResponseError as e:
+                if e.status_code != 429:
+                    logging.error(f"ACS error: {e}")
+                    return False, None
+                delay = retry_after_seconds(e, attempt)
+                logging.warning(f"ACS throttled, pausing sends for {delay}s")
+                limiter.pause(delay)
+            except Exception as e:
+                logging.error(f"Unexpected error: {e}")
+                return False, None
+    return False, None
+
+
+"""
+Send every email in one queue message. Returns True when the message can be completed:
+either everything was sent, or the recipients that failed were re-queued as a new message,
+so recipients that already got the email aren't sent it again on redelivery.
+Recipients not started by the deadline count as failed, they're left for the next run the same way.
+"""
+async def process_message(email_client, limiter, semaphore, body, deadline=None):
+
+    alert_data = json.loads(body)
+    subject, plain_body, html_body = format_email(alert_data)
+    recipients = alert_data.get("recipients") or [{"email": alert_data["email"]}]
+
+    results = await asyncio.gather(*[
+        send_email_async(email_client, limiter, semaphore,
+                         build_acs_message(recipient["email"], subject, plain_body, html_body), deadline)
+        for recipient in recipients
+    ])
+
+    if EMAIL_SEND_MODE == "track":
+        for recipient, (sent, operation_id) in zip(recipients, results):
+            if sent:
+                await asyncio.to_thread(record_email_operation, operation_id, recipient["email"], alert_data.get("alert_id"))
+
+    failed = [recipient for recipient, (sent, _) in zip(recipients, results) if not sent]
+    if not failed:
+        return True
+    if "recipients" not in alert_data or len(failed) == len(recipients):
+        return False
+    requeue_failures = await send_messages_to_queue([{**alert_data, "recipients": failed}])
+    return not requeue_failures
+
+
+# Emails one queue message sends, a body that doesn't parse counts as one (process_message reports it)
+def recipient_count(message):
+
+    try:
+        alert_data = json.loads(str(message))
+        return len(alert_data.get("recipients") or [alert_data["email"]])
+    except (ValueError, KeyError, AttributeError, TypeError):
+        return 1
+
+
+# Messages whose recipients fit in the sends left, in order. The first one is always started: a chunk bigger than
+# what's left sends part of its recipients and re-queues the rest
+def split_by_sends(received, sends_left):
+
+    started, sends = [], 0
+    for position, message in enumerate(received):
+        sends += recipient_count(message)
+        if started and sends > sends_left:
+            return started, received[position:]
+        started.append(message)
+    return started, []
+
+
+"""
+Settle one message: complete on success, abandon for redelivery otherwise. A lost lock (the run took longer than the
+lock renewal) is logged rather than raised so the other messages still get settled. Returns the count to bump.
+"""
+async def settle_message(receiver, message, succeeded):
+
+    try:
+        if succeeded:
+            await receiver.complete_message(message)
+            return "completed"
+        await receiver.abandon_message(message)
+        return "abandoned"
+    except ServiceBusError as e:
+        logging.error(f"Failed to settle queue message {message.message_id}, it will be redelivered: {e}")
+        return "unsettled"
+
+
+"""
+Process received messages concurrently and settle each one. With a deadline, only the messages whose recipients the
+limiter can send before it are started, the others are abandoned untouched for the next run.
+"""
+async def dispatch_messages(receiver, email_client, received, limiter, semaphore, deadline=None):
+
+    started, skipped = received, []
+    if deadline is not None:
+        started, skipped = split_by_sends(received, limiter.tokens_before(deadline))
+
+    async def handle(message):
+        try:
+            return await process_message(email_client, limiter, semaphore, str(message), deadline)
+        except Exception as e:
+            logging.error(f"Failed to process queue message {message.message_id}: {e}")
+            return False
+
+    results = await asyncio.gather(*[handle(message) for message in started])
+    counts = {"completed": 0, "abandoned": 0, "unsettled": 0}
+    for message, succeeded in zip(started + skipped, results + [False] * len(skipped)):
+        counts[await settle_message(receiver, message, succeeded)] += 1
+    return counts
+
+
+"""
+Drain the email queue in batches until it's empty or the time budget runs out.
+Each receive only takes as many messages as the limiter can send emails before the deadline, and the recipients
+in them are counted again before any is started, so a batch never runs past the budget and its locks.
+"""
+async def drain_email_queue(time_budget=EMAIL_DISPATCH_TIME_BUDGET):
+
+    deadline = time.monotonic() + time_budget
+    totals = {"completed": 0, "abandoned": 0, "unsettled": 0}
+    limiter = TokenBucket(rate=ACS_EMAILS_PER_MINUTE / 60, capacity=ACS_BURST)
+    semaphore = asyncio.Semaphore(EMAIL_DISPATCH_CONCURRENCY)
+
+    # SDK retries are off so 429s go through the shared limiter instead of each request backing off alone
+    async with ServiceBusClient.from_connection_string(conn_str=NAMESPACE_CONNECTION_STR) as servicebus_client, \
+            AsyncEmailClient.from_connection_string(ACS_CONNECTION_STRING, retry_total=0) as email_client, \
+            AutoLockRenewer(max_lock_renewal_duration=time_budget + 60) as lock_renewer:
+        # No prefetch: prefetched messages are locked without being renewed, and the last receive is cut to the budget
+        receiver = servicebus_client.get_queue_receiver(
+            queue_name=QUEUE_NAME,
+            auto_lock_renewer=lock_renewer
+        )
+        async with receiver:
+            while True:
+                sends_left = limiter.tokens_before(deadline)
+                if sends_left < 1:
+                    break
+                received = await receiver.receive_messages(
+                    max_message_count=min(EMAIL_DISPATCH_BATCH_SIZE, sends_left), max_wait_time=5)
+                if not received:
+                    break
+                counts = await dispatch_messages(receiver, email_client, received, limiter, semaphore, deadline)
+                totals = {key: totals[key] + counts[key] for key in totals}
+
+    logging.info(f"Email dispatch finished: {totals}")
+    return totals
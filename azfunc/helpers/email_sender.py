@@ -1,13 +1,44 @@
 import os
+import hashlib
+import json
 import logging
+import threading
+import uuid
+from collections import OrderedDict
 from html import escape
 from azure.communication.email import EmailClient
 from azure.core.exceptions import HttpResponseError
+from azure.core.rest import HttpRequest
 
 # ACS secret and sender email
 ACS_CONNECTION_STRING = os.getenv("ACS_CONNECTION_STRING")
 ACS_SENDER_EMAIL = os.getenv("ACS_SENDER_EMAIL")
-email_client = EmailClient.from_connection_string(ACS_CONNECTION_STRING)
+# Built on first send, so importing this module (e.g. just to render emails) doesn't create a client
+email_client = None
+_email_client_lock = threading.Lock()
+
+# "wait" blocks until ACS finishes delivery, "track" only submits and leaves the outcome to email_reconciler
+EMAIL_SEND_MODE = os.getenv("EMAIL_SEND_MODE", "wait")
+ACS_API_VERSION = "2023-03-31"
+ACS_FINAL_STATUSES = {"Succeeded", "Failed", "Canceled"}
+
+# Rendered (subject, plain, html) per alert, so a burst of messages for one alert only escapes and builds it once
+EMAIL_CACHE_SIZE = int(os.getenv("EMAIL_CACHE_SIZE", "256"))
+# Alert fields that end up in the email, recipient fields don't change what gets rendered
+EMAIL_FIELDS = ("event", "headline", "areaDesc", "severity", "certainty", "urgency", "description",
+                "instruction", "response", "senderName", "link")
+_rendered_emails = OrderedDict()  # (alert_id, content hash) -> (subject, plain_body, html_body)
+_rendered_emails_lock = threading.Lock()
+
+
+def get_email_client():
+
+    global email_client
+    if email_client is None:
+        with _email_client_lock:
+            if email_client is None:
+                email_client = EmailClient.from_connection_string(ACS_CONNECTION_STRING)
+    return email_client
 
 
 def format_text_for_html(text: str):
@@ -23,8 +54,32 @@ def format_text_for_html(text: str):
     return text
 
 
+# Hash of the rendered fields, so an updated alert that keeps its id is rendered again
+def email_content_hash(alert: dict):
+
+    content = json.dumps([alert.get(field) for field in EMAIL_FIELDS])
+    return hashlib.blake2b(content.encode("utf-8"), digest_size=16).hexdigest()
+
+
 def format_email(alert: dict):
 
+    key = (alert.get("alert_id"), email_content_hash(alert))
+    with _rendered_emails_lock:
+        rendered = _rendered_emails.get(key)
+        if rendered is not None:
+            _rendered_emails.move_to_end(key)
+            return rendered
+
+    rendered = render_email(alert)
+    with _rendered_emails_lock:
+        _rendered_emails[key] = rendered
+        while len(_rendered_emails) > EMAIL_CACHE_SIZE:
+            _rendered_emails.popitem(last=False)
+    return rendered
+
+
+def render_email(alert: dict):
+
     subject = f"Weather Alert: {alert.get('event') or 'Unknown Event'}"
 
     plain_body = (
@@ -63,9 +118,9 @@ def format_email(alert: dict):
     return subject, plain_body, html_body
 
 
-def send_email_via_acs(to_email: str, subject: str, plain_body: str, html_body: str):
+def build_acs_message(to_email: str, subject: str, plain_body: str, html_body: str):
 
-    message = {
+    return {
         "senderAddress": ACS_SENDER_EMAIL,
         "recipients": {"to": [{"address": to_email}]},
         "content": {
@@ -75,10 +130,35 @@ def send_email_via_acs(to_email: str, subject: str, plain_body: str, html_body:
         }
     }
 
+
+# Returns the ACS operation id when the send was only submitted (track mode), otherwise None
+def send_email_via_acs(to_email: str, subject: str, plain_body: str, html_body: str, wait: bool = None):
+
+    if wait is None:
+        wait = EMAIL_SEND_MODE != "track"
+
+    message = build_acs_message(to_email, subject, plain_body, html_body)
+
     try:
-        poller = email_client.begin_send(message)
+        if not wait:
+            # polling=False returns as soon as ACS accepts the message, no long-running poll
+            operation_id = str(uuid.uuid4())
+            get_email_client().begin_send(message, operation_id=operation_id, polling=False)
+            logging.info(f"ACS email send submitted: {operation_id}")
+            return operation_id
+
+        poller = get_email_client().begin_send(message)
         logging.info(f"ACS email send status: {poller.result()['status']}")
     except HttpResponseError as e:
         logging.error(f"ACS error: {e}")
     except Exception as e:
-        logging.error(f"Unexpected error: {e}")
\ No newline at end of file
+        logging.error(f"Unexpected error: {e}")
+
+
+# One GET against the ACS operation status endpoint: {"id": ..., "status": ..., "error": ...}
+def get_email_send_status(operation_id: str):
+
+    request = HttpRequest("GET", f"/emails/operations/{operation_id}", params={"api-version": ACS_API_VERSION})
+    response = get_email_client().send_request(request)
+    response.raise_for_status()
+    return response.json()
@@ -0,0 +1,57 @@
+import os
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+MY_EMAIL = os.getenv("MY_EMAIL")
+
+# (connect, read) timeouts in seconds for calls to api.weather.gov
+NWS_TIMEOUT = (float(os.getenv("NWS_CONNECT_TIMEOUT", "3.05")), float(os.getenv("NWS_READ_TIMEOUT", "20")))
+NWS_MAX_RETRIES = int(os.getenv("NWS_MAX_RETRIES", "3"))
+NWS_HEADERS = {
+    "User-Agent": f"(KevinWeatherAlertApp, {MY_EMAIL})",
+    "Accept": "application/geo+json",
+    "Accept-Encoding": "gzip, deflate"
+}
+
+# One pooled keep-alive session per process, shared by the alert poller and the zone lookup
+_session = None
+_session_lock = threading.Lock()
+
+
+def build_session():
+
+    retry = Retry(
+        total=NWS_MAX_RETRIES,
+        backoff_factor=0.5,
+        backoff_max=8,
+        status_forcelist=(429, 500, 502, 503, 504),
+        allowed_methods=frozenset({"GET"}),
+        respect_retry_after_header=True,
+        raise_on_status=False   # hand the last response back so raise_for_status() reports it
+    )
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=10, max_retries=retry)
+
+    session = requests.Session()
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    session.headers.update(NWS_HEADERS)
+    return session
+
+
+def get_session():
+
+    global _session
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                _session = build_session()
+    return _session
+
+
+# GET through the shared session with the default timeouts unless the caller overrides them
+def nws_get(url, **kwargs):
+
+    kwargs.setdefault("timeout", NWS_TIMEOUT)
+    return get_session().get(url, **kwargs)
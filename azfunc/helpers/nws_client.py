@@ -1,17 +1,144 @@
-import requests
-import os
+import codecs
+import json
+import re
+from .http_client import nws_get
 
-MY_EMAIL = os.getenv("MY_EMAIL")
+NWS_ALERTS_URL = "https://api.weather.gov/alerts/active"
+STREAM_CHUNK_SIZE = 64 * 1024
 
+# Validators and features from the last full response, kept across warm invocations
+_last_response = {"etag": None, "last_modified": None, "features": None}
 
-def get_active_alerts():
+_json_decoder = json.JSONDecoder()
+_whitespace = re.compile(r"\s*")
+
+
+def get_active_alerts(skip_unchanged=False, stream=False, fields=None):
+
+    headers = {}
+    # Only ask for a 304 when there is something to fall back on (or the caller wants to skip)
+    if skip_unchanged or _last_response["features"] is not None:
+        if _last_response["etag"]:
+            headers["If-None-Match"] = _last_response["etag"]
+        if _last_response["last_modified"]:
+            headers["If-Modified-Since"] = _last_response["last_modified"]
 
-    nws_api_url = "https://api.weather.gov/alerts/active"
-    headers = {
-        "User-Agent": f"(KevinWeatherAlertApp, {MY_EMAIL})",
-        "Accept": "application/geo+json"
-    }
     params = {"status": ["actual"]}
-    response = requests.get(nws_api_url, params=params, headers=headers)
+    response = nws_get(NWS_ALERTS_URL, params=params, headers=headers, stream=stream)
+
+    # Feed hasn't changed since the last poll
+    if response.status_code == 304:
+        if skip_unchanged:
+            return None
+        return _last_response["features"]
+
     response.raise_for_status()
-    return response.json().get("features", [])
\ No newline at end of file
+    validators = {
+        "etag": response.headers.get("ETag"),
+        "last_modified": response.headers.get("Last-Modified")
+    }
+
+    # Streamed feeds are never held in memory, so there is no cached list to fall back on
+    if stream:
+        return _stream_features(response, validators, fields)
+
+    features = response.json().get("features", [])
+    _last_response.update({**validators, "features": features})
+    return features
+
+
+# Yield features as the body arrives, only remembering the validators once the whole feed was read
+def _stream_features(response, validators, fields):
+
+    try:
+        for feature in iter_features(response.iter_content(chunk_size=STREAM_CHUNK_SIZE)):
+            yield project_feature(feature, fields) if fields else feature
+        _last_response.update({**validators, "features": None})
+    finally:
+        response.close()
+
+
+# Keep only the listed properties so geometry and unused fields can be dropped right away
+def project_feature(feature, fields):
+
+    properties = feature.get("properties", {})
+    return {"properties": {field: properties[field] for field in fields if field in properties}}
+
+
+# Parse a GeoJSON FeatureCollection from byte chunks, yielding one feature at a time
+def iter_features(chunks):
+
+    reader = _JsonStreamReader(chunks)
+    reader.expect("{")
+    if reader.peek() == "}":
+        return
+
+    while True:
+        key = reader.decode()
+        reader.expect(":")
+        if key == "features":
+            reader.expect("[")
+            if reader.peek() == "]":
+                reader.next_char()
+            else:
+                while True:
+                    yield reader.decode()
+                    if reader.next_char() == "]":
+                        break
+        else:
+            reader.decode()  # @context, title, updated... aren't needed
+
+        if reader.next_char() == "}":
+            return
+
+
+class _JsonStreamReader:
+
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self._utf8 = codecs.getincrementaldecoder("utf-8")()
+        self._buffer = ""
+        self._pos = 0
+
+    # Append the next chunk, dropping everything already consumed
+    def _fill(self):
+        chunk = next(self._chunks, None)
+        if chunk is None:
+            return False
+        self._buffer = self._buffer[self._pos:] + self._utf8.decode(chunk)
+        self._pos = 0
+        return True
+
+    def peek(self):
+        while True:
+            self._pos = _whitespace.match(self._buffer, self._pos).end()
+            if self._pos < len(self._buffer):
+                return self._buffer[self._pos]
+            if not self._fill():
+                raise ValueError("Unexpected end of NWS alerts feed")
+
+    def next_char(self):
+        char = self.peek()
+        self._pos += 1
+        return char
+
+    def expect(self, char):
+        found = self.next_char()
+        if found != char:
+            raise ValueError(f"Malformed NWS alerts feed: expected '{char}' but found '{found}'")
+
+    # Decode the next complete JSON value, reading more chunks until it fits in the buffer
+    def decode(self):
+        self.peek()
+        while True:
+            try:
+                value, end = _json_decoder.raw_decode(self._buffer, self._pos)
+            except json.JSONDecodeError:
+                if not self._fill():
+                    raise
+                continue
+            # A number at the end of the buffer may continue in the next chunk
+            if end == len(self._buffer) and isinstance(value, (int, float)) and self._fill():
+                continue
+            self._pos = end
+            return value
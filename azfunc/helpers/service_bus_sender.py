@@ -1,23 +1,121 @@
 import asyncio
 import json
 import os
+import threading
+import weakref
 from azure.servicebus.aio import ServiceBusClient
 from azure.servicebus import ServiceBusMessage
+from azure.servicebus.exceptions import MessageSizeExceededError
 
 # Service bus secrets
 NAMESPACE_CONNECTION_STR = os.getenv("NAMESPACE_CONNECTION_STR")
 QUEUE_NAME = os.getenv("QUEUE_NAME")
 
+# Batches in flight at once, keeps big fan-outs from tripping Service Bus throttling
+MAX_CONCURRENT_SENDS = int(os.getenv("SERVICE_BUS_MAX_CONCURRENT_SENDS", "4"))
 
-async def send_messages_to_queue(messages):
+# Client and sender reused across warm invocations, one per event loop they were opened on
+_connections = weakref.WeakKeyDictionary()  # loop -> {"client", "sender"}
+# Event loop of each worker thread: Functions runs sync handlers on a thread pool, and a loop can't be
+# run by a second thread while the first one is still in it (a dispatch_emails drain next to a poll_alerts tick)
+_worker = threading.local()
 
-    async with ServiceBusClient.from_connection_string(
+
+# asyncio.run() closes its loop after every tick, which would orphan the cached sender, so a thread's ticks share one loop
+def run_on_worker_loop(coro):
+
+    loop = getattr(_worker, "loop", None)
+    if loop is None or loop.is_closed():
+        loop = _worker.loop = asyncio.new_event_loop()
+    return loop.run_until_complete(coro)
+
+
+async def get_sender():
+
+    loop = asyncio.get_running_loop()
+    connection = _connections.get(loop)
+    if connection is None:
+        client = ServiceBusClient.from_connection_string(
             conn_str=NAMESPACE_CONNECTION_STR,
             logging_enable=True
-    ) as servicebus_client:
-        sender = servicebus_client.get_queue_sender(queue_name=QUEUE_NAME)
-        async with sender:
-            # Prepare messages as ServiceBusMessage objects
-            sb_messages = [ServiceBusMessage(json.dumps(msg)) for msg in messages]
-            # Send messages all at once
-            await asyncio.gather(*[sender.send_messages(sb_msg) for sb_msg in sb_messages])
+        )
+        connection = _connections[loop] = {"client": client, "sender": client.get_queue_sender(queue_name=QUEUE_NAME)}
+    return connection["sender"]
+
+
+async def close_sender():
+
+    connection = _connections.pop(asyncio.get_running_loop(), None)
+    if connection is None:
+        return
+    await connection["sender"].close()
+    await connection["client"].close()
+
+
+"""
+Pack messages into size-aware ServiceBusMessageBatch objects and send them with bounded concurrency.
+Returns the batches that failed as [{"messages": [...], "error": exception}], an empty list means everything was queued.
+queue_name defaults to QUEUE_NAME, whose sender is cached. Other queues (the shard jobs) get a short-lived sender.
+"""
+async def send_messages_to_queue(messages, queue_name=None):
+
+    if not messages:
+        return []
+
+    if queue_name and queue_name != QUEUE_NAME:
+        client = ServiceBusClient.from_connection_string(conn_str=NAMESPACE_CONNECTION_STR, logging_enable=True)
+        sender = client.get_queue_sender(queue_name=queue_name)
+        try:
+            return await _send_batches(sender, messages)
+        finally:
+            await sender.close()
+            await client.close()
+
+    failures = await _send_batches(await get_sender(), messages)
+
+    # Don't keep a sender around that may be in a bad state
+    if failures:
+        await close_sender()
+    return failures
+
+
+async def _send_batches(sender, messages):
+
+    batches, failures = await _build_batches(sender, messages)
+    semaphore = asyncio.Semaphore(MAX_CONCURRENT_SENDS)
+
+    async def send_batch(batch, batch_messages):
+        async with semaphore:
+            try:
+                await sender.send_messages(batch)
+            except Exception as e:
+                failures.append({"messages": batch_messages, "error": e})
+
+    await asyncio.gather(*[send_batch(batch, batch_messages) for batch, batch_messages in batches])
+    return failures
+
+
+async def _build_batches(sender, messages):
+
+    batches, failures = [], []
+    batch, batch_messages = await sender.create_message_batch(), []
+    for msg in messages:
+        sb_message = ServiceBusMessage(json.dumps(msg))
+        try:
+            batch.add_message(sb_message)
+        except MessageSizeExceededError as e:
+            if not batch_messages:
+                failures.append({"messages": [msg], "error": e})  # too big even on its own
+                continue
+            batches.append((batch, batch_messages))
+            batch, batch_messages = await sender.create_message_batch(), []
+            try:
+                batch.add_message(sb_message)
+            except MessageSizeExceededError as e:
+                failures.append({"messages": [msg], "error": e})
+                continue
+        batch_messages.append(msg)
+
+    if batch_messages:
+        batches.append((batch, batch_messages))
+    return batches, failures
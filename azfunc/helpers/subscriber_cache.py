@@ -0,0 +1,93 @@
+import logging
+import os
+import threading
+import time
+from .cosmos_helpers import get_container, get_user_emails
+
+# Keep zone -> subscribers in memory across warm invocations instead of reading Cosmos every tick
+SUBSCRIBER_CACHE_ENABLED = os.getenv("SUBSCRIBER_CACHE_ENABLED", "false").lower() == "true"
+# Full reload now and then, the change feed (latest version mode) doesn't report deletes
+SUBSCRIBER_CACHE_RELOAD_SECONDS = float(os.getenv("SUBSCRIBER_CACHE_RELOAD_SECONDS", str(6 * 60 * 60)))
+
+
+"""
+Process-level zone -> user ids and user id -> email maps, loaded once with a full read of zone_subscriptions and users
+and then kept current from each container's change feed, resumed from the continuation token of the previous read.
+A tick where nobody signed up costs two empty change feed reads instead of the zone and user queries.
+Safe to share between threads.
+"""
+class SubscriberCache:
+
+    def __init__(self, reload_seconds=SUBSCRIBER_CACHE_RELOAD_SECONDS, clock=time.monotonic):
+        self.reload_seconds = reload_seconds
+        self._clock = clock
+        self._zone_users = {}   # zone_id -> [user_id]
+        self._user_emails = {}  # user_id -> email
+        self._continuations = {}  # container name -> change feed continuation token
+        self._loaded_at = None
+        self._lock = threading.Lock()
+
+    def _read_change_feed(self, container_name, **kwargs):
+        container = get_container(container_name)
+        changes = list(container.query_items_change_feed(**kwargs))
+        # After the feed is drained the etag header holds the token to resume from
+        self._continuations[container_name] = container.client_connection.last_response_headers["etag"]
+        return changes
+
+    def _apply(self, zones, users):
+        for zone in zones:
+            self._zone_users[zone["id"]] = list(zone.get("user_ids") or [])
+        for user in users:
+            self._user_emails[user["id"]] = user.get("email")
+
+    def load(self):
+        with self._lock:
+            # Change feed positions are taken before the full read so nothing written during it is missed,
+            # replaying those changes afterwards is harmless because each one carries the whole document
+            self._read_change_feed("zones_container", start_time="Now")
+            self._read_change_feed("users_container", start_time="Now")
+            zones = get_container("zones_container").query_items(
+                query="SELECT c.id, c.user_ids FROM c", enable_cross_partition_query=True)
+            users = get_container("users_container").query_items(
+                query="SELECT c.id, c.email FROM c", enable_cross_partition_query=True)
+            self._zone_users, self._user_emails = {}, {}
+            self._apply(zones, users)
+            self._loaded_at = self._clock()
+            logging.info(f"Subscriber cache loaded: {len(self._zone_users)} zones, {len(self._user_emails)} users")
+
+    def refresh(self):
+        if self._loaded_at is None or self._clock() - self._loaded_at >= self.reload_seconds:
+            self.load()
+            return
+        with self._lock:
+            zones = self._read_change_feed("zones_container", continuation=self._continuations["zones_container"])
+            users = self._read_change_feed("users_container", continuation=self._continuations["users_container"])
+            self._apply(zones, users)
+            if zones or users:
+                logging.info(f"Subscriber cache applied {len(zones)} zone and {len(users)} user changes")
+
+    # Same (zone_to_users, user_emails) shape as get_zone_subscribers()
+    def resolve(self, affected_zone_ids):
+        self.refresh()
+        with self._lock:
+            zone_to_users = {zone_id: list(self._zone_users[zone_id]) for zone_id in affected_zone_ids
+                             if self._zone_users.get(zone_id)}
+            user_ids = {user_id for user_ids in zone_to_users.values() for user_id in user_ids}
+            user_emails = {user_id: self._user_emails[user_id] for user_id in user_ids if user_id in self._user_emails}
+
+        missing = user_ids - set(user_emails)
+        if missing:
+            found = get_user_emails(missing)
+            user_emails.update(found)
+            with self._lock:
+                self._user_emails.update(found)
+        return zone_to_users, user_emails
+
+    def clear(self):
+        with self._lock:
+            self._zone_users, self._user_emails, self._continuations = {}, {}, {}
+            self._loaded_at = None
+
+
+# Lives for the whole worker process
+subscriber_cache = SubscriberCache()
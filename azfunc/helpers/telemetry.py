@@ -0,0 +1,72 @@
+import logging
+import os
+import random
+import time
+from contextlib import contextmanager
+from opentelemetry import metrics, trace
+
+# Share of ticks whose heavy debug payloads (whole subscriber maps) are logged, and only when DEBUG is enabled
+DEBUG_PAYLOAD_SAMPLE_RATE = float(os.getenv("DEBUG_PAYLOAD_SAMPLE_RATE", "0.01"))
+
+# Spans and metrics go through the OpenTelemetry API: they're no-ops until the host (or run.py) registers a
+# tracer/meter provider, e.g. configure_azure_monitor(), and pick it up as soon as it's set
+tracer = trace.get_tracer("weather_alert.worker")
+meter = metrics.get_meter("weather_alert.worker")
+
+stage_duration = meter.create_histogram(
+    "alert_worker.stage.duration", unit="ms", description="Time spent in one stage of a tick")
+alerts_counter = meter.create_counter(
+    "alert_worker.alerts", unit="{alert}", description="NWS alerts fetched and changed since the previous tick")
+pairs_counter = meter.create_counter(
+    "alert_worker.pairs", unit="{pair}", description="(alert, user) pairs recorded in sent_alerts, by result")
+request_charge_counter = meter.create_counter(
+    "cosmos.request_charge", unit="RU", description="Request units charged for Cosmos reads, by container")
+
+_random = random.Random()
+
+
+"""
+Span plus duration histogram around one stage of a tick (fetch, parse, zone_query, email_lookup, dedup, enqueue).
+Exceptions are recorded on the span and re-raised, the duration is recorded either way.
+"""
+@contextmanager
+def stage(name, **attributes):
+
+    started = time.perf_counter()
+    try:
+        with tracer.start_as_current_span(f"alert_worker.{name}", attributes=attributes) as span:
+            yield span
+    finally:
+        stage_duration.record((time.perf_counter() - started) * 1000, {"stage": name})
+
+
+def record_alerts(fetched, changed):
+
+    alerts_counter.add(fetched, {"kind": "fetched"})
+    alerts_counter.add(changed, {"kind": "changed"})
+
+
+# Results of one alert_check_bulk() call, "existing" pairs are the duplicates
+def record_pairs(created, existing, failed):
+
+    pairs_counter.add(created, {"result": "created"})
+    pairs_counter.add(existing, {"result": "duplicate"})
+    pairs_counter.add(failed, {"result": "failed"})
+
+
+def record_request_charge(container_name, request_charge):
+
+    request_charge_counter.add(request_charge, {"container": container_name})
+
+
+"""
+Log a large payload at DEBUG for a sample of the calls. build() makes the payload and is only called when the
+message is actually logged, so production (INFO and up) never formats it.
+"""
+def debug_payload(label, build, sample_rate=None):
+
+    sample_rate = DEBUG_PAYLOAD_SAMPLE_RATE if sample_rate is None else sample_rate
+    if not logging.getLogger().isEnabledFor(logging.DEBUG) or _random.random() >= sample_rate:
+        return False
+    logging.debug(f"{label}: {build()}")
+    return True
@@ -0,0 +1,447 @@
+"""
+Synthetic-load benchmark for the alert fan-out: alert_worker.get_alerts() against generated NWS feeds,
+with the Cosmos, Service Bus and ACS emulators from emulators/ in place of the real services.
+
+    python benchmarks/fanout.py                           # run every scenario and print the report
+    python benchmarks/fanout.py outbreak --runs 5         # one scenario, fastest of 5 ticks
+    python benchmarks/fanout.py --cosmos-latency-ms 5     # slower services (also --nws, --servicebus, --acs)
+    python benchmarks/fanout.py --cosmos-ru-per-second 4000 --acs-emails-per-minute 6000   # throttled services
+    python benchmarks/fanout.py --save                    # store the results as the baseline
+    python benchmarks/fanout.py --compare                 # check against the baseline
+
+A comparison exits non-zero when a timing or peak memory is over the baseline by more than --tolerance,
+when a service is called more often or charged more RUs, or when the tick queues a different number of messages.
+Timings depend on the machine, save the baseline on the machine that runs the comparisons.
+"""
+import argparse
+import itertools
+import json
+import logging
+import math
+import os
+import random
+import sys
+import time
+import tracemalloc
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+AZFUNC_DIR = os.path.join(REPO_ROOT, "azfunc")
+BASELINE_PATH = os.path.join(REPO_ROOT, "benchmarks", "baselines", "fanout.json")
+
+sys.path.insert(0, AZFUNC_DIR)
+sys.path.insert(0, REPO_ROOT)
+os.environ.setdefault("NAMESPACE_CONNECTION_STR", "Endpoint=sb://localhost/;SharedAccessKeyName=bench;SharedAccessKey=a2V5")
+os.environ.setdefault("QUEUE_NAME", "alerts")
+
+import alert_worker  # noqa: E402
+from emulators import CosmosEmulator, ServiceBusEmulator, EmailEmulator  # noqa: E402
+from helpers import cosmos_helpers, nws_client, service_bus_sender, email_dispatcher  # noqa: E402
+from helpers.dedup_cache import sent_alert_cache  # noqa: E402
+
+# name -> feed and subscriber shape. zones_per_alert is a log-normal (median, sigma) of UGC codes per alert,
+# zone_skew concentrates users in populous zones (Zipf exponent), duplicate_ratio is the share of alerts
+# whose pairs are already in sent_alerts (a tick after a lost snapshot)
+SCENARIOS = {
+    "quiet": {"alerts": 25, "zones": 1500, "users": 2000, "zones_per_alert": (3, 0.8),
+              "zones_per_user": 2, "zone_skew": 0.8, "duplicate_ratio": 0.0},
+    "typical": {"alerts": 150, "zones": 3000, "users": 20000, "zones_per_alert": (5, 0.9),
+                "zones_per_user": 2, "zone_skew": 0.9, "duplicate_ratio": 0.2},
+    "outbreak": {"alerts": 500, "zones": 3500, "users": 25000, "zones_per_alert": (8, 1.0),
+                 "zones_per_user": 2, "zone_skew": 0.9, "duplicate_ratio": 0.1},
+}
+
+# Stage -> alert_worker function timed for it. The streamed feed is read while it's diffed, so "parse" is the download too
+STAGES = {
+    "fetch": "get_active_alerts",
+    "snapshot_load": "load_previous_alerts",
+    "parse": "diff_alerts",
+    "zone_query": "resolve_subscribers",
+    "index": "build_alert_index",
+    "email_lookup": "get_user_emails",
+    "pending": "build_pending_checks",
+    "dedup": "alert_check_bulk",
+    "messages": "build_messages",
+    "enqueue": "run_on_worker_loop",
+    "release": "release_unqueued",
+    "snapshot_save": "store_alert_snapshot",
+}
+
+EVENTS = ("Flood Warning", "Flash Flood Warning", "Severe Thunderstorm Warning", "Tornado Warning",
+          "Winter Storm Warning", "Heat Advisory", "Wind Advisory", "Special Weather Statement")
+STATES = ("AL", "AR", "FL", "GA", "IA", "IL", "IN", "KS", "KY", "LA", "MO", "MS", "NE", "OH", "OK", "TN", "TX")
+
+# Service latencies and limits for this invocation, set from the command line and stored with a baseline
+settings = {"nws_latency_ms": 0.0, "cosmos_latency_ms": 0.0, "servicebus_latency_ms": 0.0, "acs_latency_ms": 0.0,
+            "cosmos_ru_per_second": None, "acs_emails_per_minute": None}
+# Request counts and stage timings, reset for every run
+calls = Counter()
+stage_times = Counter()
+
+
+#================================= Synthetic data =================================
+
+def zone_ids(count):
+
+    return [f"{STATES[i % len(STATES)]}Z{i // len(STATES) + 1:03d}" for i in range(count)]
+
+
+# One NWS alert feature with the fields and body sizes the real feed has, geometry included
+def build_feature(rng, index, ugc, now):
+
+    sent = now - timedelta(minutes=rng.randrange(120))
+    event = rng.choice(EVENTS)
+    lng, lat = rng.uniform(-104, -80), rng.uniform(29, 43)
+    ring = [[round(lng + 0.4 * math.cos(a / 8 * math.pi), 4), round(lat + 0.3 * math.sin(a / 8 * math.pi), 4)]
+            for a in range(16)]
+    return {
+        "id": f"https://api.weather.gov/alerts/urn:oid:2.49.0.1.840.0.{index:040x}.001.1",
+        "type": "Feature",
+        "geometry": {"type": "Polygon", "coordinates": [ring + ring[:1]]},
+        "properties": {
+            "@id": f"https://api.weather.gov/alerts/urn:oid:2.49.0.1.840.0.{index:040x}.001.1",
+            "@type": "wx:Alert",
+            "id": f"urn:oid:2.49.0.1.840.0.{index:040x}.001.1",
+            "areaDesc": "; ".join(f"{zone_id} County" for zone_id in ugc),
+            "geocode": {"SAME": [f"0{rng.randrange(10000, 99999)}" for _ in ugc], "UGC": ugc},
+            "affectedZones": [f"https://api.weather.gov/zones/forecast/{zone_id}" for zone_id in ugc],
+            "references": [],
+            "sent": sent.isoformat(),
+            "effective": sent.isoformat(),
+            "onset": sent.isoformat(),
+            "expires": (sent + timedelta(hours=6)).isoformat(),
+            "ends": (sent + timedelta(hours=12)).isoformat(),
+            "status": "Actual",
+            "messageType": "Alert",
+            "category": "Met",
+            "severity": rng.choice(("Minor", "Moderate", "Severe", "Extreme")),
+            "certainty": rng.choice(("Possible", "Likely", "Observed")),
+            "urgency": rng.choice(("Expected", "Immediate")),
+            "event": event,
+            "sender": "w-nws.webmaster@noaa.gov",
+            "senderName": f"NWS {rng.choice(STATES)} Office",
+            "headline": f"{event} issued {sent:%B %d at %I:%M%p} until {sent + timedelta(hours=6):%I:%M%p}",
+            "description": ("* WHAT...Conditions described by the forecast office. " * rng.randrange(8, 30)).strip(),
+            "instruction": ("Move to higher ground and monitor local media. " * rng.randrange(2, 8)).strip(),
+            "response": "Execute",
+            "parameters": {"AWIPSidentifier": ["FLWXXX"], "WMOidentifier": ["WGUS44 KXXX 000000"],
+                           "NWSheadline": [event.upper()], "BLOCKCHANNEL": ["EAS", "NWEM", "CMAS"]},
+            "web": "http://www.weather.gov"
+        }
+    }
+
+
+# /alerts/active body as bytes, alerts cover runs of neighbouring zones like a real outbreak track
+def build_feed(scenario, all_zone_ids, rng, now):
+
+    median, sigma = scenario["zones_per_alert"]
+    features = []
+    for index in range(scenario["alerts"]):
+        count = max(1, min(len(all_zone_ids), round(rng.lognormvariate(math.log(median), sigma))))
+        start = rng.randrange(len(all_zone_ids))
+        ugc = [all_zone_ids[(start + offset) % len(all_zone_ids)] for offset in range(count)]
+        features.append(build_feature(rng, index, ugc, now))
+    return json.dumps({
+        "@context": ["https://geojson.org/geojson-ld/geojson-context.jsonld", {"@version": "1.1"}],
+        "type": "FeatureCollection",
+        "features": features,
+        "title": "Current watches, warnings, and advisories",
+        "updated": now.isoformat()
+    }).encode("utf-8")
+
+
+# zone_subscriptions and users documents, each user subscribed to a few zones picked by population
+def build_subscribers(scenario, all_zone_ids, rng):
+
+    cum_weights = list(itertools.accumulate(1 / (rank + 1) ** scenario["zone_skew"] for rank in range(len(all_zone_ids))))
+    ranked = all_zone_ids[:]
+    rng.shuffle(ranked)
+    zone_users, users = {}, []
+    for index in range(scenario["users"]):
+        user_id = f"user-{index:07d}"
+        users.append({"id": user_id, "email": f"{user_id}@example.com", "first_name": "Bench"})
+        for zone_id in set(rng.choices(ranked, cum_weights=cum_weights, k=rng.randint(1, scenario["zones_per_user"]))):
+            zone_users.setdefault(zone_id, []).append(user_id)
+
+    zones = []
+    for zone_id, user_ids in zone_users.items():
+        zone = {"id": zone_id, "user_ids": user_ids}
+        if cosmos_helpers.ZONE_SUBSCRIBERS_ENABLED:
+            zone["subscribers"] = [{"id": user_id, "email": f"{user_id}@example.com"} for user_id in user_ids]
+        zones.append(zone)
+    return zones, users
+
+
+# sent_alerts docs for every pair of the first duplicate_ratio of alerts, in the configured storage mode
+def build_sent_alerts(scenario, feed, zones):
+
+    features = json.loads(feed)["features"]
+    zone_users = {zone["id"]: zone["user_ids"] for zone in zones}
+    docs = []
+    for feature in features[:round(len(features) * scenario["duplicate_ratio"])]:
+        alert_id = feature["properties"]["id"]
+        user_ids = list(dict.fromkeys(user_id for zone_id in feature["properties"]["geocode"]["UGC"]
+                                      for user_id in zone_users.get(zone_id, [])))
+        if cosmos_helpers.SENT_ALERTS_MODE == "compact":
+            docs.append({"id": alert_id, "alert_id": alert_id, "user_ids": user_ids})
+        else:
+            docs.extend({"id": f"{alert_id}-{user_id}", "alert_id": alert_id, "user_id": user_id} for user_id in user_ids)
+    return docs
+
+
+#================================= Stand-ins =================================
+
+# NWS isn't one of the emulators, the feed is served from memory with the same per-call latency knob
+def simulate_nws(operation):
+
+    calls[f"nws.{operation}"] += 1
+    if settings["nws_latency_ms"]:
+        time.sleep(settings["nws_latency_ms"] / 1000)
+
+
+# What requests hands back for a streamed /alerts/active call
+class FakeNwsResponse:
+
+    status_code = 200
+
+    def __init__(self, body):
+        self.headers = {"ETag": '"bench"', "Last-Modified": "Mon, 01 Jan 2024 00:00:00 GMT"}
+        self._body = body
+
+    def raise_for_status(self):
+        pass
+
+    def iter_content(self, chunk_size):
+        for start in range(0, len(self._body), chunk_size):
+            simulate_nws("chunk")
+            yield self._body[start:start + chunk_size]
+
+    def close(self):
+        pass
+
+
+#================================= Harness =================================
+
+def timed(stage, function):
+
+    def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            stage_times[stage] += time.perf_counter() - started
+    return wrapper
+
+
+# alert_worker functions before they were wrapped, so installing again for the next scenario doesn't nest timers
+_originals = {}
+
+
+def install_stand_ins(feed):
+
+    def nws_get(url, **kwargs):
+        simulate_nws("get")
+        return FakeNwsResponse(feed)
+
+    nws_client.nws_get = nws_get
+    for stage, name in STAGES.items():
+        setattr(alert_worker, name, timed(stage, _originals.setdefault(name, getattr(alert_worker, name))))
+
+    # The dispatcher's own limiter is set just under the emulated ACS quota, like it should be in production,
+    # so timer jitter doesn't turn into 429s. Without a quota it stays out of the way
+    email_dispatcher.ACS_EMAILS_PER_MINUTE = (settings["acs_emails_per_minute"] or 1e9) * 0.95
+    email_dispatcher.ACS_BURST = 10 if settings["acs_emails_per_minute"] else 1e9
+
+
+"""
+Fresh emulators, caches and counters so every run starts from the same state.
+Cosmos is provisioned through provision_cosmos() and seeded without charging RUs, so only the tick's requests count.
+"""
+def reset(zones, users, sent_alerts):
+
+    cosmos = CosmosEmulator(latency=settings["cosmos_latency_ms"] / 1000, ru_per_second=settings["cosmos_ru_per_second"])
+    cosmos_helpers.CosmosClient = cosmos.client
+    for name in ["client", "database", *cosmos_helpers.CONTAINERS]:
+        setattr(cosmos_helpers, name, None)
+    cosmos_helpers.provision_cosmos()
+    for name, docs in (("zones_container", zones), ("users_container", users), ("alerts_container", sent_alerts)):
+        cosmos.container(cosmos_helpers.COSMOS_DATABASE_ID, cosmos_helpers.CONTAINERS[name][0]).load(docs)
+    cosmos.reset_stats()
+    if sent_alert_cache is not None:
+        sent_alert_cache.clear()
+
+    servicebus = ServiceBusEmulator(latency=settings["servicebus_latency_ms"] / 1000)
+    service_bus_sender.ServiceBusClient = email_dispatcher.ServiceBusClient = servicebus
+    service_bus_sender._connections.clear()
+    acs = EmailEmulator(latency=settings["acs_latency_ms"] / 1000, emails_per_minute=settings["acs_emails_per_minute"],
+                        burst=email_dispatcher.ACS_BURST)
+    email_dispatcher.AsyncEmailClient = acs.aio
+
+    nws_client._last_response.update({"etag": None, "last_modified": None, "features": None})
+    alert_worker._tick_state["complete"] = False
+    calls.clear()
+    stage_times.clear()
+    return cosmos, servicebus, acs
+
+
+def run_once(data, emails=True, trace_memory=False):
+
+    cosmos, servicebus, acs = reset(*data)
+    queue = servicebus.queue(service_bus_sender.QUEUE_NAME)
+    if trace_memory:
+        tracemalloc.start()
+    started = time.perf_counter()
+    alert_worker.get_alerts()
+    wall_ms = (time.perf_counter() - started) * 1000
+    peak_mb = tracemalloc.get_traced_memory()[1] / 2 ** 20 if trace_memory else None
+    if trace_memory:
+        tracemalloc.stop()
+
+    result = {
+        "wall_ms": wall_ms,
+        "stages_ms": {stage: stage_times[stage] * 1000 for stage in STAGES},
+        "peak_mb": peak_mb,
+        "queued": queue.depth,
+        "request_charge": cosmos.request_charge,
+        "cosmos_throttled": cosmos.throttled,
+    }
+    if emails:
+        # The real timer function: receive, send through the ACS emulator, complete
+        started = time.perf_counter()
+        service_bus_sender.run_on_worker_loop(email_dispatcher.drain_email_queue(time_budget=3600))
+        result["email_ms"] = (time.perf_counter() - started) * 1000
+        result["acs_throttled"] = acs.throttled
+
+    for service, emulator in (("cosmos", cosmos), ("servicebus", servicebus), ("acs", acs)):
+        calls.update({f"{service}.{operation}": count for operation, count in emulator.calls.items()})
+    result["calls"] = dict(sorted(calls.items()))
+    return result
+
+
+# Fastest of the timed runs, plus peak memory from one extra traced run so tracing doesn't skew the timings
+def run_scenario(name, runs, seed, emails):
+
+    scenario = SCENARIOS[name]
+    rng = random.Random(seed)
+    all_zone_ids = zone_ids(scenario["zones"])
+    feed = build_feed(scenario, all_zone_ids, rng, datetime.now(timezone.utc))
+    zones, users = build_subscribers(scenario, all_zone_ids, rng)
+    data = (zones, users, build_sent_alerts(scenario, feed, zones))
+    install_stand_ins(feed)
+
+    results = [run_once(data, emails) for _ in range(runs)]
+    best = min(results, key=lambda result: result["wall_ms"])
+    best["stages_ms"] = {stage: min(result["stages_ms"][stage] for result in results) for stage in STAGES}
+    if emails:
+        best["email_ms"] = min(result["email_ms"] for result in results)
+    best["peak_mb"] = run_once(data, emails=False, trace_memory=True)["peak_mb"]
+    best["feed_kb"] = len(feed) / 1024
+    return best
+
+
+def print_report(name, result):
+
+    email_ms = f", email dispatch {result['email_ms']:.1f} ms" if "email_ms" in result else ""
+    print(f"\n{name}: tick {result['wall_ms']:.1f} ms{email_ms}, peak {result['peak_mb']:.1f} MB, "
+          f"feed {result['feed_kb']:.0f} KB, {result['queued']} messages queued, {result['request_charge']:.0f} RU")
+    if result["cosmos_throttled"] or result.get("acs_throttled"):
+        print(f"  throttled: {result['cosmos_throttled']} Cosmos requests, {result.get('acs_throttled', 0)} ACS sends")
+    for stage, elapsed_ms in result["stages_ms"].items():
+        print(f"  {stage:<16}{elapsed_ms:>10.1f} ms")
+    for call, count in result["calls"].items():
+        print(f"  {call:<44}{count:>8}")
+
+
+# Regressions of one scenario against its baseline, as printable lines
+def compare(result, baseline, tolerance, min_delta_ms):
+
+    problems = []
+    timings = [("tick", result["wall_ms"], baseline["wall_ms"])]
+    timings += [(stage, result["stages_ms"].get(stage, 0.0), elapsed_ms) for stage, elapsed_ms in baseline["stages_ms"].items()]
+    if "email_ms" in result and "email_ms" in baseline:
+        timings.append(("email dispatch", result["email_ms"], baseline["email_ms"]))
+    for label, current, previous in timings:
+        if current > previous * (1 + tolerance) and current - previous > min_delta_ms:
+            problems.append(f"{label} {current:.1f} ms vs {previous:.1f} ms")
+
+    if result["peak_mb"] > baseline["peak_mb"] * (1 + tolerance):
+        problems.append(f"peak memory {result['peak_mb']:.1f} MB vs {baseline['peak_mb']:.1f} MB")
+    if result["request_charge"] > baseline.get("request_charge", float("inf")) + 0.01:
+        problems.append(f"charged {result['request_charge']:.1f} RU vs {baseline['request_charge']:.1f}")
+    if result["queued"] != baseline["queued"]:
+        problems.append(f"queued {result['queued']} messages vs {baseline['queued']}")
+    for call, count in result["calls"].items():
+        if count > baseline["calls"].get(call, 0):
+            problems.append(f"{call} called {count} times vs {baseline['calls'].get(call, 0)}")
+    return problems
+
+
+def rounded(value):
+
+    if isinstance(value, dict):
+        return {key: rounded(item) for key, item in value.items()}
+    return round(value, 2) if isinstance(value, float) else value
+
+
+def main(argv=None):
+
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("scenarios", nargs="*", metavar="scenario",
+                        help=f"scenarios to run ({', '.join(SCENARIOS)}), all by default")
+    parser.add_argument("--runs", type=int, default=3, help="ticks per scenario, the fastest one counts")
+    parser.add_argument("--seed", type=int, default=1, help="seed for the generated feed and subscribers")
+    for service in ("nws", "cosmos", "servicebus", "acs"):
+        parser.add_argument(f"--{service}-latency-ms", type=float, default=0.0,
+                            help=f"simulated latency of each {service} call")
+    parser.add_argument("--cosmos-ru-per-second", type=float, help="provisioned throughput, throttles with 429s past it")
+    parser.add_argument("--acs-emails-per-minute", type=float, help="ACS send quota, throttles with 429s past it")
+    parser.add_argument("--no-emails", action="store_true", help="skip delivering the queued messages to ACS")
+    parser.add_argument("--save", action="store_true", help=f"write the results to {os.path.relpath(BASELINE_PATH, REPO_ROOT)}")
+    parser.add_argument("--compare", action="store_true", help="fail on regressions against the baseline")
+    parser.add_argument("--baseline", default=BASELINE_PATH, help="baseline file for --save and --compare")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="allowed slowdown or growth, 0.25 is 25%%")
+    parser.add_argument("--min-delta-ms", type=float, default=5.0, help="ignore slowdowns smaller than this")
+    args = parser.parse_args(argv)
+    unknown = [name for name in args.scenarios if name not in SCENARIOS]
+    if unknown:
+        parser.error(f"unknown scenario {', '.join(unknown)}, choose from {', '.join(SCENARIOS)}")
+
+    # The worker's own info logs would dominate the timings
+    logging.basicConfig(level=logging.WARNING)
+    for name in settings:
+        settings[name] = getattr(args, name)
+    run_settings = {"seed": args.seed, "emails": not args.no_emails, **settings}
+
+    results = {}
+    for name in args.scenarios or SCENARIOS:
+        results[name] = run_scenario(name, args.runs, args.seed, emails=not args.no_emails)
+        print_report(name, results[name])
+
+    if args.save:
+        os.makedirs(os.path.dirname(args.baseline), exist_ok=True)
+        with open(args.baseline, "w", encoding="utf-8") as f:
+            json.dump({"settings": run_settings, "scenarios": rounded(results)}, f, indent=2)
+        print(f"\nSaved baseline to {args.baseline}")
+
+    if not args.compare:
+        return 0
+    with open(args.baseline, encoding="utf-8") as f:
+        baseline = json.load(f)
+    if baseline["settings"] != run_settings:
+        print(f"\nWarning: baseline was saved with different settings: {baseline['settings']}")
+
+    failed = False
+    print()
+    for name, result in results.items():
+        if name not in baseline["scenarios"]:
+            print(f"{name:<10} no baseline")
+            continue
+        problems = compare(result, baseline["scenarios"][name], args.tolerance, args.min_delta_ms)
+        failed = failed or bool(problems)
+        print(f"{name:<10} {'; '.join(problems) or 'ok'}")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,86 @@
+"""
+Cold-start import budget per entry point, measured with `python -X importtime` in a fresh interpreter.
+
+    python benchmarks/import_time.py              # report and check against the budgets
+    python benchmarks/import_time.py --runs 5     # best of 5 runs per entry point
+    python benchmarks/import_time.py --scale 2    # loosen every budget, e.g. on a slow machine
+
+Exits non-zero when an entry point is over budget or loads a module it shouldn't.
+"""
+import argparse
+import os
+import subprocess
+import sys
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+AZFUNC_DIR = os.path.join(REPO_ROOT, "azfunc")
+
+# name -> (working directory, import statement, budget in ms, modules that must not be loaded)
+ENTRY_POINTS = {
+    "function_app (indexing)": (AZFUNC_DIR, "import function_app", 300,
+                                ("azure.cosmos", "azure.servicebus", "azure.communication.email", "requests")),
+    "poll_alerts": (AZFUNC_DIR, "import alert_worker", 800,
+                    ("azure.communication.email",)),
+    "process_shard": (AZFUNC_DIR, "import alert_shards", 800,
+                      ("azure.communication.email",)),
+    "send_emails": (AZFUNC_DIR, "import helpers.email_sender", 400,
+                    ("azure.cosmos", "azure.servicebus")),
+    "reconcile_emails": (AZFUNC_DIR, "import email_reconciler", 600,
+                         ("azure.servicebus",)),
+    "flask app": (REPO_ROOT, "import app.routes", 900,
+                  ("azure.servicebus", "azure.communication.email")),
+}
+
+
+# Total import time in ms (sum of the "self" column) and the set of modules imported
+def measure(cwd, statement):
+
+    code = f"{statement}\nimport sys\nprint('\\n'.join(sys.modules))"
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", code],
+        cwd=cwd, capture_output=True, text=True, env={**os.environ, "PYTHONDONTWRITEBYTECODE": "1"}
+    )
+    if result.returncode != 0:
+        raise RuntimeError(f"{statement!r} failed:\n{result.stderr[-2000:]}")
+
+    total_us = 0
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        total_us += int(line.split(":", 1)[1].split("|")[0])
+    return total_us / 1000, set(result.stdout.split())
+
+
+def loaded_forbidden(modules, forbidden):
+
+    return sorted(name for name in forbidden if any(m == name or m.startswith(name + ".") for m in modules))
+
+
+def main(argv=None):
+
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--runs", type=int, default=3, help="runs per entry point, the fastest one counts")
+    parser.add_argument("--scale", type=float, default=1.0, help="multiply every budget by this factor")
+    args = parser.parse_args(argv)
+
+    failed = False
+    print(f"{'entry point':<26}{'import ms':>10}{'budget ms':>11}  result")
+    for name, (cwd, statement, budget_ms, forbidden) in ENTRY_POINTS.items():
+        runs = [measure(cwd, statement) for _ in range(args.runs)]
+        elapsed_ms = min(ms for ms, _ in runs)
+        unexpected = loaded_forbidden(runs[0][1], forbidden)
+        budget_ms *= args.scale
+
+        problems = []
+        if elapsed_ms > budget_ms:
+            problems.append("over budget")
+        if unexpected:
+            problems.append(f"loads {', '.join(unexpected)}")
+        failed = failed or bool(problems)
+        print(f"{name:<26}{elapsed_ms:>10.1f}{budget_ms:>11.0f}  {'; '.join(problems) or 'ok'}")
+
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,8 @@
+# Local stand-ins for Cosmos DB, Service Bus and ACS email with latency, throttling and conflict semantics,
+# for load-testing the poll -> queue -> email path on one machine. Not deployed.
+from .base import Latency, RateLimit
+from .cosmos import CosmosEmulator
+from .servicebus import ServiceBusEmulator
+from .acs import EmailEmulator
+
+__all__ = ["Latency", "RateLimit", "CosmosEmulator", "ServiceBusEmulator", "EmailEmulator"]
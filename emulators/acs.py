@@ -0,0 +1,165 @@
+import random
+import re
+import threading
+import time
+import uuid
+from collections import Counter
+from azure.core.exceptions import HttpResponseError
+from .base import RateLimit, as_latency
+
+_OPERATION_PATH = re.compile(r"/emails/operations/(?P<operation_id>[^/?]+)")
+
+
+# Just enough of an HTTP response for HttpResponseError and the code reading its headers
+class EmulatedHttpResponse:
+
+    def __init__(self, status_code, body=None, headers=None, reason=""):
+        self.status_code = status_code
+        self.headers = headers or {}
+        self.reason = reason
+        self._body = body
+
+    def json(self):
+        return self._body
+
+    def text(self):
+        return str(self._body or "")
+
+    # Like azure-core's HttpResponse, every error status is a plain HttpResponseError (404 included)
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise HttpResponseError(message=self.reason, response=self)
+
+
+"""
+In-process Azure Communication Services email resource answering the EmailClient calls email_sender,
+email_dispatcher and email_reconciler make. Sends wait for the configured latency, are throttled with a 429 and a
+Retry-After header past emails_per_minute, and end as "Failed" for failure_rate of the messages.
+Accepted messages are kept in sent, operation statuses in operations.
+Stand in for the SDK with email_sender.EmailClient = emulator and email_dispatcher.AsyncEmailClient = emulator.aio.
+"""
+class EmailEmulator:
+
+    def __init__(self, latency=0.0, emails_per_minute=None, burst=None, failure_rate=0.0, seed=None,
+                 clock=time.monotonic):
+        self.latency = as_latency(latency)
+        self.rate_limit = RateLimit(emails_per_minute / 60, capacity=burst or 1, clock=clock) if emails_per_minute else None
+        self.failure_rate = failure_rate
+        self.calls = Counter()
+        self.sent = []
+        self.operations = {}  # operation id -> {"id", "status", "error"}
+        self.throttled = 0
+        self.aio = _AsyncEmailClientFactory(self)
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    # Same call as EmailClient.from_connection_string()
+    def from_connection_string(self, conn_str=None, **kwargs):
+        return EmulatedEmailClient(self)
+
+    def _count(self, operation):
+        with self._lock:
+            self.calls[operation] += 1
+
+    def _submit(self, message, operation_id=None):
+        retry_after = self.rate_limit.consume() if self.rate_limit else 0.0
+        with self._lock:
+            if retry_after:
+                self.throttled += 1
+                response = EmulatedHttpResponse(429, headers={"Retry-After": str(max(1, round(retry_after)))},
+                                                reason="Too Many Requests")
+                error = HttpResponseError(message="Too many requests", response=response)
+                error.status_code = 429
+                raise error
+            operation_id = operation_id or str(uuid.uuid4())
+            failed = self._random.random() < self.failure_rate
+            operation = {
+                "id": operation_id,
+                "status": "Failed" if failed else "Succeeded",
+                "error": {"code": "EmailDroppedAllRecipientsSuppressed", "message": "Emulated failure"} if failed else None
+            }
+            self.operations[operation_id] = operation
+            self.sent.append(message)
+            return dict(operation)
+
+    def _operation_response(self, request):
+        match = _OPERATION_PATH.search(str(request.url))
+        operation = self.operations.get(match["operation_id"]) if match else None
+        if operation is None:
+            return EmulatedHttpResponse(404, reason="Operation not found")
+        return EmulatedHttpResponse(200, body=dict(operation))
+
+
+class EmulatedPoller:
+
+    def __init__(self, operation):
+        self._operation = operation
+
+    def status(self):
+        return self._operation["status"]
+
+    def done(self):
+        return True
+
+    def result(self):
+        return dict(self._operation)
+
+
+class EmulatedEmailClient:
+
+    def __init__(self, emulator):
+        self._emulator = emulator
+
+    def begin_send(self, message, operation_id=None, polling=True, **kwargs):
+        self._emulator._count("begin_send")
+        self._emulator.latency.sleep()
+        return EmulatedPoller(self._emulator._submit(message, operation_id))
+
+    def send_request(self, request, **kwargs):
+        self._emulator._count("send_request")
+        self._emulator.latency.sleep()
+        return self._emulator._operation_response(request)
+
+    def close(self):
+        pass
+
+
+class EmulatedAsyncPoller(EmulatedPoller):
+
+    async def result(self):
+        return dict(self._operation)
+
+
+class EmulatedAsyncEmailClient:
+
+    def __init__(self, emulator):
+        self._emulator = emulator
+
+    async def begin_send(self, message, operation_id=None, polling=True, **kwargs):
+        self._emulator._count("begin_send")
+        await self._emulator.latency.asleep()
+        return EmulatedAsyncPoller(self._emulator._submit(message, operation_id))
+
+    async def send_request(self, request, **kwargs):
+        self._emulator._count("send_request")
+        await self._emulator.latency.asleep()
+        return self._emulator._operation_response(request)
+
+    async def close(self):
+        pass
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+
+# azure.communication.email.aio.EmailClient stand-in, clients made from it share the emulator with the sync ones
+class _AsyncEmailClientFactory:
+
+    def __init__(self, emulator):
+        self._emulator = emulator
+
+    def from_connection_string(self, conn_str=None, **kwargs):
+        return EmulatedAsyncEmailClient(self._emulator)
@@ -0,0 +1,65 @@
+import asyncio
+import random
+import threading
+import time
+
+
+"""
+Simulated round-trip time: base seconds plus up to jitter seconds, drawn from a seeded generator so runs repeat.
+"""
+class Latency:
+
+    def __init__(self, base=0.0, jitter=0.0, seed=None):
+        self.base = base
+        self.jitter = jitter
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def sample(self):
+        if not self.jitter:
+            return self.base
+        with self._lock:
+            return self.base + self._random.uniform(0, self.jitter)
+
+    def sleep(self):
+        delay = self.sample()
+        if delay > 0:
+            time.sleep(delay)
+
+    async def asleep(self):
+        delay = self.sample()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+
+# Emulators take either a Latency or a plain number of seconds
+def as_latency(latency):
+
+    return latency if isinstance(latency, Latency) else Latency(base=latency or 0.0)
+
+
+"""
+Service-side throughput limit (RU/s, emails per minute...) as a token bucket: rate units per second, capacity banked.
+consume() returns 0 and takes the cost, or returns the seconds until it would be accepted (the retry-after) and takes
+nothing. A single request costing more than the capacity is accepted once the bucket is full and leaves it in debt.
+"""
+class RateLimit:
+
+    def __init__(self, rate, capacity=None, clock=time.monotonic):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else rate
+        self._clock = clock
+        self._tokens = float(self.capacity)
+        self._updated_at = clock()
+        self._lock = threading.Lock()
+
+    def consume(self, cost=1.0):
+        with self._lock:
+            now = self._clock()
+            self._tokens = min(self.capacity, self._tokens + max(0.0, now - self._updated_at) * self.rate)
+            self._updated_at = max(now, self._updated_at)
+            needed = min(cost, self.capacity)
+            if self._tokens >= needed:
+                self._tokens -= cost
+                return 0.0
+            return (needed - self._tokens) / self.rate
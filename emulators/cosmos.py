@@ -0,0 +1,516 @@
+import copy
+import itertools
+import json
+import re
+import threading
+import time
+from collections import Counter
+from azure.core import MatchConditions
+from azure.cosmos import exceptions
+from .base import RateLimit, as_latency
+
+# Approximate RU charges: point reads cost about 1 RU per KB and writes about 5.5 RU per KB, queries add a flat cost.
+# Close enough to compare code paths with each other, not a substitute for the charges Cosmos reports
+READ_RU_PER_KB = 1.0
+WRITE_RU_PER_KB = 5.5
+QUERY_RU = 2.5
+FAILED_REQUEST_RU = 1.0
+# Operations allowed in one transactional batch
+MAX_BATCH_OPERATIONS = 100
+
+_MISSING = object()
+
+_QUERY = re.compile(
+    r"^\s*SELECT\s+(?:TOP\s+(?P<top>@\w+|\d+)\s+)?(?P<projection>.+?)\s+FROM\s+c"
+    r"(?:\s+WHERE\s+(?P<where>.+?))?"
+    r"(?:\s+ORDER\s+BY\s+(?P<order>c(?:\.\w+)+)(?:\s+(?P<direction>ASC|DESC))?)?\s*$",
+    re.IGNORECASE | re.DOTALL
+)
+_CONDITION = re.compile(
+    r"^(?P<negate>NOT\s+)?(?:ARRAY_CONTAINS\(\s*(?P<array>c(?:\.\w+)+)\s*,\s*(?P<needle>.+)\)"
+    r"|IS_DEFINED\(\s*(?P<defined>c(?:\.\w+)+)\s*\)"
+    r"|(?P<field>c(?:\.\w+)+)\s*(?P<operator>=|!=|<>|<=|>=|<|>)\s*(?P<value>.+))$",
+    re.IGNORECASE | re.DOTALL
+)
+_FILTER_PREDICATE = re.compile(r"^\s*FROM\s+c\s+WHERE\s+(?P<where>.+)$", re.IGNORECASE | re.DOTALL)
+_COMPARISONS = {
+    "=": lambda a, b: a == b,
+    "!=": lambda a, b: a != b,
+    "<>": lambda a, b: a != b,
+    "<": lambda a, b: a < b,
+    ">": lambda a, b: a > b,
+    "<=": lambda a, b: a <= b,
+    ">=": lambda a, b: a >= b,
+}
+
+
+def document_kb(doc):
+
+    return len(json.dumps(doc, default=str).encode("utf-8")) / 1024
+
+
+def read_charge(doc):
+
+    return FAILED_REQUEST_RU if doc is None else max(1.0, document_kb(doc)) * READ_RU_PER_KB
+
+
+def write_charge(doc):
+
+    return max(1.0, document_kb(doc)) * WRITE_RU_PER_KB
+
+
+# c.a.b -> doc["a"]["b"], _MISSING when any part isn't there (Cosmos "undefined")
+def field_value(doc, path):
+
+    value = doc
+    for part in path.split(".")[1:]:
+        if not isinstance(value, dict) or part not in value:
+            return _MISSING
+        value = value[part]
+    return value
+
+
+# A query literal: @parameter, 'single quoted', or JSON ("double quoted", numbers, true, false, null)
+def literal_value(token, parameters):
+
+    token = token.strip()
+    if token.startswith("@"):
+        if token not in parameters:
+            raise exceptions.CosmosHttpResponseError(status_code=400, message=f"Parameter {token} is not defined")
+        return parameters[token]
+    if token.startswith("'") and token.endswith("'"):
+        return token[1:-1]
+    try:
+        return json.loads(token)
+    except ValueError:
+        raise NotImplementedError(f"Unsupported query value: {token}")
+
+
+"""
+WHERE clause evaluator for the query subset the app uses: conditions joined with AND, each one
+c.field <op> value, [NOT] ARRAY_CONTAINS(c.field, value) or [NOT] IS_DEFINED(c.field). Anything else raises NotImplementedError
+so a test notices instead of getting wrong results.
+"""
+def where_matcher(where, parameters):
+
+    if not where:
+        return lambda doc: True
+
+    conditions = []
+    for clause in re.split(r"\s+AND\s+", where.strip(), flags=re.IGNORECASE):
+        match = _CONDITION.match(clause.strip())
+        if not match:
+            raise NotImplementedError(f"Unsupported query condition: {clause}")
+        negate = bool(match["negate"])
+        if match["defined"]:
+
+            def condition(doc, field_path=match["defined"], negate=negate):
+                return (field_value(doc, field_path) is not _MISSING) != negate
+        elif match["array"]:
+            array_path, needle = match["array"], literal_value(match["needle"], parameters)
+
+            def condition(doc, array_path=array_path, needle=needle, negate=negate):
+                values = field_value(doc, array_path)
+                return (isinstance(values, list) and needle in values) != negate
+        else:
+            field_path, compare = match["field"], _COMPARISONS[match["operator"]]
+            value = literal_value(match["value"], parameters)
+
+            def condition(doc, field_path=field_path, compare=compare, value=value, negate=negate):
+                found = field_value(doc, field_path)
+                try:
+                    return found is not _MISSING and compare(found, value) != negate
+                except TypeError:
+                    return False
+        conditions.append(condition)
+    return lambda doc: all(condition(doc) for condition in conditions)
+
+
+def project(doc, projection):
+
+    projection = projection.strip()
+    if projection == "*":
+        return doc
+    if projection.upper().startswith("VALUE "):
+        return field_value(doc, projection[6:].strip())
+    projected = {}
+    for path in (part.strip() for part in projection.split(",")):
+        if not path.startswith("c."):
+            raise NotImplementedError(f"Unsupported query projection: {path}")
+        value = field_value(doc, path)
+        if value is not _MISSING:
+            projected[path.rsplit(".", 1)[-1]] = value
+    return projected
+
+
+# Apply one JSON patch operation (add, set, replace, remove, incr) to doc in place
+def apply_patch(doc, operation):
+
+    op, path, value = operation["op"], operation["path"], operation.get("value")
+    parts = path.strip("/").split("/")
+    parent = doc
+    try:
+        for part in parts[:-1]:
+            parent = parent[int(part)] if isinstance(parent, list) else parent[part]
+    except (KeyError, IndexError, ValueError):
+        raise exceptions.CosmosHttpResponseError(status_code=400, message=f"Patch path {path} doesn't exist")
+
+    last = parts[-1]
+    if isinstance(parent, list):
+        if op == "add":
+            if last == "-":
+                parent.append(value)
+            else:
+                parent.insert(int(last), value)
+            return
+        last = int(last)
+        if not -len(parent) <= last < len(parent):
+            raise exceptions.CosmosHttpResponseError(status_code=400, message=f"Patch path {path} doesn't exist")
+    elif op in ("replace", "remove", "incr") and last not in parent:
+        raise exceptions.CosmosHttpResponseError(status_code=400, message=f"Patch path {path} doesn't exist")
+
+    if op in ("add", "set", "replace"):
+        parent[last] = value
+    elif op == "remove":
+        del parent[last]
+    elif op == "incr":
+        parent[last] += value
+    else:
+        raise exceptions.CosmosHttpResponseError(status_code=400, message=f"Unsupported patch operation {op}")
+
+
+class ReadItemsResult(list):
+
+    def __init__(self, docs, headers):
+        super().__init__(docs)
+        self._headers = headers
+
+    def get_response_headers(self):
+        return self._headers
+
+
+class _ClientConnection:
+
+    def __init__(self):
+        self.last_response_headers = {}
+
+
+"""
+In-process Cosmos DB account: databases and containers that answer the ContainerProxy calls cosmos_helpers and
+subscriber_cache make, with the same exceptions for conflicts (409), missing items (404) and failed conditions (412).
+Every request waits for the configured latency and is charged approximate RUs against ru_per_second. Like the SDK,
+a throttled request is retried after the retry-after up to throttle_retries times before the 429 reaches the caller.
+Stand in for the SDK with cosmos_helpers.CosmosClient = emulator.client.
+"""
+class CosmosEmulator:
+
+    def __init__(self, latency=0.0, ru_per_second=None, throttle_retries=9, clock=time.monotonic,
+                 wall_clock=time.time, sleep=time.sleep):
+        self.latency = as_latency(latency)
+        self.rate_limit = RateLimit(ru_per_second, clock=clock) if ru_per_second else None
+        self.throttle_retries = throttle_retries
+        self.wall_clock = wall_clock
+        self._sleep = sleep
+        self.calls = Counter()  # "{container id}.{operation}" -> requests
+        self.request_charge = 0.0
+        self.throttled = 0
+        self._databases = {}
+        self._lock = threading.Lock()
+
+    # Same signature as the CosmosClient constructor
+    def client(self, url=None, credential=None, **kwargs):
+        return EmulatedCosmosClient(self)
+
+    def database(self, database_id):
+        with self._lock:
+            return self._databases.setdefault(database_id, EmulatedDatabase(self, database_id))
+
+    def container(self, database_id, container_id):
+        return self.database(database_id).get_container_client(container_id)
+
+    def reset_stats(self):
+        with self._lock:
+            self.calls.clear()
+            self.request_charge = 0.0
+            self.throttled = 0
+
+    # Count, delay and charge one request, raising the 429 once the retries are used up
+    def _request(self, container_id, operation, charge):
+        with self._lock:
+            self.calls[f"{container_id}.{operation}"] += 1
+        for attempt in itertools.count():
+            self.latency.sleep()
+            retry_after = self.rate_limit.consume(charge) if self.rate_limit else 0.0
+            if not retry_after:
+                break
+            with self._lock:
+                self.throttled += 1
+            if attempt >= self.throttle_retries:
+                error = exceptions.CosmosHttpResponseError(
+                    status_code=429, message="Request rate is large. More Request Units may be needed.")
+                error.headers["x-ms-retry-after-ms"] = str(int(retry_after * 1000))
+                raise error
+            self._sleep(retry_after)
+        with self._lock:
+            self.request_charge += charge
+        return charge
+
+
+class EmulatedCosmosClient:
+
+    def __init__(self, emulator):
+        self._emulator = emulator
+
+    def get_database_client(self, database):
+        return self._emulator.database(database)
+
+    def create_database_if_not_exists(self, id, **kwargs):
+        return self._emulator.database(id)
+
+
+class EmulatedDatabase:
+
+    def __init__(self, emulator, database_id):
+        self._emulator = emulator
+        self.id = database_id
+        self._containers = {}
+        self._lock = threading.Lock()
+
+    def create_container_if_not_exists(self, id, partition_key, default_ttl=None, **kwargs):
+        with self._lock:
+            if id not in self._containers:
+                self._containers[id] = EmulatedContainer(self._emulator, id, partition_key.path, default_ttl)
+            return self._containers[id]
+
+    def create_container(self, id, partition_key, default_ttl=None, **kwargs):
+        if id in self._containers:
+            raise exceptions.CosmosResourceExistsError(message=f"Container {id} already exists")
+        return self.create_container_if_not_exists(id, partition_key, default_ttl, **kwargs)
+
+    def replace_container(self, container, partition_key, default_ttl=None, **kwargs):
+        container = self.get_container_client(getattr(container, "id", container))
+        container.default_ttl = default_ttl
+        return container
+
+    # Unlike the SDK this fails right away for a container that was never created, instead of on its first request
+    def get_container_client(self, container):
+        try:
+            return self._containers[container]
+        except KeyError:
+            raise exceptions.CosmosResourceNotFoundError(message=f"Container {container} doesn't exist, provision it first")
+
+
+"""
+One container. Items are stored per partition key value with _etag, _ts and _lsn system properties, TTL is honoured
+when the container has default_ttl set (-1 or seconds), and query_items_change_feed() reports the latest version
+of every item written after the continuation token (deletes aren't reported, like latest version mode).
+"""
+class EmulatedContainer:
+
+    def __init__(self, emulator, container_id, partition_key_path, default_ttl=None):
+        self._emulator = emulator
+        self.id = container_id
+        self.partition_key_path = partition_key_path
+        self.default_ttl = default_ttl
+        self.client_connection = _ClientConnection()
+        self._partitions = {}  # partition key value -> {id: doc}
+        self._lsn = 0
+        self._lock = threading.RLock()
+
+    def read(self, **kwargs):
+        properties = {"id": self.id, "partitionKey": {"paths": [self.partition_key_path], "kind": "Hash"}}
+        if self.default_ttl is not None:
+            properties["defaultTtl"] = self.default_ttl
+        return properties
+
+    # Seed items without charging or counting requests, for test and benchmark setup
+    def load(self, docs):
+        with self._lock:
+            for doc in docs:
+                self._store(copy.deepcopy(doc))
+
+    def items(self):
+        with self._lock:
+            return [copy.deepcopy(doc) for partition in self._partitions.values() for doc in partition.values()
+                    if not self._expired(doc)]
+
+    def _partition_key(self, body):
+        value = field_value(body, "c" + self.partition_key_path.replace("/", "."))
+        if value is _MISSING:
+            raise exceptions.CosmosHttpResponseError(
+                status_code=400, message=f"Item is missing its partition key {self.partition_key_path}")
+        return value
+
+    def _expired(self, doc):
+        if self.default_ttl is None:
+            return False
+        ttl = doc.get("ttl", self.default_ttl)
+        return ttl is not None and ttl != -1 and self._emulator.wall_clock() >= doc["_ts"] + ttl
+
+    def _get(self, partition_key, item_id):
+        doc = self._partitions.get(partition_key, {}).get(item_id)
+        return None if doc is None or self._expired(doc) else doc
+
+    def _store(self, doc):
+        if "id" not in doc:
+            raise exceptions.CosmosHttpResponseError(status_code=400, message="Item is missing its id")
+        self._lsn += 1
+        doc.update({"_etag": f'"{self._lsn:016x}"', "_ts": int(self._emulator.wall_clock()), "_lsn": self._lsn})
+        self._partitions.setdefault(self._partition_key(doc), {})[doc["id"]] = doc
+        return copy.deepcopy(doc)
+
+    def _request(self, operation, charge, **headers):
+        charge = self._emulator._request(self.id, operation, charge)
+        self.client_connection.last_response_headers = {"x-ms-request-charge": f"{charge:.2f}", **headers}
+
+    def _not_found(self, item_id):
+        return exceptions.CosmosResourceNotFoundError(message=f"Item {item_id} not found in {self.id}")
+
+    def create_item(self, body, **kwargs):
+        doc = copy.deepcopy(body)
+        self._request("create_item", write_charge(doc))
+        with self._lock:
+            if self._get(self._partition_key(doc), doc.get("id")) is not None:
+                raise exceptions.CosmosResourceExistsError(message=f"Item {doc['id']} already exists in {self.id}")
+            return self._store(doc)
+
+    def upsert_item(self, body, **kwargs):
+        doc = copy.deepcopy(body)
+        self._request("upsert_item", write_charge(doc))
+        with self._lock:
+            return self._store(doc)
+
+    def replace_item(self, item, body, etag=None, match_condition=None, **kwargs):
+        doc = copy.deepcopy(body)
+        self._request("replace_item", write_charge(doc))
+        with self._lock:
+            current = self._get(self._partition_key(doc), item["id"] if isinstance(item, dict) else item)
+            if current is None:
+                raise self._not_found(doc.get("id"))
+            if match_condition == MatchConditions.IfNotModified and etag != current["_etag"]:
+                raise exceptions.CosmosAccessConditionFailedError(message=f"Item {doc['id']} was modified")
+            return self._store(doc)
+
+    def read_item(self, item, partition_key, **kwargs):
+        self._request("read_item", read_charge(self._get(partition_key, item)))
+        with self._lock:
+            doc = self._get(partition_key, item)
+            if doc is None:
+                raise self._not_found(item)
+            return copy.deepcopy(doc)
+
+    def read_items(self, items, max_concurrency=None, **kwargs):
+        items = list(items)
+        with self._lock:
+            docs = [self._get(partition_key, item_id) for item_id, partition_key in items]
+            found = [copy.deepcopy(doc) for doc in docs if doc is not None]
+        charge = max(1.0, sum(read_charge(doc) for doc in found))
+        self._request("read_items", charge)
+        return ReadItemsResult(found, dict(self.client_connection.last_response_headers))
+
+    def delete_item(self, item, partition_key, **kwargs):
+        self._request("delete_item", write_charge(self._get(partition_key, item) or {}))
+        with self._lock:
+            if self._get(partition_key, item) is None:
+                raise self._not_found(item)
+            del self._partitions[partition_key][item]
+
+    def patch_item(self, item, partition_key, patch_operations, filter_predicate=None, **kwargs):
+        self._request("patch_item", write_charge(self._get(partition_key, item) or {}))
+        with self._lock:
+            current = self._get(partition_key, item)
+            if current is None:
+                raise self._not_found(item)
+            if filter_predicate:
+                match = _FILTER_PREDICATE.match(filter_predicate)
+                if not match:
+                    raise NotImplementedError(f"Unsupported filter predicate: {filter_predicate}")
+                if not where_matcher(match["where"], {})(current):
+                    raise exceptions.CosmosAccessConditionFailedError(message=f"Filter predicate failed for {item}")
+            doc = copy.deepcopy(current)
+            for operation in patch_operations:
+                apply_patch(doc, operation)
+            return self._store(doc)
+
+    def query_items(self, query, parameters=None, partition_key=None, enable_cross_partition_query=None, **kwargs):
+        match = _QUERY.match(query)
+        if not match:
+            raise NotImplementedError(f"Unsupported query: {query}")
+        parameters = {parameter["name"]: parameter["value"] for parameter in parameters or []}
+        matches = where_matcher(match["where"], parameters)
+
+        with self._lock:
+            partitions = [self._partitions.get(partition_key, {})] if partition_key is not None \
+                else list(self._partitions.values())
+            docs = [doc for partition in partitions for doc in partition.values()
+                    if not self._expired(doc) and matches(doc)]
+            if match["order"]:
+                docs.sort(key=lambda doc: field_value(doc, match["order"]),
+                          reverse=(match["direction"] or "").upper() == "DESC")
+            if match["top"]:
+                docs = docs[:int(literal_value(match["top"], parameters))]
+            results = [project(doc, match["projection"]) for doc in docs]
+            results = [copy.deepcopy(result) for result in results if result is not _MISSING]
+
+        self._request("query_items", QUERY_RU + sum(read_charge(doc) for doc in docs) / 10)
+        return results
+
+    # Transactional batch on one partition: every operation applies or none do
+    def execute_item_batch(self, batch_operations, partition_key, **kwargs):
+        batch_operations = list(batch_operations)
+        if len(batch_operations) > MAX_BATCH_OPERATIONS:
+            raise exceptions.CosmosHttpResponseError(
+                status_code=400, message=f"Batch has {len(batch_operations)} operations, the limit is {MAX_BATCH_OPERATIONS}")
+        bodies = [operation[1][-1] for operation in batch_operations if operation[0] in ("create", "upsert", "replace")]
+        self._request("execute_item_batch", sum(write_charge(body) for body in bodies) or FAILED_REQUEST_RU)
+
+        with self._lock:
+            staged = {item_id: doc for item_id, doc in self._partitions.get(partition_key, {}).items()
+                      if not self._expired(doc)}
+            for index, (operation, args, *_) in enumerate(batch_operations):
+                item_id = args[-1]["id"] if operation in ("create", "upsert", "replace") else args[0]
+                if operation in ("create", "upsert", "replace") and self._partition_key(args[-1]) != partition_key:
+                    raise exceptions.CosmosBatchOperationError(error_index=index, headers={}, status_code=400,
+                                                               message="Partition key doesn't match the batch")
+                if operation == "create" and item_id in staged:
+                    raise exceptions.CosmosBatchOperationError(error_index=index, headers={}, status_code=409,
+                                                               message=f"Item {item_id} already exists")
+                if operation in ("replace", "delete", "read") and item_id not in staged:
+                    raise exceptions.CosmosBatchOperationError(error_index=index, headers={}, status_code=404,
+                                                               message=f"Item {item_id} not found")
+                if operation == "delete":
+                    del staged[item_id]
+                elif operation != "read":
+                    staged[item_id] = args[-1]
+
+            results = []
+            for operation, args, *_ in batch_operations:
+                if operation == "delete":
+                    del self._partitions[partition_key][args[0]]
+                    results.append({"statusCode": 204})
+                elif operation == "read":
+                    results.append({"statusCode": 200, "resourceBody": copy.deepcopy(self._get(partition_key, args[0]))})
+                else:
+                    results.append({"statusCode": 201 if operation == "create" else 200,
+                                    "resourceBody": self._store(copy.deepcopy(args[-1]))})
+            return results
+
+    # start_time="Now" only positions the feed, continuation resumes after the token from the previous read
+    def query_items_change_feed(self, start_time=None, continuation=None, partition_key=None, **kwargs):
+        with self._lock:
+            if continuation is not None:
+                after = int(continuation)
+            elif start_time == "Now":
+                after = self._lsn
+            else:
+                after = 0
+            partitions = [self._partitions.get(partition_key, {})] if partition_key is not None \
+                else list(self._partitions.values())
+            docs = sorted((doc for partition in partitions for doc in partition.values()
+                           if doc["_lsn"] > after and not self._expired(doc)), key=lambda doc: doc["_lsn"])
+            changes = [copy.deepcopy(doc) for doc in docs]
+            token = str(self._lsn)
+
+        self._request("query_items_change_feed", FAILED_REQUEST_RU + sum(read_charge(doc) for doc in changes),
+                      etag=token)
+        return changes
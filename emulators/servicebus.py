@@ -0,0 +1,211 @@
+import threading
+import uuid
+from collections import Counter, deque
+from azure.servicebus.exceptions import MessageLockLostError, MessageSizeExceededError, ServiceBusQuotaExceededError
+from .base import as_latency
+
+# Standard tier limits: 256 KB per batch, messages dead-lettered after 10 deliveries
+MAX_BATCH_SIZE_IN_BYTES = 256 * 1024
+MAX_DELIVERY_COUNT = 10
+# Per-message overhead counted against the batch size (system properties, AMQP framing)
+MESSAGE_OVERHEAD_BYTES = 64
+
+
+class EmulatedReceivedMessage:
+
+    def __init__(self, body, message_id):
+        self.message_id = message_id
+        self.delivery_count = 0
+        self._body = body
+
+    def __str__(self):
+        return self._body
+
+
+"""
+One queue with peek-lock semantics: received messages stay locked until they're completed or abandoned,
+abandoned ones become available again and are dead-lettered after max_delivery_count deliveries.
+Sending more than max_depth active plus locked messages raises ServiceBusQuotaExceededError like a full queue.
+"""
+class EmulatedQueue:
+
+    def __init__(self, name, max_depth=None, max_delivery_count=MAX_DELIVERY_COUNT):
+        self.name = name
+        self.max_depth = max_depth
+        self.max_delivery_count = max_delivery_count
+        self.available = deque()
+        self.locked = {}  # message_id -> message
+        self.dead_letters = []
+        self.completed = 0
+        self.peak_depth = 0
+        self._lock = threading.Lock()
+
+    @property
+    def depth(self):
+        return len(self.available) + len(self.locked)
+
+    def enqueue(self, bodies):
+        with self._lock:
+            if self.max_depth is not None and self.depth + len(bodies) > self.max_depth:
+                raise ServiceBusQuotaExceededError(message=f"Queue {self.name} is full ({self.max_depth} messages)")
+            self.available.extend(EmulatedReceivedMessage(body, str(uuid.uuid4())) for body in bodies)
+            self.peak_depth = max(self.peak_depth, self.depth)
+
+    def lock_messages(self, max_message_count):
+        with self._lock:
+            received = []
+            while self.available and len(received) < max_message_count:
+                message = self.available.popleft()
+                message.delivery_count += 1
+                self.locked[message.message_id] = message
+                received.append(message)
+            return received
+
+    def settle(self, message, completed):
+        with self._lock:
+            if self.locked.pop(message.message_id, None) is None:
+                raise MessageLockLostError(message=f"Message {message.message_id} isn't locked")
+            if completed:
+                self.completed += 1
+            elif message.delivery_count >= self.max_delivery_count:
+                self.dead_letters.append(message)
+            else:
+                self.available.append(message)
+
+    # Bodies of the messages waiting to be received, oldest first
+    def bodies(self):
+        with self._lock:
+            return [str(message) for message in self.available]
+
+
+"""
+In-process Service Bus namespace answering the aio ServiceBusClient, sender and receiver calls that
+service_bus_sender and email_dispatcher make. Every send, receive and settle waits for the configured latency.
+Stand in for the SDK with service_bus_sender.ServiceBusClient = emulator (and email_dispatcher.ServiceBusClient).
+"""
+class ServiceBusEmulator:
+
+    def __init__(self, latency=0.0, max_queue_depth=None, max_batch_size_in_bytes=MAX_BATCH_SIZE_IN_BYTES,
+                 max_delivery_count=MAX_DELIVERY_COUNT):
+        self.latency = as_latency(latency)
+        self.max_queue_depth = max_queue_depth
+        self.max_batch_size_in_bytes = max_batch_size_in_bytes
+        self.max_delivery_count = max_delivery_count
+        self.calls = Counter()
+        self._queues = {}
+        self._lock = threading.Lock()
+
+    # Same call as ServiceBusClient.from_connection_string()
+    def from_connection_string(self, conn_str=None, **kwargs):
+        return EmulatedServiceBusClient(self)
+
+    def queue(self, name):
+        with self._lock:
+            if name not in self._queues:
+                self._queues[name] = EmulatedQueue(name, self.max_queue_depth, self.max_delivery_count)
+            return self._queues[name]
+
+    async def _request(self, operation):
+        with self._lock:
+            self.calls[operation] += 1
+        await self.latency.asleep()
+
+
+class EmulatedServiceBusClient:
+
+    def __init__(self, emulator):
+        self._emulator = emulator
+
+    def get_queue_sender(self, queue_name, **kwargs):
+        return EmulatedSender(self._emulator, self._emulator.queue(queue_name))
+
+    def get_queue_receiver(self, queue_name, **kwargs):
+        return EmulatedReceiver(self._emulator, self._emulator.queue(queue_name))
+
+    async def close(self):
+        pass
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+
+class EmulatedMessageBatch:
+
+    def __init__(self, max_size_in_bytes):
+        self.max_size_in_bytes = max_size_in_bytes
+        self.size_in_bytes = 0
+        self.bodies = []
+
+    def __len__(self):
+        return len(self.bodies)
+
+    def add_message(self, message):
+        body = str(message)
+        size = len(body.encode("utf-8")) + MESSAGE_OVERHEAD_BYTES
+        if self.size_in_bytes + size > self.max_size_in_bytes:
+            raise MessageSizeExceededError(message=f"ServiceBusMessageBatch has reached its size limit: {self.max_size_in_bytes}")
+        self.bodies.append(body)
+        self.size_in_bytes += size
+
+
+class EmulatedSender:
+
+    def __init__(self, emulator, queue):
+        self._emulator = emulator
+        self._queue = queue
+
+    async def create_message_batch(self, max_size_in_bytes=None):
+        return EmulatedMessageBatch(min(max_size_in_bytes or self._emulator.max_batch_size_in_bytes,
+                                        self._emulator.max_batch_size_in_bytes))
+
+    # A batch, one message or a list of messages
+    async def send_messages(self, message, **kwargs):
+        if isinstance(message, EmulatedMessageBatch):
+            bodies = message.bodies
+        elif isinstance(message, (list, tuple)):
+            bodies = [str(item) for item in message]
+        else:
+            bodies = [str(message)]
+        await self._emulator._request("send_messages")
+        self._queue.enqueue(bodies)
+
+    async def close(self):
+        pass
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+
+# Returns whatever is available right away instead of waiting max_wait_time for more to arrive
+class EmulatedReceiver:
+
+    def __init__(self, emulator, queue):
+        self._emulator = emulator
+        self._queue = queue
+
+    async def receive_messages(self, max_message_count=1, max_wait_time=None):
+        await self._emulator._request("receive_messages")
+        return self._queue.lock_messages(max_message_count or 1)
+
+    async def complete_message(self, message):
+        await self._emulator._request("complete_message")
+        self._queue.settle(message, completed=True)
+
+    async def abandon_message(self, message):
+        await self._emulator._request("abandon_message")
+        self._queue.settle(message, completed=False)
+
+    async def close(self):
+        pass
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
@@ -0,0 +1,186 @@
+import pytest
+import asyncio
+import threading
+from unittest.mock import AsyncMock, MagicMock
+from azure.cosmos.exceptions import CosmosHttpResponseError
+from azfunc import alert_pipeline
+
+
+def make_tick(alert_ids, users):
+
+    all_alerts = [{"properties": {"id": alert_id, "event": "Flood Warning", "web": "http://www.weather.gov"}}
+                  for alert_id in alert_ids]
+    user_to_alerts = {user_id: {index: "FLC127" for index in range(len(alert_ids))} for user_id in users}
+    user_emails = {user_id: f"{user_id}@example.com" for user_id in users}
+    current_alerts = {alert_id: "2025-10-22T00:00:00Z" for alert_id in alert_ids}
+    return all_alerts, current_alerts, user_to_alerts, user_emails
+
+
+"""Fixture that records snapshot saves and released pairs instead of touching Cosmos."""
+@pytest.fixture(autouse=True)
+def stored(monkeypatch):
+
+    stored = {"snapshot": None, "released": []}
+    monkeypatch.setattr(alert_pipeline, "store_alert_snapshot", lambda alerts, retry_alert_ids=(): stored.update(
+        snapshot={alert_id: sent for alert_id, sent in alerts.items() if alert_id not in retry_alert_ids}))
+    monkeypatch.setattr(alert_pipeline, "release_unqueued", lambda messages: stored["released"].extend(messages))
+    return stored
+
+
+#================================= Test prepare_tick_async() =================================
+
+def make_feed_alert(alert_id, zones):
+
+    return {"properties": {"id": alert_id, "event": "Flood Warning", "sent": "2025-10-22T00:00:00Z",
+                           "geocode": {"UGC": zones}}}
+
+
+# The first alert's zones are looked up while the rest of the feed is still being parsed
+@pytest.mark.asyncio
+async def test_prepare_tick_async_overlaps_lookups_with_parse(monkeypatch):
+
+    alerts = [make_feed_alert("A1", ["FLC127"]), make_feed_alert("A2", ["TXZ001", "FLC127"])]
+    first_lookup_started = threading.Event()
+    looked_up = []
+
+    def fake_fetch(on_changed):
+        on_changed(alerts[0])
+        # The parse only goes on once the lookup for A1's zone is under way
+        assert first_lookup_started.wait(2)
+        on_changed(alerts[1])
+        return alerts, {"A1": "2025-10-22T00:00:00Z", "A2": "2025-10-22T00:00:00Z"}, {"FLC127", "TXZ001"}
+
+    def fake_resolve(zone_ids):
+        looked_up.append(list(zone_ids))
+        first_lookup_started.set()
+        return {zone_id: [f"user-{zone_id}"] for zone_id in zone_ids}, None
+
+    monkeypatch.setattr(alert_pipeline, "PIPELINE_LOOKUP_ZONES", 1)
+    monkeypatch.setattr(alert_pipeline, "fetch_changed_alerts", fake_fetch)
+    monkeypatch.setattr(alert_pipeline, "resolve_subscribers", fake_resolve)
+    monkeypatch.setattr(alert_pipeline, "get_user_emails", lambda user_ids: {user_id: f"{user_id}@example.com" for user_id in user_ids})
+
+    all_alerts, current_alerts, user_to_alerts, user_emails = await alert_pipeline.prepare_tick_async()
+
+    # Assertions
+    assert looked_up == [["FLC127"], ["TXZ001"]]                        # each zone once, in chunks as they turned up
+    assert user_to_alerts == {"user-FLC127": {0: "FLC127", 1: "FLC127"}, "user-TXZ001": {1: "TXZ001"}}
+    assert user_emails == {"user-FLC127": "user-FLC127@example.com", "user-TXZ001": "user-TXZ001@example.com"}
+
+
+@pytest.mark.asyncio
+async def test_prepare_tick_async_lookup_failure(monkeypatch, caplog):
+
+    alerts = [make_feed_alert("A1", ["FLC127"])]
+
+    def fake_fetch(on_changed):
+        on_changed(alerts[0])
+        return alerts, {"A1": "2025-10-22T00:00:00Z"}, {"FLC127"}
+
+    monkeypatch.setattr(alert_pipeline, "fetch_changed_alerts", fake_fetch)
+    monkeypatch.setattr(alert_pipeline, "resolve_subscribers", MagicMock(side_effect=Exception("DB error!")))
+
+    with caplog.at_level("ERROR"):
+        result = await alert_pipeline.prepare_tick_async()
+
+    # Assertions
+    assert result is None
+    assert "Failed to query zone subscriptions: DB error!" in caplog.text
+
+
+#================================= Test get_alerts_async() =================================
+
+@pytest.mark.asyncio
+async def test_get_alerts_async_queues_every_new_pair(monkeypatch, stored):
+
+    sent = []
+
+    async def fake_send(messages):
+        sent.append(list(messages))
+        return []
+
+    monkeypatch.setattr(alert_pipeline, "prepare_tick_async", AsyncMock(return_value=make_tick(["A1", "A2", "A3"], ["user1", "user2"])))
+    monkeypatch.setattr(alert_pipeline, "alert_check_bulk", lambda pairs: (list(pairs), [], []))
+    monkeypatch.setattr(alert_pipeline, "send_messages_to_queue", fake_send)
+
+    await alert_pipeline.get_alerts_async()
+
+    # Assertions
+    queued = sorted((msg["alert_id"], msg["user_id"]) for batch in sent for msg in batch)
+    assert queued == [(a, u) for a in ["A1", "A2", "A3"] for u in ["user1", "user2"]]
+    assert stored["snapshot"] == {"A1": "2025-10-22T00:00:00Z", "A2": "2025-10-22T00:00:00Z",
+                                  "A3": "2025-10-22T00:00:00Z"}
+
+
+# Sending alert N's messages overlaps with the dedup writes for alert N+1
+@pytest.mark.asyncio
+async def test_get_alerts_async_overlaps_stages(monkeypatch):
+
+    events = []
+    first_send_started = asyncio.Event()
+    second_check_started = asyncio.Event()
+    loop = asyncio.get_running_loop()
+
+    def fake_check(pairs):
+        alert_id = pairs[0]["alert_id"]
+        events.append(f"check {alert_id}")
+        if alert_id == "A2":
+            loop.call_soon_threadsafe(second_check_started.set)
+            # The second alert's write only finishes once the first alert's messages are being sent
+            asyncio.run_coroutine_threadsafe(asyncio.wait_for(first_send_started.wait(), 2), loop).result()
+        return list(pairs), [], []
+
+    async def fake_send(messages):
+        if messages[0]["alert_id"] == "A1":
+            await asyncio.wait_for(second_check_started.wait(), 2)      # so both are in flight at once
+        events.append(f"send {messages[0]['alert_id']}")
+        first_send_started.set()
+        return []
+
+    monkeypatch.setattr(alert_pipeline, "PIPELINE_DEDUP_WORKERS", 1)
+    monkeypatch.setattr(alert_pipeline, "prepare_tick_async", AsyncMock(return_value=make_tick(["A1", "A2"], ["user1"])))
+    monkeypatch.setattr(alert_pipeline, "alert_check_bulk", fake_check)
+    monkeypatch.setattr(alert_pipeline, "send_messages_to_queue", fake_send)
+
+    await alert_pipeline.get_alerts_async()
+
+    # Assertions
+    assert events == ["check A1", "check A2", "send A1", "send A2"]
+
+
+@pytest.mark.asyncio
+async def test_get_alerts_async_failures_are_retried(monkeypatch, stored):
+
+    def fake_check(pairs):
+        if pairs[0]["alert_id"] == "A2":
+            return [], [], [(pairs[0], CosmosHttpResponseError(message="write failed"))]
+        return list(pairs), [], []
+
+    async def fake_send(messages):
+        # A3's batch doesn't make it onto the queue
+        return [{"messages": [m for m in messages if m["alert_id"] == "A3"], "error": Exception("busy")}] \
+            if any(m["alert_id"] == "A3" for m in messages) else []
+
+    monkeypatch.setattr(alert_pipeline, "prepare_tick_async", AsyncMock(return_value=make_tick(["A1", "A2", "A3"], ["user1"])))
+    monkeypatch.setattr(alert_pipeline, "alert_check_bulk", fake_check)
+    monkeypatch.setattr(alert_pipeline, "send_messages_to_queue", fake_send)
+
+    await alert_pipeline.get_alerts_async()
+
+    # Assertions
+    assert stored["snapshot"] == {"A1": "2025-10-22T00:00:00Z"}         # A2 and A3 retried next tick
+    assert [(m["alert_id"], m["user_id"]) for m in stored["released"]] == [("A3", "user1")]
+
+
+@pytest.mark.asyncio
+async def test_get_alerts_async_nothing_to_do(monkeypatch, stored):
+
+    check = MagicMock()
+    monkeypatch.setattr(alert_pipeline, "prepare_tick_async", AsyncMock(return_value=None))
+    monkeypatch.setattr(alert_pipeline, "alert_check_bulk", check)
+
+    await alert_pipeline.get_alerts_async()
+
+    # Assertions
+    check.assert_not_called()
+    assert stored["snapshot"] is None
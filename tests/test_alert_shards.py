@@ -0,0 +1,202 @@
+import pytest
+import asyncio
+import sys
+import threading
+from unittest.mock import AsyncMock
+from azfunc import alert_shards
+from azfunc.helpers import service_bus_sender
+
+
+def make_alert(alert_id, zones, description="Seek shelter now."):
+
+    return {"properties": {"id": alert_id, "geocode": {"UGC": zones}, "event": "Flood Warning",
+                           "description": description, "sent": "2025-10-22T00:00:00Z"}}
+
+
+# (alert id, zone id) pairs covered by a set of jobs, each job only fans an alert out to its own zones
+def job_pairs(jobs):
+
+    pairs = []
+    for job in jobs:
+        for alert in job["alerts"]:
+            pairs.extend((alert["properties"]["id"], zone_id) for zone_id in alert["properties"]["geocode"]["UGC"]
+                         if zone_id in job["zone_ids"])
+    return pairs
+
+
+"""Fixture that records snapshot saves instead of touching Cosmos."""
+@pytest.fixture(autouse=True)
+def stored(monkeypatch):
+
+    stored = {"snapshot": None}
+    monkeypatch.setattr(alert_shards, "store_alert_snapshot", lambda alerts, retry_alert_ids=(): stored.update(
+        snapshot={alert_id: sent for alert_id, sent in alerts.items() if alert_id not in retry_alert_ids}))
+    return stored
+
+
+#================================= Test build_shard_jobs() =================================
+
+def test_shard_for_zone_is_stable():
+
+    # Assertions
+    assert alert_shards.shard_for_zone("FLC127", 8) == alert_shards.shard_for_zone("FLC127", 8)
+    assert {alert_shards.shard_for_zone(f"FLC{n:03}", 8) for n in range(200)} == set(range(8))
+
+
+def test_build_shard_jobs_covers_every_pair_once():
+
+    zones = [f"FLC{n:03}" for n in range(40)]
+    alerts = [make_alert("A1", zones[:30]), make_alert("A2", zones[20:]), make_alert("A3", ["TXZ001"])]
+    affected_zone_ids = set(zones) | {"TXZ001"}
+
+    jobs = alert_shards.build_shard_jobs(alerts, affected_zone_ids, 4)
+
+    # Assertions
+    expected = [(alert["properties"]["id"], zone_id) for alert in alerts for zone_id in alert["properties"]["geocode"]["UGC"]]
+    assert sorted(job_pairs(jobs)) == sorted(expected)              # nothing lost, nothing fanned out twice
+    for job in jobs:
+        assert job["shards"] == 4
+        assert {alert_shards.shard_for_zone(zone_id, 4) for zone_id in job["zone_ids"]} == {job["shard"]}
+
+
+def test_build_shard_jobs_splits_large_shards(monkeypatch):
+
+    monkeypatch.setattr(alert_shards, "SHARD_JOB_MAX_BYTES", 1200)     # about two alerts
+    alerts = [make_alert(f"A{n}", ["FLC127"], description="x" * 400) for n in range(5)]
+
+    jobs = alert_shards.build_shard_jobs(alerts, {"FLC127"}, 4)
+
+    # Assertions
+    assert [len(job["alerts"]) for job in jobs] == [2, 2, 1]
+    assert all(job["zone_ids"] == ["FLC127"] for job in jobs)
+
+
+#================================= Test coordinate_tick() =================================
+
+def test_coordinate_tick_queues_shard_jobs(monkeypatch, stored):
+
+    alerts = [make_alert("A1", ["FLC127", "TXZ001"]), make_alert("A2", ["CAZ041"])]
+    current_alerts = {"A1": "2025-10-22T00:00:00Z", "A2": "2025-10-22T00:00:00Z"}
+    monkeypatch.setattr(alert_shards, "fetch_changed_alerts",
+                        lambda: (alerts, dict(current_alerts), {"FLC127", "TXZ001", "CAZ041"}))
+    mock_send = AsyncMock(return_value=[])
+    monkeypatch.setattr(alert_shards, "send_messages_to_queue", mock_send)
+
+    alert_shards.coordinate_tick(16)
+
+    # Assertions
+    jobs = mock_send.call_args.args[0]
+    assert mock_send.call_args.kwargs["queue_name"] == alert_shards.SHARD_QUEUE_NAME
+    assert sorted(zone_id for job in jobs for zone_id in job["zone_ids"]) == ["CAZ041", "FLC127", "TXZ001"]
+    assert stored["snapshot"] == current_alerts
+
+
+def test_coordinate_tick_retries_unqueued_jobs(monkeypatch, stored, caplog):
+
+    alerts = [make_alert("A1", ["FLC127"]), make_alert("A2", ["CAZ041"])]
+    monkeypatch.setattr(alert_shards, "fetch_changed_alerts",
+                        lambda: (alerts, {"A1": "2025-10-22T00:00:00Z", "A2": "2025-10-22T00:00:00Z"},
+                                 {"FLC127", "CAZ041"}))
+
+    async def fail_a1_jobs(jobs, queue_name=None):
+        failed = [job for job in jobs if job["alerts"][0]["properties"]["id"] == "A1"]
+        return [{"messages": failed, "error": RuntimeError("queue full")}]
+
+    monkeypatch.setattr(alert_shards, "send_messages_to_queue", fail_a1_jobs)
+
+    with caplog.at_level("ERROR"):
+        alert_shards.coordinate_tick(16)
+
+    # Assertions
+    assert "Failed to queue 1 shard jobs: queue full" in caplog.text
+    assert stored["snapshot"] == {"A2": "2025-10-22T00:00:00Z"}         # A1 is queued again next tick
+
+
+def test_coordinate_tick_send_exception(monkeypatch, stored):
+
+    monkeypatch.setattr(alert_shards, "fetch_changed_alerts",
+                        lambda: ([make_alert("A1", ["FLC127"])], {"A1": "2025-10-22T00:00:00Z"}, {"FLC127"}))
+    monkeypatch.setattr(alert_shards, "send_messages_to_queue", AsyncMock(side_effect=RuntimeError("down")))
+
+    alert_shards.coordinate_tick(4)
+
+    # Assertions
+    assert stored["snapshot"] is None
+
+
+#================================= Test run_shard_job() =================================
+
+def test_run_shard_job_fans_out_its_zones(monkeypatch):
+
+    job = {"shard": 3, "shards": 8, "zone_ids": ["FLC127"], "alerts": [make_alert("A1", ["FLC127", "TXZ001"])]}
+    looked_up, fanned_out = [], []
+    monkeypatch.setattr(alert_shards, "resolve_recipients",
+                        lambda alerts, zone_ids: looked_up.append(zone_ids) or ({"user1": {0: "FLC127"}}, {"user1": "a@example.com"}))
+    monkeypatch.setattr(alert_shards, "fan_out", lambda *args: fanned_out.append(args) or set())
+
+    alert_shards.run_shard_job(job)
+
+    # Assertions
+    assert looked_up == [["FLC127"]]                  # only this shard's zones
+    assert fanned_out == [(job["alerts"], {"user1": {0: "FLC127"}}, {"user1": "a@example.com"})]
+
+
+@pytest.mark.parametrize("recipients, retry_alert_ids, message", [
+    # Case 1: subscriber lookup failed
+    (None, set(), "subscriber lookup failed"),
+    # Case 2: dedup writes or the send failed outright
+    (({}, {}), None, "no pairs were recorded or queued"),
+    # Case 3: some alerts need another go
+    (({}, {}), {"A1"}, "1 alerts need a retry"),
+])
+def test_run_shard_job_raises_for_redelivery(monkeypatch, recipients, retry_alert_ids, message):
+
+    job = {"shard": 3, "shards": 8, "zone_ids": ["FLC127"], "alerts": [make_alert("A1", ["FLC127"])]}
+    monkeypatch.setattr(alert_shards, "resolve_recipients", lambda alerts, zone_ids: recipients)
+    monkeypatch.setattr(alert_shards, "fan_out", lambda *args: retry_alert_ids)
+
+    # Assertions
+    with pytest.raises(RuntimeError, match=message):
+        alert_shards.run_shard_job(job)
+
+
+# Shard jobs handled at the same time on two threads of one instance both queue their emails
+def test_run_shard_job_concurrent_jobs(monkeypatch):
+
+    # alert_shards imports alert_worker the way the Functions host does (azfunc/ on the path), not as azfunc.alert_worker
+    alert_worker = sys.modules[alert_shards.fan_out.__module__]
+    both_sending = threading.Barrier(2, timeout=5)
+    sent, loops, errors = [], [], []
+
+    async def fake_send(messages):
+        loops.append(asyncio.get_running_loop())
+        both_sending.wait()                     # the other job is inside its event loop too
+        sent.extend(messages)
+        return []
+
+    monkeypatch.setattr(service_bus_sender, "_worker", threading.local())
+    monkeypatch.setattr(alert_worker, "alert_check_bulk", lambda checks: (list(checks), [], []))
+    monkeypatch.setattr(alert_worker, "send_messages_to_queue", fake_send)
+    monkeypatch.setattr(alert_shards, "resolve_recipients",
+                        lambda alerts, zone_ids: ({f"user-{zone_ids[0]}": {0: zone_ids[0]}},
+                                                  {f"user-{zone_ids[0]}": f"{zone_ids[0]}@example.com"}))
+
+    def handler(zone_id):
+        try:
+            alert_shards.run_shard_job({"shard": 0, "shards": 2, "zone_ids": [zone_id],
+                                        "alerts": [make_alert(f"A-{zone_id}", [zone_id])]})
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=handler, args=(zone_id,)) for zone_id in ["FLC127", "TXZ001"]]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    # Assertions
+    assert errors == []
+    assert sorted(msg["user_id"] for msg in sent) == ["user-FLC127", "user-TXZ001"]
+    assert loops[0] is not loops[1]
+    for loop in loops:
+        loop.close()
@@ -1,6 +1,7 @@
 import pytest
+from datetime import datetime, timedelta, timezone
 from unittest.mock import MagicMock, AsyncMock
-from azure.cosmos.exceptions import CosmosResourceExistsError, CosmosHttpResponseError
+from azure.cosmos.exceptions import CosmosHttpResponseError
 from requests import RequestException
 from azfunc import alert_worker
 
@@ -28,6 +29,32 @@ def make_alert(alert_id, zones):
     }]
 
 
+# Fake alert_check_bulk() where every pair is new
+def record_all(alert_details_list):
+
+    return list(alert_details_list), [], []
+
+
+"""Fixture that replaces the Cosmos-backed alert snapshot with an empty one and records saves."""
+@pytest.fixture(autouse=True)
+def alert_snapshot(monkeypatch):
+
+    saved = []
+    monkeypatch.setattr(alert_worker, "_tick_state", {"complete": False, "fanned_out_at": {}})
+    monkeypatch.setattr(alert_worker, "get_alert_snapshot", lambda: {"alerts": {}, "fanned_out_at": {}, "taken_at": None})
+    monkeypatch.setattr(alert_worker, "save_alert_snapshot", lambda alerts, fanned_out_at: saved.append(alerts))
+    return saved
+
+
+"""Fixture that records which messages get their dedup records released."""
+@pytest.fixture(autouse=True)
+def released_checks(monkeypatch):
+
+    released = []
+    monkeypatch.setattr(alert_worker, "release_alert_checks", lambda messages: released.extend(messages) or [])
+    return released
+
+
 # Tests get_alerts() in case the API raises a RequestException
 def test_get_alerts_api_failure(monkeypatch, caplog):
 
@@ -49,10 +76,31 @@ def test_get_alerts_api_failure(monkeypatch, caplog):
     assert "Failed to fetch NWS alerts: API down!" in caplog.text
 
 
+# Tests get_alerts() when the NWS feed hasn't changed since the last poll
+def test_get_alerts_feed_unchanged(monkeypatch, caplog):
+
+    monkeypatch.setattr(alert_worker, "get_active_alerts", lambda *args, **kwargs: None)
+
+    mock_zone_query = MagicMock()
+    monkeypatch.setattr(alert_worker, "get_zone_to_users", mock_zone_query)
+
+    mock_send = AsyncMock()
+    monkeypatch.setattr(alert_worker, "send_messages_to_queue", mock_send)
+
+    with caplog.at_level("INFO"):
+        result = alert_worker.get_alerts()
+
+    # Assertions
+    assert result is None                           # returned early
+    mock_zone_query.assert_not_called()             # Cosmos never touched
+    mock_send.assert_not_called()                   # nothing sent
+    assert "NWS alerts unchanged since last poll." in caplog.text
+
+
 # Tests get_alerts() in case the API returns no zones affected
 def test_get_alerts_no_affected_zones(monkeypatch, caplog):
 
-    monkeypatch.setattr(alert_worker, "get_active_alerts", lambda: make_alert(alert_id="123", zones=[]))
+    monkeypatch.setattr(alert_worker, "get_active_alerts", lambda *args, **kwargs: make_alert(alert_id="123", zones=[]))
 
     mock_send = AsyncMock()
     monkeypatch.setattr(alert_worker, "send_messages_to_queue", mock_send)
@@ -72,7 +120,7 @@ def test_get_alerts_get_zone_to_users_exception(monkeypatch, caplog):
     def raise_exception(*args, **kwargs):
         raise Exception("DB error!")
 
-    monkeypatch.setattr(alert_worker, "get_active_alerts", lambda: make_alert(alert_id="123", zones=["FLC127"]))
+    monkeypatch.setattr(alert_worker, "get_active_alerts", lambda *args, **kwargs: make_alert(alert_id="123", zones=["FLC127"]))
     monkeypatch.setattr(alert_worker, "get_zone_to_users", raise_exception)
 
     mock_send = AsyncMock()
@@ -93,7 +141,8 @@ def test_get_alerts_get_user_emails(monkeypatch, caplog):
     def raise_exception(*args, **kwargs):
         raise Exception("DB error!")
 
-    monkeypatch.setattr(alert_worker, "get_active_alerts", lambda: make_alert(alert_id="123", zones=["FLC127"]))
+    monkeypatch.setattr(alert_worker, "get_active_alerts", lambda *args, **kwargs: make_alert(alert_id="123", zones=["FLC127"]))
+    monkeypatch.setattr(alert_worker, "get_zone_to_users", lambda *args, **kwargs: {"FLC127": ["user1"]})
     monkeypatch.setattr(alert_worker, "get_user_emails", raise_exception)
 
     mock_send = AsyncMock()
@@ -111,7 +160,7 @@ def test_get_alerts_get_user_emails(monkeypatch, caplog):
 # Tests get_alerts() doesn't send a message when user_email_list is missing an email
 def test_get_alerts_no_emails(monkeypatch):
 
-    monkeypatch.setattr(alert_worker, "get_active_alerts", lambda: make_alert(alert_id="123", zones=["FLC127"]))
+    monkeypatch.setattr(alert_worker, "get_active_alerts", lambda *args, **kwargs: make_alert(alert_id="123", zones=["FLC127"]))
     monkeypatch.setattr(alert_worker, "get_zone_to_users", lambda *args, **kwargs: {"FLC127": ["user1"]})
     monkeypatch.setattr(alert_worker, "get_user_emails", lambda *args, **kwargs: {})
 
@@ -128,10 +177,10 @@ def test_get_alerts_no_emails(monkeypatch):
 # Tests get_alerts() to see if seen_alerts set catches a duplicate alert
 def test_get_alerts_seen_alerts_set(monkeypatch, caplog):
 
-    monkeypatch.setattr(alert_worker, "get_active_alerts", lambda: make_alert(alert_id="123", zones=["FLC127", "FLC127"]))
+    monkeypatch.setattr(alert_worker, "get_active_alerts", lambda *args, **kwargs: make_alert(alert_id="123", zones=["FLC127", "FLC127"]))
     monkeypatch.setattr(alert_worker, "get_zone_to_users", lambda *args, **kwargs: {"FLC127": ["user1"]})
     monkeypatch.setattr(alert_worker, "get_user_emails", lambda *args, **kwargs: {"user1": "user1@example.com"})
-    monkeypatch.setattr(alert_worker, "alert_check", lambda *args, **kwargs: None)
+    monkeypatch.setattr(alert_worker, "alert_check_bulk", record_all)
 
     mock_send = AsyncMock()
     monkeypatch.setattr(alert_worker, "send_messages_to_queue", mock_send)
@@ -151,21 +200,66 @@ def test_get_alerts_seen_alerts_set(monkeypatch, caplog):
     assert f"Queued {count} messages successfully." in caplog.text
 
 
-# Tests get_alerts() for the 3 Cosmos exception branches
-@pytest.mark.parametrize("exception_cls, log_prefix", [
-    (CosmosResourceExistsError, None),
-    (CosmosHttpResponseError, "Cosmos DB error when processing alert"),
-    (Exception, "Unexpected error when processing alert")
+# Tests get_alerts() resolves recipients from the denormalized zone documents without a users query
+def test_get_alerts_zone_subscribers(monkeypatch):
+
+    def fail(*args, **kwargs):
+        raise AssertionError("users container shouldn't be queried")
+
+    monkeypatch.setattr(alert_worker, "ZONE_SUBSCRIBERS_ENABLED", True)
+    monkeypatch.setattr(alert_worker, "get_active_alerts", lambda *args, **kwargs: make_alert(alert_id="123", zones=["FLC127"]))
+    monkeypatch.setattr(alert_worker, "get_zone_subscribers",
+                        lambda *args, **kwargs: ({"FLC127": ["user1"]}, {"user1": "user1@example.com"}))
+    monkeypatch.setattr(alert_worker, "get_zone_to_users", fail)
+    monkeypatch.setattr(alert_worker, "get_user_emails", fail)
+    monkeypatch.setattr(alert_worker, "alert_check_bulk", record_all)
+
+    mock_send = AsyncMock(return_value=[])
+    monkeypatch.setattr(alert_worker, "send_messages_to_queue", mock_send)
+    alert_worker.get_alerts()
+
+    # Assertions
+    sent_messages = mock_send.call_args.args[0]
+    assert [(msg["user_id"], msg["email"]) for msg in sent_messages] == [("user1", "user1@example.com")]
+
+
+# Tests resolve_subscribers() serves the warm cache and falls back to Cosmos when the cache fails
+def test_resolve_subscribers_cache(monkeypatch):
+
+    cache = MagicMock()
+    cache.resolve.side_effect = [({"FLC127": ["user1"]}, {"user1": "user1@example.com"}), Exception("feed error")]
+    monkeypatch.setattr(alert_worker, "SUBSCRIBER_CACHE_ENABLED", True)
+    monkeypatch.setattr(alert_worker, "subscriber_cache", cache)
+    monkeypatch.setattr(alert_worker, "get_zone_to_users", lambda *args, **kwargs: {"FLC127": ["user2"]})
+
+    cached = alert_worker.resolve_subscribers(["FLC127"])
+    fallback = alert_worker.resolve_subscribers(["FLC127"])
+
+    # Assertions
+    assert cached == ({"FLC127": ["user1"]}, {"user1": "user1@example.com"})
+    assert fallback == ({"FLC127": ["user2"]}, None)                    # emails still to be queried
+    cache.clear.assert_called_once()                                    # reloaded from scratch next time
+
+
+# Tests get_alerts() for pairs that already exist and the 2 failure branches reported by alert_check_bulk()
+@pytest.mark.parametrize("error, log_prefix", [
+    (None, None),                                               # already sent on an earlier tick
+    (CosmosHttpResponseError(message="write failed"), "Cosmos DB error when processing alert"),
+    (Exception("write failed"), "Unexpected error when processing alert")
 ])
-def test_get_alerts_exceptions(monkeypatch, caplog, exception_cls, log_prefix):
+def test_get_alerts_exceptions(monkeypatch, caplog, error, log_prefix):
 
-    monkeypatch.setattr(alert_worker, "get_active_alerts", lambda: make_alert(alert_id="123", zones=["FLC127"]))
+    monkeypatch.setattr(alert_worker, "get_active_alerts", lambda *args, **kwargs: make_alert(alert_id="123", zones=["FLC127"]))
     monkeypatch.setattr(alert_worker, "get_zone_to_users", lambda *args, **kwargs: {"FLC127": ["user1"]})
     monkeypatch.setattr(alert_worker, "get_user_emails", lambda *args, **kwargs: {"user1": "user1@example.com"})
 
-    mock_alert_check = MagicMock()
-    mock_alert_check.side_effect = exception_cls
-    monkeypatch.setattr(alert_worker, "alert_check", mock_alert_check)
+    def fake_alert_check_bulk(alert_details_list):
+        if error is None:
+            return [], list(alert_details_list), []
+        return [], [], [(alert_details, error) for alert_details in alert_details_list]
+
+    mock_alert_check_bulk = MagicMock(side_effect=fake_alert_check_bulk)
+    monkeypatch.setattr(alert_worker, "alert_check_bulk", mock_alert_check_bulk)
 
     mock_send = AsyncMock()
     monkeypatch.setattr(alert_worker, "send_messages_to_queue", mock_send)
@@ -173,13 +267,13 @@ def test_get_alerts_exceptions(monkeypatch, caplog, exception_cls, log_prefix):
     with caplog.at_level("ERROR"):
         result = alert_worker.get_alerts()
 
-    alert_id = mock_alert_check.call_args.args[0]["alert_id"]
-    user_id = mock_alert_check.call_args.args[0]["user_id"]
+    alert_id = mock_alert_check_bulk.call_args.args[0][0]["alert_id"]
+    user_id = mock_alert_check_bulk.call_args.args[0][0]["user_id"]
 
     # Assertions
-    mock_alert_check.assert_called_once()   # check that alert_check gets called
-    assert result is None                   # returned early
-    mock_send.assert_not_called()           # nothing sent
+    mock_alert_check_bulk.assert_called_once()   # check that alert_check_bulk gets called
+    assert result is None                        # returned early
+    mock_send.assert_not_called()                # nothing sent
 
     if log_prefix:
         assert f"{log_prefix} {alert_id} for user {user_id}" in caplog.text
@@ -191,10 +285,10 @@ def test_get_alerts_exceptions(monkeypatch, caplog, exception_cls, log_prefix):
 def test_get_alerts_success(monkeypatch, caplog):
 
     alerts = make_alert("123", ["FLC069"]) + make_alert("456", ["FLC127"])
-    monkeypatch.setattr(alert_worker, "get_active_alerts", lambda: alerts)
+    monkeypatch.setattr(alert_worker, "get_active_alerts", lambda *args, **kwargs: alerts)
     monkeypatch.setattr(alert_worker, "get_zone_to_users", lambda *args, **kwargs: {"FLC069": ["user1"], "FLC127": ["user2"]})
     monkeypatch.setattr(alert_worker, "get_user_emails", lambda *args, **kwargs: {"user1": "user1@example.com", "user2": "user2@example.com"})
-    monkeypatch.setattr(alert_worker, "alert_check", lambda *args, **kwargs: None)
+    monkeypatch.setattr(alert_worker, "alert_check_bulk", record_all)
 
     mock_send = AsyncMock()
     monkeypatch.setattr(alert_worker, "send_messages_to_queue", mock_send)
@@ -217,12 +311,12 @@ def test_get_alerts_success(monkeypatch, caplog):
 
 
 # Tests get_alerts() when send_messages_to_queue() raises an exception
-def test_get_alerts_send_messages_exception(monkeypatch, caplog):
+def test_get_alerts_send_messages_exception(monkeypatch, caplog, released_checks):
 
-    monkeypatch.setattr(alert_worker, "get_active_alerts", lambda: make_alert("456", ["FLC127"]))
+    monkeypatch.setattr(alert_worker, "get_active_alerts", lambda *args, **kwargs: make_alert("456", ["FLC127"]))
     monkeypatch.setattr(alert_worker, "get_zone_to_users", lambda *args, **kwargs: {"FLC069": ["user1"], "FLC127": ["user2"]})
     monkeypatch.setattr(alert_worker, "get_user_emails", lambda *args, **kwargs: {"user1": "user1@example.com", "user2": "user2@example.com"})
-    monkeypatch.setattr(alert_worker, "alert_check", lambda *args, **kwargs: None)
+    monkeypatch.setattr(alert_worker, "alert_check_bulk", record_all)
 
     mock_send = AsyncMock()
     mock_send.side_effect = Exception("Service Bus error")
@@ -235,6 +329,340 @@ def test_get_alerts_send_messages_exception(monkeypatch, caplog):
     assert result is None               # returned early
     mock_send.assert_called_once()      # called once and failed
     assert f"Failed to queue messages: Service Bus error" in caplog.text
+    assert [msg["alert_id"] for msg in released_checks] == ["456"]
+
+
+#================================= Test alert snapshot diffing =================================
+
+# Tests diff_alerts() picks out new and superseded alerts and snapshots all of them
+def test_diff_alerts():
+
+    alerts = make_alert("123", ["FLC069"]) + make_alert("456", ["FLC127"]) + make_alert("789", ["FLC117"])
+    alerts[1]["properties"]["sent"] = "2025-10-22T02:00:00Z"
+    previous = {"123": "2025-10-22T00:00:00Z", "456": "2025-10-22T00:00:00Z", "999": "2025-10-21T00:00:00Z"}
+
+    seen = []
+    changed, current = alert_worker.diff_alerts(alerts, previous, seen.append)
+
+    # Assertions
+    assert [alert["properties"]["id"] for alert in changed] == ["456", "789"]     # superseded + new
+    assert seen == changed
+    assert current == {"123": "2025-10-22T00:00:00Z", "456": "2025-10-22T02:00:00Z", "789": "2025-10-22T00:00:00Z"}
+
+
+# Tests get_alerts() skips the fan-out when every alert was fanned out recently and hasn't changed
+def test_get_alerts_nothing_new(monkeypatch, caplog, alert_snapshot):
+
+    fanned_out_at = datetime.now(timezone.utc).isoformat()
+    monkeypatch.setattr(alert_worker, "get_active_alerts", lambda *args, **kwargs: make_alert("123", ["FLC127"]))
+    monkeypatch.setattr(alert_worker, "get_alert_snapshot",
+                        lambda: {"alerts": {"123": "2025-10-22T00:00:00Z"}, "fanned_out_at": {"123": fanned_out_at},
+                                 "taken_at": fanned_out_at})
+
+    mock_zone_query = MagicMock()
+    monkeypatch.setattr(alert_worker, "get_zone_to_users", mock_zone_query)
+
+    with caplog.at_level("INFO"):
+        result = alert_worker.get_alerts()
+
+    # Assertions
+    assert result is None
+    mock_zone_query.assert_not_called()
+    assert "No new or updated NWS alerts since last poll." in caplog.text
+
+
+# Tests get_alerts() fans an unchanged alert out again once its last fan-out is older than the max age
+def test_get_alerts_stale_snapshot(monkeypatch, alert_snapshot):
+
+    fanned_out_at = (datetime.now(timezone.utc) - alert_worker.ALERT_SNAPSHOT_MAX_AGE - timedelta(minutes=1)).isoformat()
+    monkeypatch.setattr(alert_worker, "get_active_alerts", lambda *args, **kwargs: make_alert("123", ["FLC127"]))
+    monkeypatch.setattr(alert_worker, "get_alert_snapshot",
+                        lambda: {"alerts": {"123": "2025-10-22T00:00:00Z"}, "fanned_out_at": {"123": fanned_out_at},
+                                 "taken_at": datetime.now(timezone.utc).isoformat()})
+    monkeypatch.setattr(alert_worker, "get_zone_to_users", lambda *args, **kwargs: {"FLC127": ["user1"]})
+    monkeypatch.setattr(alert_worker, "get_user_emails", lambda *args, **kwargs: {"user1": "user1@example.com"})
+    monkeypatch.setattr(alert_worker, "alert_check_bulk", record_all)
+
+    mock_send = AsyncMock()
+    monkeypatch.setattr(alert_worker, "send_messages_to_queue", mock_send)
+
+    alert_worker.get_alerts()
+
+    # Assertions
+    mock_send.assert_called_once()
+    assert alert_snapshot == [{"123": "2025-10-22T00:00:00Z"}]
+
+
+# A user who subscribes while an alert is active gets it once the alert is due again, even if the feed is unchanged
+def test_get_alerts_late_subscriber(monkeypatch):
+
+    snapshot = {"alerts": {}, "fanned_out_at": {}, "taken_at": None}
+    zone_to_users = {"FLC127": ["user1"]}
+    recorded, sent, conditional = set(), [], []
+
+    def fake_get_active_alerts(*args, skip_unchanged=False, **kwargs):
+        conditional.append(skip_unchanged)
+        return None if skip_unchanged else make_alert("123", ["FLC127"])        # the feed never changes
+
+    def fake_alert_check_bulk(alert_details_list):
+        created = [d for d in alert_details_list if (d["alert_id"], d["user_id"]) not in recorded]
+        recorded.update((d["alert_id"], d["user_id"]) for d in created)
+        return created, [d for d in alert_details_list if d not in created], []
+
+    async def fake_send(messages):
+        sent.append(sorted(msg["user_id"] for msg in messages))
+        return []
+
+    monkeypatch.setattr(alert_worker, "get_alert_snapshot", lambda: snapshot)
+    monkeypatch.setattr(alert_worker, "save_alert_snapshot",
+                        lambda alerts, fanned_out_at: snapshot.update(alerts=alerts, fanned_out_at=fanned_out_at))
+    monkeypatch.setattr(alert_worker, "get_active_alerts", fake_get_active_alerts)
+    monkeypatch.setattr(alert_worker, "get_zone_to_users", lambda zone_ids: dict(zone_to_users))
+    monkeypatch.setattr(alert_worker, "get_user_emails", lambda user_ids: {user_id: f"{user_id}@example.com" for user_id in user_ids})
+    monkeypatch.setattr(alert_worker, "alert_check_bulk", fake_alert_check_bulk)
+    monkeypatch.setattr(alert_worker, "send_messages_to_queue", fake_send)
+
+    alert_worker.get_alerts()
+    zone_to_users["FLC127"] = ["user1", "user2"]                            # user2 subscribes between ticks
+    alert_worker.get_alerts()                                               # 304, the alert isn't due yet
+    first_fan_out = datetime.fromisoformat(snapshot["fanned_out_at"]["123"])
+    snapshot["fanned_out_at"]["123"] = (first_fan_out - alert_worker.ALERT_SNAPSHOT_MAX_AGE - timedelta(minutes=1)).isoformat()
+    alert_worker.get_alerts()
+
+    # Assertions
+    assert conditional == [False, True, False]                              # due alerts skip the 304 shortcut
+    assert sent == [["user1"], ["user2"]]
+    assert datetime.fromisoformat(snapshot["fanned_out_at"]["123"]) >= first_fan_out
+
+
+# Tests get_alerts() leaves alerts with failed dedup writes out of the snapshot so they are retried
+def test_get_alerts_snapshot_skips_failed_alerts(monkeypatch, alert_snapshot):
+
+    alerts = make_alert("123", ["FLC069"]) + make_alert("456", ["FLC127"])
+    monkeypatch.setattr(alert_worker, "get_active_alerts", lambda *args, **kwargs: alerts)
+    monkeypatch.setattr(alert_worker, "get_zone_to_users", lambda *args, **kwargs: {"FLC069": ["user1"], "FLC127": ["user2"]})
+    monkeypatch.setattr(alert_worker, "get_user_emails", lambda *args, **kwargs: {"user1": "user1@example.com", "user2": "user2@example.com"})
+
+    def fake_alert_check_bulk(alert_details_list):
+        created = [details for details in alert_details_list if details["alert_id"] != "456"]
+        failed = [(details, CosmosHttpResponseError(message="Too many requests"))
+                  for details in alert_details_list if details["alert_id"] == "456"]
+        return created, [], failed
+    monkeypatch.setattr(alert_worker, "alert_check_bulk", fake_alert_check_bulk)
+    monkeypatch.setattr(alert_worker, "send_messages_to_queue", AsyncMock())
+
+    alert_worker.get_alerts()
 
+    # Assertions
+    assert alert_snapshot == [{"123": "2025-10-22T00:00:00Z"}]
+
+
+# Tests get_alerts() doesn't let the next tick's 304 skip the alerts that were left out for a retry
+def test_get_alerts_retry_after_failed_alert(monkeypatch, alert_snapshot):
+
+    conditional, queued = [], []
+
+    def fake_get_active_alerts(skip_unchanged=False, **kwargs):
+        conditional.append(skip_unchanged)
+        return None if skip_unchanged else make_alert("123", ["FLC069"]) + make_alert("456", ["FLC127"])
+
+    def fail_456_once(alert_details_list):
+        if len(conditional) > 1:
+            return list(alert_details_list), [], []
+        failed = [(details, CosmosHttpResponseError(message="Too many requests"))
+                  for details in alert_details_list if details["alert_id"] == "456"]
+        return [details for details in alert_details_list if details["alert_id"] != "456"], [], failed
+
+    async def fake_send(messages):
+        queued.extend(msg["alert_id"] for msg in messages)
+        return []
+
+    monkeypatch.setattr(alert_worker, "get_active_alerts", fake_get_active_alerts)
+    monkeypatch.setattr(alert_worker, "get_zone_to_users", lambda *args, **kwargs: {"FLC069": ["user1"], "FLC127": ["user2"]})
+    monkeypatch.setattr(alert_worker, "get_user_emails", lambda *args, **kwargs: {"user1": "user1@example.com", "user2": "user2@example.com"})
+    monkeypatch.setattr(alert_worker, "alert_check_bulk", fail_456_once)
+    monkeypatch.setattr(alert_worker, "send_messages_to_queue", fake_send)
+
+    alert_worker.get_alerts()           # 456 is left out for a retry
+    alert_worker.get_alerts()           # so the feed is read again instead of taking the 304
+    alert_worker.get_alerts()           # everything went out, the 304 is fine now
+
+    # Assertions
+    assert conditional == [False, False, True]
+    assert "456" in queued[1:]
+    assert alert_snapshot[-1] == {"123": "2025-10-22T00:00:00Z", "456": "2025-10-22T00:00:00Z"}
+
+
+# Tests get_alerts() doesn't save a snapshot when queueing fails
+def test_get_alerts_snapshot_not_saved_on_queue_failure(monkeypatch, alert_snapshot):
+
+    monkeypatch.setattr(alert_worker, "get_active_alerts", lambda *args, **kwargs: make_alert("456", ["FLC127"]))
+    monkeypatch.setattr(alert_worker, "get_zone_to_users", lambda *args, **kwargs: {"FLC127": ["user2"]})
+    monkeypatch.setattr(alert_worker, "get_user_emails", lambda *args, **kwargs: {"user2": "user2@example.com"})
+    monkeypatch.setattr(alert_worker, "alert_check_bulk", record_all)
+    monkeypatch.setattr(alert_worker, "send_messages_to_queue", AsyncMock(side_effect=Exception("Service Bus error")))
+
+    alert_worker.get_alerts()
+
+    # Assertions
+    assert alert_snapshot == []
+
+
+#================================= Test streamed feed handling =================================
+
+# Tests get_alerts() consumes a streamed generator and only skips unchanged feeds after a completed tick
+def test_get_alerts_skip_unchanged_after_complete_tick(monkeypatch):
+
+    calls = []
+
+    def fake_get_active_alerts(skip_unchanged=False, stream=False, fields=None):
+        calls.append({"skip_unchanged": skip_unchanged, "stream": stream, "fields": fields})
+        return (alert for alert in make_alert("123", ["FLC127"]))
+
+    monkeypatch.setattr(alert_worker, "get_active_alerts", fake_get_active_alerts)
+    monkeypatch.setattr(alert_worker, "get_zone_to_users", MagicMock(side_effect=Exception("DB error!")))
+
+    alert_worker.get_alerts()           # fails at the zone query
+    alert_worker.get_alerts()           # so this one must not skip an unchanged feed
+    monkeypatch.setattr(alert_worker, "get_zone_to_users", lambda *args, **kwargs: {})
+    monkeypatch.setattr(alert_worker, "get_user_emails", lambda *args, **kwargs: {})
+    alert_worker.get_alerts()           # completes
+    alert_worker.get_alerts()
+
+    # Assertions
+    assert [call["skip_unchanged"] for call in calls] == [False, False, False, True]
+    assert all(call["stream"] and call["fields"] == alert_worker.ALERT_FIELDS for call in calls)
+
+
+# Tests get_alerts() when the streamed feed turns out to be malformed part way through
+def test_get_alerts_stream_error(monkeypatch, caplog):
+
+    def broken_feed(*args, **kwargs):
+        yield make_alert("123", ["FLC127"])[0]
+        raise ValueError("Unexpected end of NWS alerts feed")
+
+    monkeypatch.setattr(alert_worker, "get_active_alerts", lambda *args, **kwargs: broken_feed())
+
+    mock_zone_query = MagicMock()
+    monkeypatch.setattr(alert_worker, "get_zone_to_users", mock_zone_query)
+
+    with caplog.at_level("ERROR"):
+        result = alert_worker.get_alerts()
+
+    # Assertions
+    assert result is None
+    mock_zone_query.assert_not_called()
+    assert "Failed to read NWS alerts: Unexpected end of NWS alerts feed" in caplog.text
 
 
+#================================= Test the fan-out index =================================
+
+# Tests build_alert_index() maps zones and users to alerts, keeping the first matching zone per (alert, user)
+def test_build_alert_index():
+
+    alerts = make_alert("123", ["FLC069", "FLC127", "FLC069"]) + make_alert("456", ["FLC127", "TXZ211"])
+    zone_to_users = {"FLC069": ["user1"], "FLC127": ["user1", "user2"]}
+
+    zone_to_alerts, user_to_alerts = alert_worker.build_alert_index(alerts, zone_to_users)
+
+    # Assertions
+    assert zone_to_alerts == {"FLC069": [0], "FLC127": [0, 1]}          # TXZ211 has no subscribers
+    assert user_to_alerts == {"user1": {0: "FLC069", 1: "FLC127"}, "user2": {0: "FLC127", 1: "FLC127"}}
+
+
+# Tests get_alerts() only looks up users who have an alert and shares the alert payload between recipients
+def test_get_alerts_shared_payload(monkeypatch):
+
+    alerts = make_alert("123", ["FLC069"])
+    monkeypatch.setattr(alert_worker, "get_active_alerts", lambda *args, **kwargs: alerts)
+    monkeypatch.setattr(alert_worker, "get_zone_to_users", lambda *args, **kwargs: {"FLC069": ["user1", "user2"], "FLC127": ["user3"]})
+    mock_emails = MagicMock(return_value={"user1": "user1@example.com", "user2": "user2@example.com"})
+    monkeypatch.setattr(alert_worker, "get_user_emails", mock_emails)
+    monkeypatch.setattr(alert_worker, "alert_check_bulk", record_all)
+
+    mock_send = AsyncMock()
+    monkeypatch.setattr(alert_worker, "send_messages_to_queue", mock_send)
+
+    alert_worker.get_alerts()
+    first, second = mock_send.call_args.args[0]
+
+    # Assertions
+    assert mock_emails.call_args.args[0] == {"user1", "user2"}
+    assert {first["email"], second["email"]} == {"user1@example.com", "user2@example.com"}
+    assert first["description"] is second["description"]               # same string object, not rebuilt
+    assert first["link"] == "http://www.weather.gov"
+
+
+# Tests get_alerts() releases the dedup records of a failed batch and keeps its alert out of the snapshot
+def test_get_alerts_partial_queue_failure(monkeypatch, caplog, alert_snapshot, released_checks):
+
+    alerts = make_alert("123", ["FLC069"]) + make_alert("456", ["FLC127"])
+    monkeypatch.setattr(alert_worker, "get_active_alerts", lambda *args, **kwargs: alerts)
+    monkeypatch.setattr(alert_worker, "get_zone_to_users", lambda *args, **kwargs: {"FLC069": ["user1"], "FLC127": ["user2"]})
+    monkeypatch.setattr(alert_worker, "get_user_emails", lambda *args, **kwargs: {"user1": "user1@example.com", "user2": "user2@example.com"})
+    monkeypatch.setattr(alert_worker, "alert_check_bulk", record_all)
+
+    async def fake_send(messages):
+        return [{"messages": [msg for msg in messages if msg["alert_id"] == "456"], "error": Exception("throttled")}]
+    monkeypatch.setattr(alert_worker, "send_messages_to_queue", fake_send)
+
+    with caplog.at_level("INFO"):
+        alert_worker.get_alerts()
+
+    # Assertions
+    assert "Failed to queue a batch of 1 messages: throttled" in caplog.text
+    assert "Queued 1 messages successfully." in caplog.text
+    assert [(msg["alert_id"], msg["user_id"]) for msg in released_checks] == [("456", "user2")]
+    assert alert_snapshot == [{"123": "2025-10-22T00:00:00Z"}]
+
+
+#================================= Test alert-level queue messages =================================
+
+# Tests get_alerts() queues one copy of the alert per chunk of recipients when QUEUE_MESSAGE_FORMAT is per_alert
+def test_get_alerts_per_alert_messages(monkeypatch, released_checks):
+
+    monkeypatch.setattr(alert_worker, "QUEUE_MESSAGE_FORMAT", "per_alert")
+    monkeypatch.setattr(alert_worker, "RECIPIENTS_PER_MESSAGE", 2)
+    monkeypatch.setattr(alert_worker, "get_active_alerts", lambda *args, **kwargs: make_alert("123", ["FLC069"]))
+    monkeypatch.setattr(alert_worker, "get_zone_to_users", lambda *args, **kwargs: {"FLC069": ["user1", "user2", "user3"]})
+    monkeypatch.setattr(alert_worker, "get_user_emails",
+                        lambda user_ids: {user_id: f"{user_id}@example.com" for user_id in user_ids})
+    monkeypatch.setattr(alert_worker, "alert_check_bulk", record_all)
+
+    async def fake_send(messages):
+        return [{"messages": messages[1:], "error": Exception("throttled")}]
+    mock_send = AsyncMock(side_effect=fake_send)
+    monkeypatch.setattr(alert_worker, "send_messages_to_queue", mock_send)
+
+    alert_worker.get_alerts()
+    messages = mock_send.call_args.args[0]
+
+    # Assertions
+    assert len(messages) == 2
+    assert all(msg["alert_id"] == "123" and msg["description"] == "Seek shelter now." for msg in messages)
+    assert all("email" not in msg for msg in messages)
+    recipients = [recipient for msg in messages for recipient in msg["recipients"]]
+    assert sorted(recipient["email"] for recipient in recipients) == ["user1@example.com", "user2@example.com", "user3@example.com"]
+    assert all(recipient["zone_id"] == "FLC069" for recipient in recipients)
+    assert released_checks == [{"alert_id": "123", "user_id": messages[1]["recipients"][0]["user_id"]}]
+
+
+# per_alert chunks are only queued where a redelivered chunk can't email its recipients twice
+@pytest.mark.parametrize("message_format, dispatch_mode, send_mode, expected", [
+    # Case 1: send_emails waits on each delivery in turn, fall back to one message per user
+    ("per_alert", "trigger", "wait", "per_user"),
+    # Case 2: track mode only submits the sends
+    ("per_alert", "trigger", "track", "per_alert"),
+    # Case 3: the batch dispatcher re-queues only the failed recipients
+    ("per_alert", "batch", "wait", "per_alert"),
+    # Case 4: per_user is always safe
+    ("per_user", "trigger", "wait", "per_user"),
+])
+def test_queue_message_format(caplog, message_format, dispatch_mode, send_mode, expected):
+
+    with caplog.at_level("WARNING"):
+        result = alert_worker.queue_message_format(message_format, dispatch_mode, send_mode)
+
+    # Assertions
+    assert result == expected
+    assert ("queueing per_user messages" in caplog.text) == (message_format != expected)
@@ -4,6 +4,7 @@ from datetime import datetime, timezone
 from azure.cosmos import exceptions
 from app import create_app
 from azfunc.helpers import cosmos_helpers
+from azfunc.helpers.dedup_cache import SentAlertCache
 
 
 @pytest.fixture
@@ -14,6 +15,15 @@ def client():
         yield client
 
 
+"""Fixture that gives each test an empty dedup cache."""
+@pytest.fixture(autouse=True)
+def sent_alert_cache(monkeypatch):
+
+    cache = SentAlertCache(max_size=1000, ttl=60)
+    monkeypatch.setattr(cosmos_helpers, "sent_alert_cache", cache)
+    return cache
+
+
 #================================= Test create_user() =================================
 
 def test_create_user(monkeypatch):
@@ -28,7 +38,7 @@ def test_create_user(monkeypatch):
             created_items.append(body)
 
     # Fake update_zone_subscriptions()
-    def fake_update_zone_subscriptions(zone_id, user_id):
+    def fake_update_zone_subscriptions(zone_id, user_id, email=None):
         updated_zones.append({
             "id": zone_id,
             "user_ids": [user_id]
@@ -63,48 +73,191 @@ def test_create_user(monkeypatch):
 
 
 #================================= Test update_zone_subscriptions() =================================
+'''
+Fake applies the patch the way Cosmos does: 404 for a missing document, 412 when the filter predicate
+doesn't match, 400 when appending to an array the document doesn't have, otherwise apply the operations
+'''
+
+class FakeZonesContainer:
+
+    def __init__(self, zones, create_conflicts=0):
+        self.zones = zones
+        self.create_conflicts = create_conflicts
+        self.calls = []
+
+    def patch_item(self, item, partition_key, patch_operations, filter_predicate=None):
+        self.calls.append("patch")
+        if item not in self.zones:
+            raise exceptions.CosmosResourceNotFoundError()
+        zone = self.zones[item]
+        user_id = patch_operations[0]["value"]
+        assert patch_operations[0] == {"op": "add", "path": "/user_ids/-", "value": user_id}
+        assert filter_predicate.startswith(f'FROM c WHERE NOT ARRAY_CONTAINS(c.user_ids, "{user_id}")')
+        if user_id in zone["user_ids"]:
+            raise exceptions.CosmosAccessConditionFailedError()
+        if filter_predicate.endswith(" AND NOT IS_DEFINED(c.subscribers)") and "subscribers" in zone:
+            raise exceptions.CosmosAccessConditionFailedError()
+        for operation in patch_operations:
+            field = operation["path"].split("/")[1]
+            if operation["op"] == "add" and field not in zone:
+                raise exceptions.CosmosHttpResponseError(status_code=400, message=f"{field} does not exist")
+        for operation in patch_operations:
+            field = operation["path"].split("/")[1]
+            if operation["op"] == "set":
+                zone[field] = operation["value"]
+            else:
+                assert operation["op"] == "add" and operation["path"].endswith("/-")
+                zone[field].append(operation["value"])
+
+    def create_item(self, body):
+        self.calls.append("create")
+        if self.create_conflicts:
+            # Another registration created the zone between our patch and create
+            self.create_conflicts -= 1
+            self.zones[body["id"]] = {"id": body["id"], "user_ids": ["other_user"]}
+            raise exceptions.CosmosResourceExistsError()
+        self.zones[body["id"]] = body
+
+    def read_item(self, item, partition_key):
+        raise AssertionError("subscriptions shouldn't read the zone document")
+
+    def replace_item(self, item, body):
+        raise AssertionError("subscriptions shouldn't replace the zone document")
+
 
 @pytest.mark.parametrize(
-    "updated_zones, zone_id, user_id, expected, expected_replace, expected_create", [
+    "updated_zones, zone_id, user_id, create_conflicts, expected, expected_calls", [
         # Case 1: Existing zone id, new user added
         ({"ABC123": {"id": "ABC123", "user_ids": ["user1"]}, "DEF456": {"id": "DEF456", "user_ids": ["user1", "user2"]}},
-         "ABC123", "user3", {"id": "ABC123", "user_ids": ["user1", "user3"]}, True, False),
+         "ABC123", "user3", 0, {"id": "ABC123", "user_ids": ["user1", "user3"]}, ["patch"]),
         # Case 2: New zone id created
-        ({"ABC123": {"id": "ABC123", "user_ids": ["user1"]}}, "DEF456", "user2", {"id": "DEF456", "user_ids": ["user2"]}, False, True),
+        ({"ABC123": {"id": "ABC123", "user_ids": ["user1"]}}, "DEF456", "user2", 0,
+         {"id": "DEF456", "user_ids": ["user2"], "subscribers": []}, ["patch", "create"]),
         # Case 3: User already present in the zone id (no-op)
-        ({"ABC123": {"id": "ABC123", "user_ids": ["user1"]}}, "ABC123", "user1", {"id": "ABC123", "user_ids": ["user1"]}, False, False)
+        ({"ABC123": {"id": "ABC123", "user_ids": ["user1"]}}, "ABC123", "user1", 0,
+         {"id": "ABC123", "user_ids": ["user1"]}, ["patch"]),
+        # Case 4: Zone created concurrently by another signup, patch it on retry
+        ({}, "DEF456", "user2", 1, {"id": "DEF456", "user_ids": ["other_user", "user2"]}, ["patch", "create", "patch"])
     ]
 )
-def test_update_zone_subscriptions(monkeypatch, updated_zones, zone_id, user_id, expected, expected_replace, expected_create):
+def test_update_zone_subscriptions(monkeypatch, updated_zones, zone_id, user_id, create_conflicts, expected, expected_calls):
 
-    # Track method calls
-    called = {"replace": False, "create": False}
+    container = FakeZonesContainer(updated_zones, create_conflicts)
+    monkeypatch.setattr(cosmos_helpers, "zones_container", container)
+    cosmos_helpers.update_zone_subscriptions(zone_id, user_id)
 
-    # Fake users_container
-    class FakeZonesContainer:
-        def read_item(self, item, partition_key):
-            if item in updated_zones:
-                return updated_zones[item]
+    # Assertions
+    assert updated_zones[zone_id] == expected
+    assert container.calls == expected_calls
+
+
+def test_update_zone_subscriptions_gives_up(monkeypatch):
+
+    # Zone keeps vanishing and reappearing between patch and create
+    class FlappingZonesContainer:
+        def patch_item(self, item, partition_key, patch_operations, filter_predicate=None):
             raise exceptions.CosmosResourceNotFoundError()
 
         def create_item(self, body):
-            called["create"] = True
-            updated_zones[body["id"]] = body
+            raise exceptions.CosmosResourceExistsError()
 
-        def replace_item(self, item, body):
-            called["replace"] = True
-            updated_zones[item] = body
+    monkeypatch.setattr(cosmos_helpers, "zones_container", FlappingZonesContainer())
 
-    monkeypatch.setattr(cosmos_helpers, "zones_container", FakeZonesContainer())
-    cosmos_helpers.update_zone_subscriptions(zone_id, user_id)
+    # Assertions
+    with pytest.raises(RuntimeError):
+        cosmos_helpers.update_zone_subscriptions("ABC123", "user1")
+
+
+def test_update_zone_subscriptions_with_subscribers(monkeypatch):
+
+    zones = {"ABC123": {"id": "ABC123", "user_ids": ["user1"], "subscribers": [{"id": "user1", "email": "user1@email.com"}]}}
+    container = FakeZonesContainer(zones)
+    monkeypatch.setattr(cosmos_helpers, "zones_container", container)
+    monkeypatch.setattr(cosmos_helpers, "ZONE_SUBSCRIBERS_ENABLED", True)
+
+    cosmos_helpers.update_zone_subscriptions("ABC123", "user2", "user2@email.com")
+    cosmos_helpers.update_zone_subscriptions("DEF456", "user2", "user2@email.com")
 
     # Assertions
-    assert updated_zones[zone_id] == expected
-    assert called["replace"] == expected_replace
-    assert called["create"] == expected_create
+    assert zones["ABC123"]["user_ids"] == ["user1", "user2"]
+    assert zones["ABC123"]["subscribers"][-1] == {"id": "user2", "email": "user2@email.com"}
+    assert zones["DEF456"] == {"id": "DEF456", "user_ids": ["user2"],
+                               "subscribers": [{"id": "user2", "email": "user2@email.com"}]}
+
+
+# A zone created before the flag was on and not backfilled gets its subscribers array on the next signup
+def test_update_zone_subscriptions_without_subscribers_array(monkeypatch):
+
+    zones = {"ABC123": {"id": "ABC123", "user_ids": ["user1"]}}
+    container = FakeZonesContainer(zones)
+    monkeypatch.setattr(cosmos_helpers, "zones_container", container)
+    monkeypatch.setattr(cosmos_helpers, "ZONE_SUBSCRIBERS_ENABLED", True)
+
+    cosmos_helpers.update_zone_subscriptions("ABC123", "user2", "user2@email.com")
+    cosmos_helpers.update_zone_subscriptions("ABC123", "user3", "user3@email.com")
+
+    # Assertions
+    assert zones["ABC123"] == {"id": "ABC123", "user_ids": ["user1", "user2", "user3"],
+                               "subscribers": [{"id": "user2", "email": "user2@email.com"},
+                                               {"id": "user3", "email": "user3@email.com"}]}
+    assert container.calls == ["patch", "patch", "patch"]           # 400, set, then a plain append
+
+
+# The array appears between the 400 and the set (backfill ran), the set must not overwrite it
+def test_update_zone_subscriptions_backfilled_meanwhile(monkeypatch):
+
+    zones = {"ABC123": {"id": "ABC123", "user_ids": ["user1"]}}
+    container = FakeZonesContainer(zones)
+    patch_item = container.patch_item
+
+    def backfill_after_400(item, partition_key, patch_operations, filter_predicate=None):
+        try:
+            patch_item(item, partition_key, patch_operations, filter_predicate)
+        except exceptions.CosmosHttpResponseError as e:
+            if e.status_code == 400:
+                zones[item]["subscribers"] = [{"id": "user1", "email": "user1@email.com"}]
+            raise
+
+    container.patch_item = backfill_after_400
+    monkeypatch.setattr(cosmos_helpers, "zones_container", container)
+    monkeypatch.setattr(cosmos_helpers, "ZONE_SUBSCRIBERS_ENABLED", True)
+
+    cosmos_helpers.update_zone_subscriptions("ABC123", "user2", "user2@email.com")
+
+    # Assertions
+    assert zones["ABC123"]["user_ids"] == ["user1", "user2"]
+    assert zones["ABC123"]["subscribers"] == [{"id": "user1", "email": "user1@email.com"},
+                                              {"id": "user2", "email": "user2@email.com"}]
 
 
 #================================= Test get_zone_to_users() =================================
+'''
+Fake read_items() returns what the SDK's CosmosList does: found documents only,
+with the summed request charge in the response headers
+'''
+
+class FakeReadResults(list):
+
+    def __init__(self, docs, request_charge):
+        super().__init__(docs)
+        self.request_charge = request_charge
+
+    def get_response_headers(self):
+        return {"x-ms-request-charge": str(self.request_charge)}
+
+
+class FakeReadContainer:
+
+    def __init__(self, docs):
+        self.docs = docs
+        self.calls = []
+
+    def read_items(self, items, max_concurrency=None):
+        self.calls.append(items)
+        for doc_id, partition_key in items:
+            assert doc_id == partition_key                             # containers are partitioned by /id
+        return FakeReadResults([self.docs[doc_id] for doc_id, _ in items if doc_id in self.docs], len(items) * 1.0)
+
 
 @pytest.mark.parametrize("zone_subscriptions, affected_zone_ids, expected", [
     # Case 1: one zone look up
@@ -112,17 +265,13 @@ def test_update_zone_subscriptions(monkeypatch, updated_zones, zone_id, user_id,
      ["DEF456"], {"DEF456": ["user1", "user2"]}),
     # Case 2: multiple zones look up
     ({"ABC123": {"id": "ABC123", "user_ids": ["user1"]},"DEF456": {"id": "DEF456", "user_ids": ["user1", "user2"]}},
-     ["ABC123", "DEF456"], {"ABC123": ["user1"], "DEF456": ["user1", "user2"]})
+     ["ABC123", "DEF456"], {"ABC123": ["user1"], "DEF456": ["user1", "user2"]}),
+    # Case 3: unknown zones and zones without subscribers are dropped
+    ({"ABC123": {"id": "ABC123", "user_ids": []}}, ["ABC123", "XYZ999"], {})
 ])
 def test_get_zone_to_users(monkeypatch, zone_subscriptions, affected_zone_ids, expected):
 
-    # Fake users_container
-    class FakeZonesContainer:
-        def query_items(self, query, parameters, enable_cross_partition_query=True):
-            requested_ids = parameters[0]["value"]
-            return [zone_subscriptions[zone_id] for zone_id in requested_ids if zone_id in zone_subscriptions]
-
-    monkeypatch.setattr(cosmos_helpers, "zones_container", FakeZonesContainer())
+    monkeypatch.setattr(cosmos_helpers, "zones_container", FakeReadContainer(zone_subscriptions))
     results = cosmos_helpers.get_zone_to_users(affected_zone_ids)
 
     # Assertions
@@ -137,19 +286,112 @@ def test_get_user_emails(monkeypatch):
     users = {"user1": {"id": "user1", "email": "user1@email.com"}, "user2": {"id": "user2", "email": "user2@email.com"},
              "user3": {"id": "user3", "email": "user3@email.com"}}
 
-    class FakeUsersContainer:
-        def query_items(self, query, parameters, enable_cross_partition_query=True):
-            # Going through parameters more closely simulates how the real query would happen
-            requested_ids = set(parameters[0]["value"])
-            return [users[user] for user in requested_ids if user in users]
-
-    monkeypatch.setattr(cosmos_helpers, "users_container", FakeUsersContainer())
+    monkeypatch.setattr(cosmos_helpers, "users_container", FakeReadContainer(users))
     results = cosmos_helpers.get_user_emails(all_user_ids)
 
     # Assertions
     assert results == {"user1": "user1@email.com", "user3": "user3@email.com"}
 
 
+#================================= Test get_zone_subscribers() =================================
+
+def test_get_zone_subscribers(monkeypatch):
+
+    zones = {
+        "ABC123": {"id": "ABC123", "user_ids": ["user1", "user2"],
+                   "subscribers": [{"id": "user1", "email": "user1@email.com"}, {"id": "user2", "email": "user2@email.com"}]},
+        # Not backfilled yet, user3 only exists in user_ids
+        "DEF456": {"id": "DEF456", "user_ids": ["user1", "user3"],
+                   "subscribers": [{"id": "user1", "email": "user1@email.com"}]},
+        "GHI789": {"id": "GHI789", "user_ids": []}
+    }
+    looked_up = []
+
+    def fake_get_user_emails(user_ids):
+        looked_up.append(set(user_ids))
+        return {"user3": "user3@email.com"}
+
+    monkeypatch.setattr(cosmos_helpers, "zones_container", FakeReadContainer(zones))
+    monkeypatch.setattr(cosmos_helpers, "get_user_emails", fake_get_user_emails)
+    zone_to_users, user_emails = cosmos_helpers.get_zone_subscribers(["ABC123", "DEF456", "GHI789"])
+
+    # Assertions
+    assert zone_to_users == {"ABC123": ["user1", "user2"], "DEF456": ["user1", "user3"]}
+    assert user_emails == {"user1": "user1@email.com", "user2": "user2@email.com", "user3": "user3@email.com"}
+    assert looked_up == [{"user3"}]                                     # only the subscriber missing an email
+
+
+#================================= Test backfill_zone_subscribers() =================================
+
+def test_backfill_zone_subscribers(monkeypatch):
+
+    stored = {
+        "ABC123": {"id": "ABC123", "user_ids": ["user1", "user2"], "_etag": "1"},
+        "DEF456": {"id": "DEF456", "user_ids": ["user1"], "subscribers": [{"id": "user1", "email": "user1@email.com"}],
+                   "_etag": "1"},
+    }
+    users = {"user1": "user1@email.com", "user2": "user2@email.com", "user3": "user3@email.com"}
+    replaced = []
+
+    class FakeZonesContainer:
+        def query_items(self, query, enable_cross_partition_query=True):
+            # Snapshot as of the query, ABC123 then changes underneath the backfill
+            docs = [dict(zone) for zone in stored.values()]
+            stored["ABC123"] = {"id": "ABC123", "user_ids": ["user1", "user2", "user3"], "_etag": "2"}
+            return docs
+
+        def read_item(self, item, partition_key):
+            return dict(stored[item])
+
+        def replace_item(self, item, body, etag, match_condition):
+            if stored[item]["_etag"] != etag:
+                raise exceptions.CosmosAccessConditionFailedError()
+            replaced.append(item)
+            stored[item] = {**body, "_etag": str(int(etag) + 1)}
+
+    monkeypatch.setattr(cosmos_helpers, "zones_container", FakeZonesContainer())
+    monkeypatch.setattr(cosmos_helpers, "get_user_emails", lambda user_ids: {u: users[u] for u in user_ids})
+    updated = cosmos_helpers.backfill_zone_subscribers()
+
+    # Assertions
+    assert updated == 1                                                 # DEF456 already complete
+    assert replaced == ["ABC123"]                                       # retried after the ETag conflict
+    assert stored["ABC123"]["subscribers"] == [{"id": "user1", "email": "user1@email.com"},
+                                               {"id": "user2", "email": "user2@email.com"},
+                                               {"id": "user3", "email": "user3@email.com"}]
+
+
+#================================= Test read_by_ids() =================================
+
+def test_read_by_ids_chunks_and_reports(monkeypatch):
+
+    users = {f"user{i}": {"id": f"user{i}", "email": f"user{i}@email.com"} for i in range(5)}
+    container = FakeReadContainer(users)
+    monkeypatch.setattr(cosmos_helpers, "users_container", container)
+    monkeypatch.setattr(cosmos_helpers, "READ_CHUNK_SIZE", 2)
+    monkeypatch.setattr(cosmos_helpers, "read_stats", {})
+
+    docs = cosmos_helpers.read_by_ids("users_container", ["user0", "user1", "user1", "user2", "missing"])
+
+    # Assertions
+    assert [doc["id"] for doc in docs] == ["user0", "user1", "user2"]
+    assert [len(chunk) for chunk in container.calls] == [2, 2]          # duplicates removed, 4 ids in chunks of 2
+    stats = cosmos_helpers.read_stats["users_container"]
+    assert stats["requested"] == 4 and stats["found"] == 3
+    assert stats["request_charge"] == 4.0
+    assert stats["elapsed_ms"] >= 0
+
+
+def test_read_by_ids_empty(monkeypatch):
+
+    container = FakeReadContainer({})
+    monkeypatch.setattr(cosmos_helpers, "users_container", container)
+
+    # Assertions
+    assert cosmos_helpers.read_by_ids("users_container", []) == []
+    assert container.calls == []                                        # no round trip for an empty id set
+
+
 #================================= Test alert_check() =================================
 
 def test_alert_check(monkeypatch):
@@ -176,8 +418,428 @@ def test_alert_check(monkeypatch):
     alert_id = f"{alert_sent_details["alert_id"]}-{alert_sent_details["user_id"]}"
     expected_doc = {
         "id": alert_id,
-        **alert_sent_details
+        **alert_sent_details,
+        "ttl": cosmos_helpers.SENT_ALERT_DEFAULT_TTL                    # no expiry on the alert
     }
 
     # Assertions
-    assert created_items[alert_id] == expected_doc
\ No newline at end of file
+    assert created_items[alert_id] == expected_doc
+
+
+# A cached pair is reported as existing without calling Cosmos, and confirmed pairs get cached
+def test_alert_check_cached(monkeypatch, sent_alert_cache):
+
+    class FakeAlertsContainer():
+        def __init__(self):
+            self.calls = 0
+        def create_item(self, body):
+            self.calls += 1
+
+    container = FakeAlertsContainer()
+    monkeypatch.setattr(cosmos_helpers, "alerts_container", container)
+    details = {"alert_id": "alert1", "user_id": "user1", "email": "user1@example.com", "created_at": None,
+               "sent_at": None, "zone_id": "zone1", "event": None, "link": None}
+
+    cosmos_helpers.alert_check(details)
+
+    # Assertions
+    assert "alert1-user1" in sent_alert_cache
+    with pytest.raises(exceptions.CosmosResourceExistsError):
+        cosmos_helpers.alert_check(details)
+    assert container.calls == 1
+
+
+#================================= Test alert_check_bulk() =================================
+
+def make_details(alert_id, user_id):
+
+    return {
+        "alert_id": alert_id,
+        "user_id": user_id,
+        "email": f"{user_id}@example.com",
+        "created_at": "2025-10-21T18:02:13.782936+00:00",
+        "sent_at": "2025-10-21T18:04:00.000000+00:00",
+        "zone_id": "zone1",
+        "event": "Flood Warning",
+        "link": "http://www.weather.gov"
+    }
+
+
+# Fake sent_alerts container: stored docs by id, plus ids another writer sneaks in right before a batch
+class FakeBulkAlertsContainer:
+
+    def __init__(self, stored=(), racing=(), failing_alert_ids=()):
+        self.docs = {doc_id: {"user_id": doc_id.split("-", 1)[1]} for doc_id in stored}
+        self.racing = set(racing)
+        self.failing_alert_ids = set(failing_alert_ids)
+        self.batches = []
+
+    def query_items(self, query, parameters, partition_key):
+        if partition_key in self.failing_alert_ids:
+            raise exceptions.CosmosHttpResponseError(message="Too many requests")
+        return [doc["user_id"] for doc_id, doc in self.docs.items() if doc_id.startswith(f"{partition_key}-")]
+
+    def execute_item_batch(self, batch_operations, partition_key):
+        self.batches.append((partition_key, len(batch_operations)))
+        bodies = [operation[1][0] for operation in batch_operations]
+        for doc_id in self.racing:
+            self.docs[doc_id] = {}
+        if any(body["id"] in self.docs for body in bodies):
+            raise exceptions.CosmosBatchOperationError(error_index=0, headers={}, status_code=409, message="Conflict")
+        for body in bodies:
+            self.docs[body["id"]] = body
+
+    def create_item(self, body):
+        if body["id"] in self.docs:
+            raise exceptions.CosmosResourceExistsError()
+        self.docs[body["id"]] = body
+
+
+def test_alert_check_bulk(monkeypatch):
+
+    container = FakeBulkAlertsContainer(stored=["alert1-user1"])
+    monkeypatch.setattr(cosmos_helpers, "alerts_container", container)
+
+    pairs = [make_details("alert1", "user1"), make_details("alert1", "user2")] + \
+            [make_details("alert2", f"user{i}") for i in range(150)]
+    created, existing, failed = cosmos_helpers.alert_check_bulk(pairs)
+
+    # Assertions
+    assert [(d["alert_id"], d["user_id"]) for d in existing] == [("alert1", "user1")]
+    assert len(created) == 151 and failed == []
+    assert sorted(container.batches) == [("alert1", 1), ("alert2", 50), ("alert2", 100)]   # grouped and chunked
+    assert container.docs["alert1-user2"] == {"id": "alert1-user2", **make_details("alert1", "user2"),
+                                              "ttl": cosmos_helpers.SENT_ALERT_DEFAULT_TTL}
+
+
+# Cached pairs skip Cosmos entirely and the results of a bulk call are cached for the next tick
+def test_alert_check_bulk_uses_cache(monkeypatch, sent_alert_cache):
+
+    container = FakeBulkAlertsContainer(stored=["alert2-user1"])
+    monkeypatch.setattr(cosmos_helpers, "alerts_container", container)
+    sent_alert_cache.add("alert1-user1")
+
+    created, existing, failed = cosmos_helpers.alert_check_bulk(
+        [make_details("alert1", "user1"), make_details("alert2", "user1"), make_details("alert2", "user2")])
+
+    # Assertions
+    assert [(d["alert_id"], d["user_id"]) for d in existing] == [("alert1", "user1"), ("alert2", "user1")]
+    assert [(d["alert_id"], d["user_id"]) for d in created] == [("alert2", "user2")]
+    assert [partition for partition, _ in container.batches] == ["alert2"]     # alert1 never reached Cosmos
+    assert "alert2-user1" in sent_alert_cache and "alert2-user2" in sent_alert_cache
+
+
+# A batch that loses a race falls back to per-pair creates so each pair is classified exactly once
+def test_alert_check_bulk_race(monkeypatch):
+
+    container = FakeBulkAlertsContainer(racing=["alert1-user2"])
+    monkeypatch.setattr(cosmos_helpers, "alerts_container", container)
+
+    created, existing, failed = cosmos_helpers.alert_check_bulk([make_details("alert1", "user1"), make_details("alert1", "user2")])
+
+    # Assertions
+    assert [d["user_id"] for d in created] == ["user1"]
+    assert [d["user_id"] for d in existing] == ["user2"]
+    assert failed == []
+
+
+# A failing partition is reported pair by pair without affecting the others
+def test_alert_check_bulk_failure(monkeypatch):
+
+    container = FakeBulkAlertsContainer(failing_alert_ids=["alert2"])
+    monkeypatch.setattr(cosmos_helpers, "alerts_container", container)
+
+    created, existing, failed = cosmos_helpers.alert_check_bulk([make_details("alert1", "user1"), make_details("alert2", "user1")])
+
+    # Assertions
+    assert [d["alert_id"] for d in created] == ["alert1"]
+    assert existing == []
+    assert [(d["alert_id"], type(e)) for d, e in failed] == [("alert2", exceptions.CosmosHttpResponseError)]
+
+
+#================================= Test release_alert_checks() =================================
+
+def test_release_alert_checks(monkeypatch, sent_alert_cache):
+
+    deleted = []
+
+    class FakeAlertsContainer:
+        def delete_item(self, item, partition_key):
+            if item == "alert1-user2":
+                raise exceptions.CosmosResourceNotFoundError()
+            if item == "alert1-user3":
+                raise exceptions.CosmosHttpResponseError(message="Too many requests")
+            deleted.append((item, partition_key))
+
+    monkeypatch.setattr(cosmos_helpers, "alerts_container", FakeAlertsContainer())
+    sent_alert_cache.add("alert1-user1")
+
+    not_released = cosmos_helpers.release_alert_checks(
+        [make_details("alert1", "user1"), make_details("alert1", "user2"), make_details("alert1", "user3")])
+
+    # Assertions
+    assert deleted == [("alert1-user1", "alert1")]
+    assert not_released == ["alert1-user3"]                 # already-gone records aren't an error
+    assert "alert1-user1" not in sent_alert_cache
+
+
+#================================= Test sent_alert_ttl() =================================
+
+@pytest.mark.parametrize("expires_at, ends_at, expected", [
+    ("2025-10-22T06:00:00+00:00", None, 6 * 3600 + 100),                # expires in 6 hours
+    ("2025-10-22T06:00:00+00:00", "2025-10-22T12:00:00-04:00", 16 * 3600 + 100),   # the later of the two wins
+    ("2025-10-21T06:00:00+00:00", None, 100),                           # already expired, grace window only
+    (None, None, 5000),                                                 # no expiry, default ttl
+    ("not a date", None, 5000),
+])
+def test_sent_alert_ttl(monkeypatch, expires_at, ends_at, expected):
+
+    monkeypatch.setattr(cosmos_helpers, "SENT_ALERT_TTL_GRACE", 100)
+    monkeypatch.setattr(cosmos_helpers, "SENT_ALERT_DEFAULT_TTL", 5000)
+    now = datetime(2025, 10, 22, tzinfo=timezone.utc)
+
+    # Assertions
+    assert cosmos_helpers.sent_alert_ttl({"expires_at": expires_at, "ends_at": ends_at}, now=now) == expected
+
+
+#================================= Test compact sent_alerts mode =================================
+'''
+Fake compact sent_alerts container: one doc per alert with an ETag bumped on every write.
+racing user ids are added by another writer right after the first read, so the first replace hits a 412
+'''
+
+class FakeCompactAlertsContainer:
+
+    def __init__(self, stored=None, racing=()):
+        self.docs = {alert_id: {"id": alert_id, "alert_id": alert_id, "user_ids": list(user_ids), "_etag": "1"}
+                     for alert_id, user_ids in (stored or {}).items()}
+        self.racing = list(racing)
+        self.writes = []
+
+    def read_item(self, item, partition_key):
+        if item not in self.docs:
+            raise exceptions.CosmosResourceNotFoundError()
+        doc = {**self.docs[item], "user_ids": list(self.docs[item]["user_ids"])}
+        if self.racing:
+            self.docs[item]["user_ids"].extend(self.racing)
+            self.docs[item]["_etag"] += "+"
+            self.racing = []
+        return doc
+
+    def create_item(self, body):
+        if body["id"] in self.docs:
+            raise exceptions.CosmosResourceExistsError()
+        self.writes.append("create")
+        self.docs[body["id"]] = {**body, "_etag": "1"}
+
+    def replace_item(self, item, body, etag, match_condition):
+        if self.docs[item]["_etag"] != etag:
+            raise exceptions.CosmosAccessConditionFailedError()
+        self.writes.append("replace")
+        self.docs[item] = {**body, "_etag": etag + "+"}
+
+
+def test_compact_alert_check_bulk(monkeypatch, sent_alert_cache):
+
+    container = FakeCompactAlertsContainer(stored={"alert1": ["user1"]}, racing=["user2"])
+    monkeypatch.setattr(cosmos_helpers, "alerts_container", container)
+    monkeypatch.setattr(cosmos_helpers, "SENT_ALERTS_MODE", "compact")
+
+    created, existing, failed = cosmos_helpers.alert_check_bulk(
+        [make_details("alert1", "user1"), make_details("alert1", "user2"), make_details("alert1", "user3"),
+         make_details("alert2", "user1")])
+
+    # Assertions
+    assert sorted((d["alert_id"], d["user_id"]) for d in created) == [("alert1", "user3"), ("alert2", "user1")]
+    assert [(d["alert_id"], d["user_id"]) for d in existing] == [("alert1", "user1"), ("alert1", "user2")]
+    assert failed == []
+    assert container.docs["alert1"]["user_ids"] == ["user1", "user2", "user3"]      # racing writer's id kept
+    assert container.docs["alert2"]["user_ids"] == ["user1"]
+    assert container.docs["alert2"]["ttl"] == cosmos_helpers.SENT_ALERT_DEFAULT_TTL
+    assert "alert1-user3" in sent_alert_cache
+
+
+def test_compact_alert_check(monkeypatch):
+
+    container = FakeCompactAlertsContainer()
+    monkeypatch.setattr(cosmos_helpers, "alerts_container", container)
+    monkeypatch.setattr(cosmos_helpers, "SENT_ALERTS_MODE", "compact")
+    monkeypatch.setattr(cosmos_helpers, "sent_alert_cache", None)
+
+    cosmos_helpers.alert_check(make_details("alert1", "user1"))
+
+    # Assertions
+    with pytest.raises(exceptions.CosmosResourceExistsError):
+        cosmos_helpers.alert_check(make_details("alert1", "user1"))       # same semantics as per-user docs
+    assert container.writes == ["create"]
+
+
+def test_compact_release_alert_checks(monkeypatch, sent_alert_cache):
+
+    container = FakeCompactAlertsContainer(stored={"alert1": ["user1", "user2", "user3"]})
+    monkeypatch.setattr(cosmos_helpers, "alerts_container", container)
+    monkeypatch.setattr(cosmos_helpers, "SENT_ALERTS_MODE", "compact")
+    sent_alert_cache.add("alert1-user1")
+
+    not_released = cosmos_helpers.release_alert_checks(
+        [make_details("alert1", "user1"), make_details("alert1", "user3"), make_details("alert9", "user1")])
+
+    # Assertions
+    assert not_released == []                                           # missing record isn't an error
+    assert container.docs["alert1"]["user_ids"] == ["user2"]
+    assert "alert1-user1" not in sent_alert_cache
+
+
+# Alerts with more recipients than a page holds spill over into further pages instead of one oversized doc
+def test_compact_alert_check_pages(monkeypatch, sent_alert_cache):
+
+    container = FakeCompactAlertsContainer()
+    monkeypatch.setattr(cosmos_helpers, "alerts_container", container)
+    monkeypatch.setattr(cosmos_helpers, "SENT_ALERTS_MODE", "compact")
+    monkeypatch.setattr(cosmos_helpers, "SENT_ALERT_COMPACT_PAGE_SIZE", 3)
+
+    created, _, _ = cosmos_helpers.alert_check_bulk([make_details("alert1", f"user{n}") for n in range(7)])
+    sent_alert_cache.clear()
+    created_again, existing_again, _ = cosmos_helpers.alert_check_bulk(
+        [make_details("alert1", f"user{n}") for n in [0, 5, 7, 8]])
+    not_released = cosmos_helpers.release_alert_checks([make_details("alert1", "user1"), make_details("alert1", "user8")])
+
+    # Assertions
+    assert len(created) == 7
+    assert [d["user_id"] for d in created_again] == ["user7", "user8"]
+    assert [d["user_id"] for d in existing_again] == ["user0", "user5"]
+    assert not_released == []
+    assert {doc_id: doc["user_ids"] for doc_id, doc in container.docs.items()} == {
+        "alert1": ["user0", "user2"], "alert1~1": ["user3", "user4", "user5"], "alert1~2": ["user6", "user7"]}
+
+
+#================================= Test get_alert_snapshot() and save_alert_snapshot() =================================
+
+def test_alert_snapshot_round_trip(monkeypatch):
+
+    stored = {}
+
+    class FakeStateContainer:
+        def read_item(self, item, partition_key):
+            if item in stored:
+                return stored[item]
+            raise exceptions.CosmosResourceNotFoundError()
+
+        def upsert_item(self, body):
+            stored[body["id"]] = body
+
+    monkeypatch.setattr(cosmos_helpers, "state_container", FakeStateContainer())
+
+    # First run has no snapshot yet
+    assert cosmos_helpers.get_alert_snapshot() == {"alerts": {}, "fanned_out_at": {}, "taken_at": None}
+
+    cosmos_helpers.save_alert_snapshot({"alert1": "2025-10-22T00:00:00Z"}, {"alert1": "2025-10-22T00:05:00Z"})
+    snapshot = cosmos_helpers.get_alert_snapshot()
+
+    # Assertions
+    assert snapshot["alerts"] == {"alert1": "2025-10-22T00:00:00Z"}
+    assert snapshot["fanned_out_at"] == {"alert1": "2025-10-22T00:05:00Z"}
+    datetime.fromisoformat(snapshot["taken_at"])
+
+
+#================================= Test email operation tracking =================================
+
+def test_email_operations(monkeypatch):
+
+    created, patched = [], []
+
+    class FakeEmailOperationsContainer:
+        def create_item(self, body):
+            created.append(body)
+
+        def query_items(self, query, parameters, enable_cross_partition_query=True):
+            return [doc for doc in created if doc["status"] == "Running"][:parameters[0]["value"]]
+
+        def patch_item(self, item, partition_key, patch_operations):
+            patched.append((item, partition_key, {op["path"]: op["value"] for op in patch_operations}))
+
+    monkeypatch.setattr(cosmos_helpers, "email_operations_container", FakeEmailOperationsContainer())
+    cosmos_helpers.record_email_operation("op1", "user1@example.com", "alert1")
+    pending = cosmos_helpers.get_pending_email_operations(max_items=10)
+    cosmos_helpers.update_email_operation("op1", "Failed", {"code": "Bounced"})
+
+    # Assertions
+    assert pending == [{"id": "op1", "to": "user1@example.com", "alert_id": "alert1", "status": "Running",
+                        "submitted_at": created[0]["submitted_at"]}]
+    assert patched[0][:2] == ("op1", "op1")
+    assert patched[0][2]["/status"] == "Failed" and patched[0][2]["/error"] == {"code": "Bounced"}
+
+
+#================================= Test lazy container access =================================
+
+def test_get_container_is_lazy_and_cached(monkeypatch):
+
+    created_clients = []
+
+    class FakeCosmosClient:
+        def __init__(self, endpoint, key):
+            created_clients.append(self)
+            self.database_ids = []
+
+        def get_database_client(self, database_id):
+            self.database_ids.append(database_id)
+            return FakeDatabase()
+
+    class FakeDatabase:
+        def get_container_client(self, container_id):
+            return {"id": container_id}
+
+    monkeypatch.setattr(cosmos_helpers, "CosmosClient", FakeCosmosClient)
+    monkeypatch.setattr(cosmos_helpers, "client", None)
+    monkeypatch.setattr(cosmos_helpers, "database", None)
+    monkeypatch.setattr(cosmos_helpers, "users_container", None)
+    monkeypatch.setattr(cosmos_helpers, "alerts_container", None)
+
+    first = cosmos_helpers.get_container("users_container")
+    second = cosmos_helpers.get_container("users_container")
+    alerts = cosmos_helpers.get_container("alerts_container")
+
+    # Assertions
+    assert first is second                                              # proxy cached for the process
+    assert first == {"id": "users"} and alerts == {"id": "sent_alerts"}
+    assert len(created_clients) == 1                                    # one client shared by every container
+    assert created_clients[0].database_ids == ["weather_app_db"]
+
+
+def test_provision_cosmos_creates_every_container(monkeypatch):
+
+    created, replaced = [], []
+
+    class FakeContainer:
+        def __init__(self, id):
+            self.id = id
+
+        def read(self):
+            # sent_alerts already existed without TTL
+            return {"id": self.id} if self.id == "sent_alerts" else {"id": self.id, "defaultTtl": 7 * 24 * 60 * 60}
+
+    class FakeDatabase:
+        def create_container_if_not_exists(self, id, partition_key, **options):
+            created.append((id, partition_key["paths"][0], options))
+            return FakeContainer(id)
+
+        def replace_container(self, container, partition_key, default_ttl):
+            replaced.append((container.id, default_ttl))
+
+    class FakeCosmosClient:
+        def __init__(self, endpoint, key):
+            pass
+
+        def create_database_if_not_exists(self, id):
+            assert id == "weather_app_db"
+            return FakeDatabase()
+
+    monkeypatch.setattr(cosmos_helpers, "CosmosClient", FakeCosmosClient)
+    cosmos_helpers.provision_cosmos()
+
+    # Assertions
+    assert [container_id for container_id, _, _ in created] == \
+        ["users", "zone_subscriptions", "sent_alerts", "poll_state", "email_operations"]
+    assert ("sent_alerts", "/alert_id", {"default_ttl": -1}) in created
+    assert created[-1][2] == {"default_ttl": 7 * 24 * 60 * 60}
+    assert replaced == [("sent_alerts", -1)]                            # TTL turned on for the existing container
@@ -0,0 +1,108 @@
+import pytest
+from azfunc.helpers import dedup_cache
+
+
+# Manually advanced clock so TTLs can be tested without sleeping
+class FakeClock:
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+#================================= Test SentAlertCache =================================
+
+def test_sent_alert_cache_lru_eviction():
+
+    cache = dedup_cache.SentAlertCache(max_size=2, ttl=60)
+    cache.add("alert1-user1")
+    cache.add("alert1-user2")
+    assert "alert1-user1" in cache          # touching it makes alert1-user2 the oldest
+    cache.add("alert1-user3")
+
+    # Assertions
+    assert len(cache) == 2
+    assert "alert1-user1" in cache
+    assert "alert1-user2" not in cache
+    assert "alert1-user3" in cache
+
+
+def test_sent_alert_cache_ttl():
+
+    clock = FakeClock()
+    cache = dedup_cache.SentAlertCache(max_size=10, ttl=60, clock=clock)
+    cache.add("alert1-user1")
+
+    clock.now = 59
+    assert "alert1-user1" in cache
+    clock.now = 60
+
+    # Assertions
+    assert "alert1-user1" not in cache
+    assert len(cache) == 0                  # expired entries are dropped on lookup
+
+
+def test_sent_alert_cache_discard():
+
+    cache = dedup_cache.SentAlertCache(max_size=10, ttl=60)
+    cache.add("alert1-user1")
+    cache.discard("alert1-user1")
+    cache.discard("never-added")
+
+    # Assertions
+    assert "alert1-user1" not in cache
+
+
+#================================= Test BloomSentAlertCache =================================
+
+def test_bloom_cache_membership_and_error_rate():
+
+    cache = dedup_cache.BloomSentAlertCache(capacity=5000, error_rate=0.01, ttl=60)
+    for i in range(5000):
+        cache.add(f"alert1-user{i}")
+
+    false_positives = sum(f"alert2-user{i}" in cache for i in range(5000))
+
+    # Assertions
+    assert all(f"alert1-user{i}" in cache for i in range(5000))     # no false negatives
+    assert false_positives < 5000 * 0.02                              # close to the configured rate
+
+
+def test_bloom_cache_rotation():
+
+    clock = FakeClock()
+    cache = dedup_cache.BloomSentAlertCache(capacity=100, error_rate=0.001, ttl=60, clock=clock)
+    cache.add("alert1-user1")
+
+    clock.now = 60
+    assert "alert1-user1" in cache          # moved to the previous generation
+    clock.now = 120
+
+    # Assertions
+    assert "alert1-user1" not in cache      # dropped after two rotations
+
+
+def test_bloom_cache_discard_clears_everything():
+
+    cache = dedup_cache.BloomSentAlertCache(capacity=100, error_rate=0.001, ttl=60)
+    cache.add("alert1-user1")
+    cache.add("alert1-user2")
+    cache.discard("alert1-user1")
+
+    # Assertions
+    assert "alert1-user1" not in cache
+    assert "alert1-user2" not in cache
+
+
+#================================= Test build_sent_alert_cache() =================================
+
+@pytest.mark.parametrize("mode, expected_type", [
+    ("lru", dedup_cache.SentAlertCache),
+    ("bloom", dedup_cache.BloomSentAlertCache),
+    ("off", type(None))
+])
+def test_build_sent_alert_cache(mode, expected_type):
+
+    assert isinstance(dedup_cache.build_sent_alert_cache(mode), expected_type)
@@ -0,0 +1,346 @@
+import pytest
+import asyncio
+import json
+import time
+from collections import OrderedDict
+from unittest.mock import MagicMock, AsyncMock
+from azure.core.exceptions import HttpResponseError
+from azure.servicebus.exceptions import MessageLockLostError
+from azfunc.helpers import email_dispatcher, email_sender
+
+
+"""Fixture that starts every test with an empty rendered email cache and wait-mode sends."""
+@pytest.fixture(autouse=True)
+def reset_dispatcher(monkeypatch):
+
+    monkeypatch.setattr(email_sender, "_rendered_emails", OrderedDict())
+    monkeypatch.setattr(email_dispatcher, "EMAIL_SEND_MODE", "wait")
+
+
+class FakeClock:
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class FakePoller:
+
+    def __init__(self, status="Succeeded"):
+        self.status = status
+
+    async def result(self):
+        return {"status": self.status}
+
+
+"""
+Stand-in for the aio ACS EmailClient. outcomes maps an address to a list of results handed out
+in order: a status string for a finished send or an exception to raise from begin_send
+"""
+class FakeEmailClient:
+
+    def __init__(self, outcomes=None):
+        self.outcomes = outcomes or {}
+        self.sent = []
+
+    async def begin_send(self, message, **kwargs):
+        address = message["recipients"]["to"][0]["address"]
+        self.sent.append((address, kwargs))
+        queued = self.outcomes.get(address)
+        outcome = queued.pop(0) if queued else "Succeeded"
+        if isinstance(outcome, Exception):
+            raise outcome
+        return FakePoller(outcome)
+
+
+class FakeReceivedMessage:
+
+    def __init__(self, body, message_id="m1"):
+        self.body = body
+        self.message_id = message_id
+
+    def __str__(self):
+        return json.dumps(self.body)
+
+
+def throttled(retry_after="0"):
+
+    response = MagicMock(status_code=429, headers={"Retry-After": retry_after})
+    error = HttpResponseError(message="Too many requests", response=response)
+    error.status_code = 429
+    return error
+
+
+def open_limiter():
+    return email_dispatcher.TokenBucket(rate=1000, capacity=1000)
+
+
+#================================= Test TokenBucket =================================
+
+@pytest.mark.asyncio
+async def test_token_bucket_waits_for_refill(monkeypatch):
+
+    clock = FakeClock()
+    sleeps = []
+
+    async def fake_sleep(seconds):
+        sleeps.append(seconds)
+        clock.now += seconds
+
+    monkeypatch.setattr(email_dispatcher.asyncio, "sleep", fake_sleep)
+    bucket = email_dispatcher.TokenBucket(rate=2, capacity=2, clock=clock)
+
+    for _ in range(3):
+        await bucket.acquire()
+
+    # Assertions
+    assert sleeps == [0.5]                                              # burst of 2 free, third waits one refill interval
+
+
+@pytest.mark.asyncio
+async def test_token_bucket_pause_holds_callers(monkeypatch):
+
+    clock = FakeClock()
+    sleeps = []
+
+    async def fake_sleep(seconds):
+        sleeps.append(seconds)
+        clock.now += seconds
+
+    monkeypatch.setattr(email_dispatcher.asyncio, "sleep", fake_sleep)
+    bucket = email_dispatcher.TokenBucket(rate=1, capacity=5, clock=clock)
+
+    bucket.pause(10)
+    await bucket.acquire()
+
+    # Assertions
+    assert sleeps == [10, 1]                                            # waits out the pause, then for a fresh token
+
+
+# A token that only comes after the deadline isn't waited for
+@pytest.mark.asyncio
+async def test_token_bucket_deadline(monkeypatch):
+
+    clock = FakeClock()
+    sleeps = []
+
+    async def fake_sleep(seconds):
+        sleeps.append(seconds)
+        clock.now += seconds
+
+    monkeypatch.setattr(email_dispatcher.asyncio, "sleep", fake_sleep)
+    bucket = email_dispatcher.TokenBucket(rate=0.5, capacity=2, clock=clock)
+    sends_left = bucket.tokens_before(5)
+
+    results = [await bucket.acquire(deadline=5) for _ in range(5)]
+
+    # Assertions
+    assert sends_left == 4                                              # burst of 2, then one every 2 s
+    assert results == [True, True, True, True, False]
+    assert sleeps == [2, 2]
+
+
+#================================= Test retry_after_seconds() =================================
+
+@pytest.mark.parametrize("headers, attempt, expected", [
+    ({"Retry-After": "7"}, 0, 7.0),                                     # seconds header
+    ({"retry-after-ms": "1500"}, 0, 1.5),                               # milliseconds header wins
+    ({}, 3, 8.0),                                                       # no header, exponential backoff
+    ({"Retry-After": "Wed, 21 Oct 2015 07:28:00 GMT"}, 1, 2.0),         # date form falls back to backoff
+])
+def test_retry_after_seconds(headers, attempt, expected):
+
+    error = MagicMock(response=MagicMock(headers=headers))
+
+    # Assertions
+    assert email_dispatcher.retry_after_seconds(error, attempt) == expected
+
+
+#================================= Test send_email_async() =================================
+
+@pytest.mark.asyncio
+async def test_send_email_async_retries_after_throttle():
+
+    client = FakeEmailClient({"a@example.com": [throttled("0"), "Succeeded"]})
+    limiter = open_limiter()
+    limiter.pause = MagicMock()
+
+    sent, operation_id = await email_dispatcher.send_email_async(
+        client, limiter, asyncio.Semaphore(1), email_sender.build_acs_message("a@example.com", "s", "p", "h"))
+
+    # Assertions
+    assert sent is True
+    assert operation_id is None
+    assert len(client.sent) == 2                                        # throttled once, then sent
+    limiter.pause.assert_called_once_with(0.0)                          # Retry-After paused the shared limiter
+
+
+@pytest.mark.asyncio
+async def test_send_email_async_gives_up_after_max_attempts(monkeypatch):
+
+    monkeypatch.setattr(email_dispatcher, "ACS_MAX_ATTEMPTS", 2)
+    client = FakeEmailClient({"a@example.com": [throttled("0"), throttled("0"), "Succeeded"]})
+
+    sent, _ = await email_dispatcher.send_email_async(
+        client, open_limiter(), asyncio.Semaphore(1), email_sender.build_acs_message("a@example.com", "s", "p", "h"))
+
+    # Assertions
+    assert sent is False
+    assert len(client.sent) == 2
+
+
+@pytest.mark.asyncio
+async def test_send_email_async_other_errors_not_retried():
+
+    error = HttpResponseError(message="Bad request")
+    error.status_code = 400
+    client = FakeEmailClient({"a@example.com": [error]})
+
+    sent, _ = await email_dispatcher.send_email_async(
+        client, open_limiter(), asyncio.Semaphore(1), email_sender.build_acs_message("a@example.com", "s", "p", "h"))
+
+    # Assertions
+    assert sent is False
+    assert len(client.sent) == 1
+
+
+@pytest.mark.asyncio
+async def test_send_email_async_track_mode_submits_without_polling(monkeypatch):
+
+    monkeypatch.setattr(email_dispatcher, "EMAIL_SEND_MODE", "track")
+    client = FakeEmailClient()
+
+    sent, operation_id = await email_dispatcher.send_email_async(
+        client, open_limiter(), asyncio.Semaphore(1), email_sender.build_acs_message("a@example.com", "s", "p", "h"))
+
+    # Assertions
+    assert sent is True
+    assert client.sent[0][1] == {"operation_id": operation_id, "polling": False}
+
+
+#================================= Test process_message() =================================
+
+@pytest.mark.asyncio
+async def test_process_message_sends_to_every_recipient():
+
+    client = FakeEmailClient()
+    body = json.dumps({"alert_id": "A1", "event": "Flood Warning",
+                       "recipients": [{"user_id": "u1", "email": "a@example.com"},
+                                      {"user_id": "u2", "email": "b@example.com"}]})
+
+    result = await email_dispatcher.process_message(client, open_limiter(), asyncio.Semaphore(2), body)
+
+    # Assertions
+    assert result is True
+    assert sorted(address for address, _ in client.sent) == ["a@example.com", "b@example.com"]
+
+
+@pytest.mark.asyncio
+async def test_process_message_requeues_only_failed_recipients(monkeypatch):
+
+    requeue = AsyncMock(return_value=[])
+    monkeypatch.setattr(email_dispatcher, "send_messages_to_queue", requeue)
+    client = FakeEmailClient({"b@example.com": ["Failed"]})
+    body = json.dumps({"alert_id": "A1", "event": "Flood Warning",
+                       "recipients": [{"user_id": "u1", "email": "a@example.com"},
+                                      {"user_id": "u2", "email": "b@example.com"}]})
+
+    result = await email_dispatcher.process_message(client, open_limiter(), asyncio.Semaphore(2), body)
+
+    # Assertions
+    assert result is True                                               # original can be completed
+    requeued = requeue.call_args[0][0]
+    assert requeued[0]["recipients"] == [{"user_id": "u2", "email": "b@example.com"}]
+
+
+@pytest.mark.asyncio
+async def test_process_message_single_email_failure():
+
+    client = FakeEmailClient({"a@example.com": ["Failed"]})
+    body = json.dumps({"alert_id": "A1", "email": "a@example.com", "event": "Flood Warning"})
+
+    result = await email_dispatcher.process_message(client, open_limiter(), asyncio.Semaphore(1), body)
+
+    # Assertions
+    assert result is False                                              # left for redelivery
+
+
+@pytest.mark.asyncio
+async def test_process_message_track_mode_records_operations(monkeypatch):
+
+    monkeypatch.setattr(email_dispatcher, "EMAIL_SEND_MODE", "track")
+    record = MagicMock()
+    monkeypatch.setattr(email_dispatcher, "record_email_operation", record)
+    body = json.dumps({"alert_id": "A1", "email": "a@example.com", "event": "Flood Warning"})
+
+    result = await email_dispatcher.process_message(FakeEmailClient(), open_limiter(), asyncio.Semaphore(1), body)
+
+    # Assertions
+    assert result is True
+    operation_id, email, alert_id = record.call_args[0]
+    assert (email, alert_id) == ("a@example.com", "A1")
+
+
+#================================= Test dispatch_messages() =================================
+
+@pytest.mark.asyncio
+async def test_dispatch_messages_settles_each_message():
+
+    receiver = MagicMock(complete_message=AsyncMock(), abandon_message=AsyncMock())
+    client = FakeEmailClient({"bad@example.com": ["Failed"]})
+    good = FakeReceivedMessage({"alert_id": "A1", "email": "good@example.com", "event": "x"}, "m1")
+    bad = FakeReceivedMessage({"alert_id": "A1", "email": "bad@example.com", "event": "x"}, "m2")
+    broken = MagicMock(message_id="m3", __str__=lambda self: "not json")
+
+    counts = await email_dispatcher.dispatch_messages(
+        receiver, client, [good, bad, broken], open_limiter(), asyncio.Semaphore(2))
+
+    # Assertions
+    assert counts == {"completed": 1, "abandoned": 2, "unsettled": 0}
+    receiver.complete_message.assert_awaited_once_with(good)
+    assert [call.args[0] for call in receiver.abandon_message.await_args_list] == [bad, broken]
+
+
+# Only the messages whose recipients can be sent before the deadline are started, the rest go back untouched
+@pytest.mark.asyncio
+async def test_dispatch_messages_counts_recipients_against_deadline():
+
+    receiver = MagicMock(complete_message=AsyncMock(), abandon_message=AsyncMock())
+    client = FakeEmailClient()
+    chunk = FakeReceivedMessage({"alert_id": "A1", "event": "x", "recipients": [
+        {"user_id": f"u{n}", "email": f"u{n}@example.com"} for n in range(3)]}, "m1")
+    single = FakeReceivedMessage({"alert_id": "A1", "email": "a@example.com", "event": "x"}, "m2")
+    later = FakeReceivedMessage({"alert_id": "A1", "email": "b@example.com", "event": "x"}, "m3")
+    limiter = email_dispatcher.TokenBucket(rate=0.001, capacity=4)      # 4 sends left before the deadline
+
+    counts = await email_dispatcher.dispatch_messages(
+        receiver, client, [chunk, single, later], limiter, asyncio.Semaphore(2), deadline=time.monotonic() + 60)
+
+    # Assertions
+    assert counts == {"completed": 2, "abandoned": 1, "unsettled": 0}
+    assert sorted(address for address, _ in client.sent) == ["a@example.com", "u0@example.com", "u1@example.com",
+                                                             "u2@example.com"]
+    receiver.abandon_message.assert_awaited_once_with(later)
+
+
+# A lost lock on one message is logged and the others are still settled
+@pytest.mark.asyncio
+async def test_dispatch_messages_lock_lost(caplog):
+
+    first = FakeReceivedMessage({"alert_id": "A1", "email": "a@example.com", "event": "x"}, "m1")
+    second = FakeReceivedMessage({"alert_id": "A1", "email": "b@example.com", "event": "x"}, "m2")
+
+    async def complete(message):
+        if message is first:
+            raise MessageLockLostError(message="lock expired")
+    receiver = MagicMock(complete_message=AsyncMock(side_effect=complete), abandon_message=AsyncMock())
+
+    with caplog.at_level("ERROR"):
+        counts = await email_dispatcher.dispatch_messages(
+            receiver, FakeEmailClient(), [first, second], open_limiter(), asyncio.Semaphore(2))
+
+    # Assertions
+    assert counts == {"completed": 1, "abandoned": 0, "unsettled": 1}
+    assert "Failed to settle queue message m1, it will be redelivered" in caplog.text
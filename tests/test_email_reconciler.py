@@ -0,0 +1,71 @@
+from datetime import datetime, timedelta, timezone
+from azure.core.exceptions import HttpResponseError
+from azfunc import email_reconciler
+
+
+# HttpResponseError the way raise_for_status() builds it, with the response's status code
+def http_error(message, status_code):
+
+    error = HttpResponseError(message)
+    error.status_code = status_code
+    return error
+
+
+def make_operation(operation_id, hours_ago=0):
+
+    submitted_at = datetime.now(timezone.utc) - timedelta(hours=hours_ago)
+    return {"id": operation_id, "to": f"{operation_id}@example.com", "status": "Running",
+            "submitted_at": submitted_at.isoformat()}
+
+
+#================================= Test reconcile_email_sends() =================================
+
+def test_reconcile_email_sends(monkeypatch, caplog):
+
+    pending = [make_operation("ok"), make_operation("bounced"), make_operation("running"),
+               make_operation("stuck", hours_ago=48), make_operation("gone"), make_operation("acs_down"),
+               make_operation("acs_down_old", hours_ago=48)]
+    statuses = {
+        "ok": {"status": "Succeeded"},
+        "bounced": {"status": "Failed", "error": {"code": "Bounced"}},
+        "running": {"status": "Running"},
+        "stuck": {"status": "Running"}
+    }
+    updates = []
+
+    def fake_status(operation_id):
+        if operation_id == "gone":
+            raise http_error("Operation not found", 404)
+        if operation_id in ("acs_down", "acs_down_old"):
+            raise http_error("Service down", 503)
+        return statuses[operation_id]
+
+    monkeypatch.setattr(email_reconciler, "get_pending_email_operations", lambda max_items: pending)
+    monkeypatch.setattr(email_reconciler, "get_email_send_status", fake_status)
+    monkeypatch.setattr(email_reconciler, "update_email_operation",
+                        lambda operation_id, status, error=None: updates.append((operation_id, status)))
+
+    with caplog.at_level("INFO"):
+        email_reconciler.reconcile_email_sends()
+
+    # Assertions
+    assert updates == [("ok", "Succeeded"), ("bounced", "Failed"), ("stuck", "Unknown"), ("gone", "Unknown"),
+                       ("acs_down_old", "Unknown")]                       # old enough to give up on despite the error
+    assert "Email send bounced to bounced@example.com ended as Failed" in caplog.text
+    assert "ACS error when checking email send acs_down" in caplog.text
+    assert "Reconciled email sends: {'Succeeded': 1, 'Failed': 4, 'Running': 1}" in caplog.text
+
+
+def test_reconcile_email_sends_query_failure(monkeypatch, caplog):
+
+    def raise_exception(*args, **kwargs):
+        raise Exception("DB error!")
+
+    monkeypatch.setattr(email_reconciler, "get_pending_email_operations", raise_exception)
+
+    with caplog.at_level("ERROR"):
+        result = email_reconciler.reconcile_email_sends()
+
+    # Assertions
+    assert result is None
+    assert "Failed to query pending email sends: DB error!" in caplog.text
@@ -1,10 +1,18 @@
 import pytest
 import logging
+from collections import OrderedDict
 from unittest.mock import MagicMock
 from azure.core.exceptions import HttpResponseError
 from azfunc.helpers import email_sender
 
 
+"""Fixture that starts every test with an empty rendered email cache."""
+@pytest.fixture(autouse=True)
+def reset_rendered_emails(monkeypatch):
+
+    monkeypatch.setattr(email_sender, "_rendered_emails", OrderedDict())
+
+
 #================================= Test format_text_for_html() =================================
 
 @pytest.mark.parametrize("text, expected, use_substring", [
@@ -90,6 +98,34 @@ def test_format_email(alert, expected_subject, plain_snippets, html_snippets):
         assert snippet in html_body
 
 
+# The same alert is rendered once no matter how many recipients it goes to
+def test_format_email_cached(monkeypatch):
+
+    calls = []
+    render_email = email_sender.render_email
+    monkeypatch.setattr(email_sender, "render_email", lambda alert: calls.append(alert) or render_email(alert))
+
+    alert = {"alert_id": "123", "event": "Flood Warning", "description": "Seek shelter now."}
+    first = email_sender.format_email({**alert, "user_id": "user1", "email": "user1@example.com"})
+    second = email_sender.format_email({**alert, "user_id": "user2", "email": "user2@example.com"})
+    updated = email_sender.format_email({**alert, "description": "Flooding has ended."})
+
+    # Assertions
+    assert first is second                              # served from the cache
+    assert len(calls) == 2                              # the updated description was rendered again
+    assert "Flooding has ended." in updated[1]
+
+
+def test_format_email_cache_is_bounded(monkeypatch):
+
+    monkeypatch.setattr(email_sender, "EMAIL_CACHE_SIZE", 2)
+    for alert_id in ("1", "2", "3"):
+        email_sender.format_email({"alert_id": alert_id})
+
+    # Assertions
+    assert [key[0] for key in email_sender._rendered_emails] == ["2", "3"]
+
+
 #================================= Test send_email_via_acs() =================================
 
 @pytest.mark.parametrize("side_effect, expected_log, log_level", [
@@ -127,3 +163,50 @@ def test_send_email_via_acs_(monkeypatch, caplog, side_effect, expected_log, log
         assert message["content"]["plainText"] == "Plain email"
         assert message["content"]["html"] == "<p>HTML email</p>"
     assert expected_log in caplog.text
+
+
+# Track mode submits without polling and hands back the operation id it sent to ACS
+def test_send_email_via_acs_track_mode(monkeypatch, caplog):
+
+    mock_client = MagicMock()
+    monkeypatch.setattr(email_sender, "email_client", mock_client)
+    monkeypatch.setattr(email_sender, "EMAIL_SEND_MODE", "track")
+
+    with caplog.at_level(logging.INFO):
+        operation_id = email_sender.send_email_via_acs("user@example.com", "Subject", "Plain email", "<p>HTML email</p>")
+
+    # Assertions
+    args, kwargs = mock_client.begin_send.call_args
+    assert kwargs == {"operation_id": operation_id, "polling": False}
+    assert args[0]["recipients"]["to"][0]["address"] == "user@example.com"
+    mock_client.begin_send.return_value.result.assert_not_called()     # never waits on delivery
+    assert f"ACS email send submitted: {operation_id}" in caplog.text
+
+
+# Wait mode (the default) returns nothing to track
+def test_send_email_via_acs_wait_mode_returns_none(monkeypatch):
+
+    mock_client = MagicMock()
+    mock_client.begin_send.return_value.result.return_value = {"status": "Succeeded"}
+    monkeypatch.setattr(email_sender, "email_client", mock_client)
+
+    # Assertions
+    assert email_sender.send_email_via_acs("user@example.com", "Subject", "Plain", "<p>HTML</p>") is None
+
+
+#================================= Test get_email_send_status() =================================
+
+def test_get_email_send_status(monkeypatch):
+
+    mock_client = MagicMock()
+    mock_client.send_request.return_value.json.return_value = {"id": "op1", "status": "Succeeded", "error": None}
+    monkeypatch.setattr(email_sender, "email_client", mock_client)
+
+    result = email_sender.get_email_send_status("op1")
+    request = mock_client.send_request.call_args.args[0]
+
+    # Assertions
+    assert result["status"] == "Succeeded"
+    assert request.method == "GET"
+    assert request.url.startswith("/emails/operations/op1?api-version=")
+    mock_client.send_request.return_value.raise_for_status.assert_called_once()
@@ -0,0 +1,322 @@
+import pytest
+import asyncio
+from azure.core import MatchConditions
+from azure.cosmos import exceptions
+from azfunc.helpers import cosmos_helpers, service_bus_sender, email_dispatcher, email_sender
+from azfunc.helpers.subscriber_cache import SubscriberCache
+from emulators import CosmosEmulator, ServiceBusEmulator, EmailEmulator, RateLimit
+
+
+# Manually advanced clock so rate limits and TTLs can be tested without sleeping
+class FakeClock:
+
+    def __init__(self, now=0.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+"""Fixture that points cosmos_helpers at a freshly provisioned emulator, with no dedup cache in the way."""
+@pytest.fixture
+def cosmos(monkeypatch):
+
+    emulator = CosmosEmulator()
+    monkeypatch.setattr(cosmos_helpers, "CosmosClient", emulator.client)
+    monkeypatch.setattr(cosmos_helpers, "sent_alert_cache", None)
+    for name in ["client", "database", *cosmos_helpers.CONTAINERS]:
+        monkeypatch.setattr(cosmos_helpers, name, None)
+    cosmos_helpers.provision_cosmos()
+    emulator.reset_stats()
+    return emulator
+
+
+def sent_alert(alert_id, user_id):
+
+    return {"alert_id": alert_id, "user_id": user_id, "email": f"{user_id}@example.com",
+            "created_at": "2025-10-22T00:00:00Z", "sent_at": "2025-10-22T00:01:00Z", "zone_id": "FLC127",
+            "event": "Flood Warning", "link": "http://www.weather.gov", "expires_at": None, "ends_at": None}
+
+
+#================================= Test RateLimit =================================
+
+def test_rate_limit_retry_after():
+
+    clock = FakeClock()
+    limit = RateLimit(rate=10, capacity=20, clock=clock)
+
+    # Assertions
+    assert limit.consume(15) == 0
+    assert limit.consume(10) == pytest.approx(0.5)   # 5 banked, 5 more take half a second
+    clock.now = 0.5
+    assert limit.consume(10) == 0
+    assert limit.consume(50) == pytest.approx(2.0)   # bigger than the bucket: waits for a full one, then goes into debt
+    clock.now = 2.5
+    assert limit.consume(50) == 0
+    assert limit.consume(1) > 0
+
+
+#================================= Test CosmosEmulator =================================
+
+def test_cosmos_conflicts_and_conditions(cosmos):
+
+    container = cosmos.container(cosmos_helpers.COSMOS_DATABASE_ID, "users")
+    created = container.create_item({"id": "user1", "email": "a@example.com"})
+
+    with pytest.raises(exceptions.CosmosResourceExistsError):
+        container.create_item({"id": "user1", "email": "b@example.com"})
+    with pytest.raises(exceptions.CosmosResourceNotFoundError):
+        container.read_item("missing", partition_key="missing")
+
+    container.replace_item("user1", {"id": "user1", "email": "c@example.com"}, etag=created["_etag"],
+                           match_condition=MatchConditions.IfNotModified)
+    with pytest.raises(exceptions.CosmosAccessConditionFailedError):
+        container.replace_item("user1", {"id": "user1", "email": "d@example.com"}, etag=created["_etag"],
+                               match_condition=MatchConditions.IfNotModified)
+
+    # Assertions
+    assert container.read_item("user1", partition_key="user1")["email"] == "c@example.com"
+    assert cosmos.calls["users.create_item"] == 2
+    assert cosmos.request_charge > 0
+
+
+def test_cosmos_zone_subscriptions_patch(cosmos):
+
+    cosmos_helpers.update_zone_subscriptions("FLC127", "user1")
+    cosmos_helpers.update_zone_subscriptions("FLC127", "user2")
+    cosmos_helpers.update_zone_subscriptions("FLC127", "user1")   # filter predicate fails, nothing changes
+
+    # Assertions
+    assert cosmos_helpers.get_zone_to_users(["FLC127", "TXZ001"]) == {"FLC127": ["user1", "user2"]}
+    assert cosmos.calls["zone_subscriptions.create_item"] == 1
+    assert cosmos.calls["zone_subscriptions.patch_item"] == 3
+
+
+# A zone from before ZONE_SUBSCRIBERS_ENABLED: the append is rejected and the IS_DEFINED-guarded set creates the array
+def test_cosmos_zone_subscriptions_without_subscribers_array(monkeypatch, cosmos):
+
+    container = cosmos.container(cosmos_helpers.COSMOS_DATABASE_ID, "zone_subscriptions")
+    container.create_item({"id": "FLC127", "user_ids": ["user1"]})
+    monkeypatch.setattr(cosmos_helpers, "ZONE_SUBSCRIBERS_ENABLED", True)
+
+    cosmos_helpers.update_zone_subscriptions("FLC127", "user2", "user2@example.com")
+    cosmos_helpers.update_zone_subscriptions("FLC127", "user3", "user3@example.com")
+
+    # Assertions
+    zone = container.read_item("FLC127", partition_key="FLC127")
+    assert zone["user_ids"] == ["user1", "user2", "user3"]
+    assert zone["subscribers"] == [{"id": "user2", "email": "user2@example.com"},
+                                   {"id": "user3", "email": "user3@example.com"}]
+    assert container.query_items("SELECT VALUE c.id FROM c WHERE IS_DEFINED(c.subscribers)") == ["FLC127"]
+    assert container.query_items("SELECT VALUE c.id FROM c WHERE NOT IS_DEFINED(c.subscribers)") == []
+
+
+def test_cosmos_alert_check_bulk_dedups(cosmos):
+
+    first = [sent_alert("A1", f"user{i}") for i in range(150)]
+    created, existing, failed = cosmos_helpers.alert_check_bulk(first)
+    second = [sent_alert("A1", f"user{i}") for i in range(100, 200)]
+    created_again, existing_again, failed_again = cosmos_helpers.alert_check_bulk(second)
+
+    # Assertions
+    assert (len(created), len(existing), failed) == (150, 0, [])
+    assert (len(created_again), len(existing_again), failed_again) == (50, 50, [])
+    assert cosmos.calls["sent_alerts.execute_item_batch"] == 3     # 100 + 50, then 50 new ones in one batch
+    assert len(cosmos.container(cosmos_helpers.COSMOS_DATABASE_ID, "sent_alerts").items()) == 200
+
+
+def test_cosmos_batch_is_all_or_nothing(cosmos):
+
+    container = cosmos.container(cosmos_helpers.COSMOS_DATABASE_ID, "sent_alerts")
+    container.create_item({"id": "A1-user2", "alert_id": "A1"})
+
+    with pytest.raises(exceptions.CosmosBatchOperationError) as error:
+        container.execute_item_batch(batch_operations=[
+            ("create", ({"id": "A1-user1", "alert_id": "A1"},)),
+            ("create", ({"id": "A1-user2", "alert_id": "A1"},)),
+        ], partition_key="A1")
+
+    # Assertions
+    assert error.value.error_index == 1
+    assert [doc["id"] for doc in container.items()] == ["A1-user2"]
+
+
+def test_cosmos_throttling_retries_then_raises():
+
+    clock = FakeClock()
+    emulator = CosmosEmulator(ru_per_second=10, throttle_retries=2, clock=clock, sleep=clock.sleep)
+    database = emulator.client().create_database_if_not_exists(id="db")
+    container = database.create_container_if_not_exists(id="items", partition_key=cosmos_helpers.PartitionKey(path="/id"))
+
+    container.create_item({"id": "1"})      # 5.5 RU
+    container.create_item({"id": "2"})      # 4.5 RU left: waits 0.1s once
+    with pytest.raises(exceptions.CosmosHttpResponseError) as error:
+        emulator.throttle_retries = 0
+        container.create_item({"id": "3"})
+
+    # Assertions
+    assert error.value.status_code == 429
+    assert int(error.value.headers["x-ms-retry-after-ms"]) > 0
+    assert emulator.throttled == 2
+    assert clock.now == pytest.approx(0.1)
+
+
+def test_cosmos_ttl_expiry():
+
+    wall_clock = FakeClock(now=1000)
+    emulator = CosmosEmulator(wall_clock=wall_clock)
+    database = emulator.client().create_database_if_not_exists(id="db")
+    container = database.create_container_if_not_exists(
+        id="sent_alerts", partition_key=cosmos_helpers.PartitionKey(path="/alert_id"), default_ttl=-1)
+    container.create_item({"id": "A1-user1", "alert_id": "A1", "ttl": 60})
+    container.create_item({"id": "A1-user2", "alert_id": "A1"})
+
+    wall_clock.now = 1060
+
+    # Assertions
+    assert container.query_items("SELECT VALUE c.id FROM c WHERE c.alert_id = @alert_id",
+                                 parameters=[{"name": "@alert_id", "value": "A1"}], partition_key="A1") == ["A1-user2"]
+    container.create_item({"id": "A1-user1", "alert_id": "A1"})     # expired, so not a conflict
+
+
+def test_cosmos_change_feed_drives_subscriber_cache(cosmos):
+
+    cosmos_helpers.create_user("Kevin", "kevin@example.com", 27.9, -82.4, ["FLC127"])
+    cache = SubscriberCache(reload_seconds=3600)
+    cache.load()
+    cosmos_helpers.create_user("Ana", "ana@example.com", 27.9, -82.4, ["FLC127"])
+
+    zone_to_users, user_emails = cache.resolve(["FLC127"])
+
+    # Assertions
+    assert len(zone_to_users["FLC127"]) == 2
+    assert sorted(user_emails.values()) == ["ana@example.com", "kevin@example.com"]
+
+
+def test_cosmos_unsupported_query_fails_loudly(cosmos):
+
+    container = cosmos.container(cosmos_helpers.COSMOS_DATABASE_ID, "users")
+
+    # Assertions
+    with pytest.raises(NotImplementedError):
+        container.query_items("SELECT * FROM c JOIN t IN c.zone_ids")
+
+
+#================================= Test ServiceBusEmulator =================================
+
+@pytest.mark.asyncio
+async def test_service_bus_queue_depth(monkeypatch):
+
+    emulator = ServiceBusEmulator(max_queue_depth=3)
+    monkeypatch.setattr(service_bus_sender, "ServiceBusClient", emulator)
+    await service_bus_sender.close_sender()
+
+    failures = await service_bus_sender.send_messages_to_queue([{"n": 1}, {"n": 2}])
+    full = await service_bus_sender.send_messages_to_queue([{"n": 3}, {"n": 4}])
+
+    # Assertions
+    assert failures == []
+    assert len(full) == 1 and full[0]["messages"] == [{"n": 3}, {"n": 4}]
+    assert emulator.queue(service_bus_sender.QUEUE_NAME).bodies() == ['{"n": 1}', '{"n": 2}']
+
+
+@pytest.mark.asyncio
+async def test_service_bus_peek_lock_and_dead_letter():
+
+    emulator = ServiceBusEmulator(max_delivery_count=2)
+    client = emulator.from_connection_string("Endpoint=sb://localhost/")
+    await client.get_queue_sender("alerts").send_messages(["first", "second"])
+    receiver = client.get_queue_receiver("alerts")
+
+    received = await receiver.receive_messages(max_message_count=10)
+    await receiver.complete_message(received[0])
+    await receiver.abandon_message(received[1])
+    redelivered = await receiver.receive_messages(max_message_count=10)
+    await receiver.abandon_message(redelivered[0])
+
+    # Assertions
+    queue = emulator.queue("alerts")
+    assert [str(message) for message in received] == ["first", "second"]
+    assert redelivered[0].delivery_count == 2
+    assert (queue.completed, queue.depth, [str(m) for m in queue.dead_letters]) == (1, 0, ["second"])
+    assert await receiver.receive_messages() == []
+
+
+#================================= Test EmailEmulator =================================
+
+# A 429 pauses the shared limiter and the send is retried once ACS has room again
+@pytest.mark.asyncio
+async def test_email_throttling_goes_through_limiter(monkeypatch):
+
+    emulator = EmailEmulator(emails_per_minute=6000)      # one send every 10 ms
+    limiter = email_dispatcher.TokenBucket(rate=1000, capacity=1000)
+    monkeypatch.setattr(email_dispatcher, "EMAIL_SEND_MODE", "wait")
+    monkeypatch.setattr(email_dispatcher, "retry_after_seconds", lambda error, attempt: 0.02)
+    client = emulator.aio.from_connection_string("endpoint=https://localhost/;accesskey=a2V5")
+
+    results = [await email_dispatcher.send_email_async(client, limiter, asyncio.Semaphore(5), {"to": address})
+               for address in ["a@example.com", "b@example.com"]]
+
+    # Assertions
+    assert results == [(True, None), (True, None)]
+    assert emulator.throttled == 1
+    assert emulator.calls["begin_send"] == 3
+    assert len(emulator.sent) == 2
+
+
+# A run stops starting emails at its time budget, what's left stays on the queue and nobody is emailed twice
+@pytest.mark.asyncio
+async def test_drain_email_queue_stops_at_time_budget(monkeypatch):
+
+    servicebus, acs = ServiceBusEmulator(), EmailEmulator()
+    monkeypatch.setattr(email_dispatcher, "ServiceBusClient", servicebus)
+    monkeypatch.setattr(email_dispatcher, "AsyncEmailClient", acs.aio)
+    monkeypatch.setattr(email_dispatcher, "ACS_CONNECTION_STRING", "endpoint=https://localhost/;accesskey=a2V5")
+    monkeypatch.setattr(email_dispatcher, "EMAIL_SEND_MODE", "wait")
+    monkeypatch.setattr(email_dispatcher, "ACS_EMAILS_PER_MINUTE", 600)      # one send every 100 ms
+    monkeypatch.setattr(email_dispatcher, "ACS_BURST", 1)
+    queue = servicebus.queue(email_dispatcher.QUEUE_NAME)
+    queue.enqueue([f'{{"alert_id": "A1", "event": "x", "email": "u{n}@example.com"}}' for n in range(20)])
+
+    totals = await email_dispatcher.drain_email_queue(time_budget=0.35)
+
+    # Assertions
+    addresses = [message["recipients"]["to"][0]["address"] for message in acs.sent]
+    assert 2 <= len(addresses) <= 5
+    assert len(set(addresses)) == len(addresses)
+    assert totals["completed"] == len(addresses) and totals["unsettled"] == 0
+    assert servicebus.calls["receive_messages"] == 1                    # sized to the budget, not a whole batch
+    assert queue.depth == 20 - len(addresses)
+
+
+@pytest.mark.asyncio
+async def test_email_throttled_response_has_retry_after():
+
+    emulator = EmailEmulator(emails_per_minute=6, clock=FakeClock())
+    client = emulator.aio.from_connection_string("endpoint=https://localhost/;accesskey=a2V5")
+    await client.begin_send({"to": "a@example.com"})
+
+    with pytest.raises(email_dispatcher.HttpResponseError) as error:
+        await client.begin_send({"to": "b@example.com"})
+
+    # Assertions
+    assert error.value.status_code == 429
+    assert email_dispatcher.retry_after_seconds(error.value, 0) == 10
+
+
+def test_email_operation_status(monkeypatch):
+
+    emulator = EmailEmulator(failure_rate=1.0, seed=1)
+    monkeypatch.setattr(email_sender, "EmailClient", emulator)
+    monkeypatch.setattr(email_sender, "email_client", None)
+
+    operation_id = email_sender.send_email_via_acs("a@example.com", "Subject", "plain", "<p>html</p>", wait=False)
+
+    # Assertions
+    assert email_sender.get_email_send_status(operation_id)["status"] == "Failed"
+    with pytest.raises(email_dispatcher.HttpResponseError) as error:
+        email_sender.get_email_send_status("unknown-operation")
+    assert error.value.status_code == 404
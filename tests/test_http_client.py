@@ -0,0 +1,56 @@
+import pytest
+from azfunc.helpers import http_client
+
+
+"""Fixture that drops the cached session so each test builds its own."""
+@pytest.fixture(autouse=True)
+def reset_session(monkeypatch):
+
+    monkeypatch.setattr(http_client, "_session", None)
+
+
+#================================= Test get_session() =================================
+
+def test_get_session_is_shared():
+
+    session = http_client.get_session()
+
+    # Assertions
+    assert http_client.get_session() is session                 # same pooled session on every call
+    assert session.headers["User-Agent"].startswith("(KevinWeatherAlertApp")
+    assert session.headers["Accept"] == "application/geo+json"
+    assert "gzip" in session.headers["Accept-Encoding"]
+
+
+def test_get_session_retry_policy():
+
+    retry = http_client.get_session().get_adapter("https://api.weather.gov").max_retries
+
+    # Assertions
+    assert retry.total == http_client.NWS_MAX_RETRIES
+    assert set(retry.status_forcelist) == {429, 500, 502, 503, 504}
+    assert retry.respect_retry_after_header
+    assert not retry.raise_on_status
+
+
+#================================= Test nws_get() =================================
+
+@pytest.mark.parametrize("kwargs, expected_timeout", [
+    ({}, http_client.NWS_TIMEOUT),             # default (connect, read) timeouts
+    ({"timeout": 1}, 1)                         # caller override
+])
+def test_nws_get_timeout(monkeypatch, kwargs, expected_timeout):
+
+    calls = []
+
+    class FakeSession:
+        def get(self, url, **kwargs):
+            calls.append((url, kwargs))
+            return "response"
+
+    monkeypatch.setattr(http_client, "_session", FakeSession())
+    result = http_client.nws_get("https://api.weather.gov/zones", params={"point": "1,2"}, **kwargs)
+
+    # Assertions
+    assert result == "response"
+    assert calls == [("https://api.weather.gov/zones", {"params": {"point": "1,2"}, "timeout": expected_timeout})]
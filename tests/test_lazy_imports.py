@@ -0,0 +1,52 @@
+import pytest
+import os
+import subprocess
+import sys
+from azfunc import helpers
+from azfunc.helpers import cosmos_helpers
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+# Import statement in a fresh interpreter, returns the names of the loaded modules
+def loaded_modules(statement, cwd=REPO_ROOT):
+
+    code = f"{statement}\nimport sys\nprint('\\n'.join(sys.modules))"
+    result = subprocess.run([sys.executable, "-c", code], cwd=cwd, capture_output=True, text=True)
+    assert result.returncode == 0, result.stderr
+    return set(result.stdout.split())
+
+
+#================================= Test helpers package =================================
+
+@pytest.mark.parametrize("statement, not_loaded", [
+    ("import azfunc.helpers", ["azure.cosmos", "azure.servicebus", "azure.communication.email", "requests"]),
+    ("from azfunc.helpers import format_email", ["azure.cosmos", "azure.servicebus"]),     # email function
+    ("from azfunc.helpers import create_user", ["azure.servicebus", "azure.communication.email"]),  # flask app
+])
+def test_helpers_load_submodules_on_demand(statement, not_loaded):
+
+    modules = loaded_modules(statement)
+
+    # Assertions
+    for name in not_loaded:
+        assert name not in modules
+
+
+def test_function_app_indexing_loads_no_sdks():
+
+    modules = loaded_modules("import function_app", cwd=os.path.join(REPO_ROOT, "azfunc"))
+
+    # Assertions
+    assert "azure.functions" in modules
+    for name in ["azure.cosmos", "azure.servicebus", "azure.communication.email", "opentelemetry"]:
+        assert name not in modules
+
+
+def test_helpers_getattr():
+
+    # Assertions
+    assert helpers.create_user is cosmos_helpers.create_user           # resolved from the submodule
+    assert "get_active_alerts" in dir(helpers)
+    with pytest.raises(AttributeError):
+        helpers.not_a_helper
@@ -1,4 +1,5 @@
 import pytest
+import json
 import requests
 from app import create_app
 from azfunc.helpers import nws_client
@@ -12,6 +13,13 @@ def client():
         yield client
 
 
+"""Fixture that clears the cached validators and features between tests."""
+@pytest.fixture(autouse=True)
+def reset_last_response(monkeypatch):
+
+    monkeypatch.setattr(nws_client, "_last_response", {"etag": None, "last_modified": None, "features": None})
+
+
 #================================= Test get_active_alerts() =================================
 
 @pytest.mark.parametrize("fake_alerts, expected", [
@@ -21,10 +29,12 @@ def client():
 def test_get_active_alerts(monkeypatch, fake_alerts, expected):
 
     class FakeResp:
+        status_code = 200
+        headers = {}
         def raise_for_status(self): pass
         def json(self): return fake_alerts
 
-    monkeypatch.setattr("azfunc.helpers.nws_client.requests.get", lambda *args, **kwargs: FakeResp())
+    monkeypatch.setattr("azfunc.helpers.nws_client.nws_get", lambda *args, **kwargs: FakeResp())
     alerts = nws_client.get_active_alerts()
 
     # Assertions
@@ -35,10 +45,119 @@ def test_get_active_alerts(monkeypatch, fake_alerts, expected):
 def test_get_active_alerts_http_error(monkeypatch):
 
     class FakeResp:
+        status_code = 503
         def raise_for_status(self): raise requests.HTTPError("API down")
 
-    monkeypatch.setattr("azfunc.helpers.nws_client.requests.get", lambda *args, **kwargs: FakeResp())
+    monkeypatch.setattr("azfunc.helpers.nws_client.nws_get", lambda *args, **kwargs: FakeResp())
 
     # Assertions
     with pytest.raises(requests.HTTPError):
         nws_client.get_active_alerts()
+
+
+# Tests that validators from the first response are sent back and a 304 is handled for both modes
+@pytest.mark.parametrize("skip_unchanged, expected", [
+    (False, [{"id": "alert1"}]),    # cached features are returned
+    (True, None)                    # caller is told nothing changed
+])
+def test_get_active_alerts_not_modified(monkeypatch, skip_unchanged, expected):
+
+    sent_headers = []
+    responses = []
+
+    class FakeResp:
+        def __init__(self, status_code):
+            self.status_code = status_code
+            self.headers = {"ETag": '"abc"', "Last-Modified": "Wed, 22 Oct 2025 00:00:00 GMT"}
+        def raise_for_status(self): pass
+        def json(self): return {"features": [{"id": "alert1"}]}
+
+    def fake_get(*args, headers=None, **kwargs):
+        sent_headers.append(dict(headers))
+        return FakeResp(200 if not responses else 304)
+
+    monkeypatch.setattr("azfunc.helpers.nws_client.nws_get", fake_get)
+    responses.append(nws_client.get_active_alerts())
+    responses.append(nws_client.get_active_alerts(skip_unchanged=skip_unchanged))
+
+    # Assertions
+    assert "If-None-Match" not in sent_headers[0]                  # nothing cached on the first call
+    assert sent_headers[1]["If-None-Match"] == '"abc"'
+    assert sent_headers[1]["If-Modified-Since"] == "Wed, 22 Oct 2025 00:00:00 GMT"
+    assert responses[1] == expected
+
+
+#================================= Test streaming mode =================================
+
+FEED = {
+    "@context": ["https://geojson.org/geojson-ld/geojson-context.jsonld", {"@version": "1.1", "features": "ignored"}],
+    "type": "FeatureCollection",
+    "features": [
+        {"id": "alert1", "geometry": {"type": "Polygon", "coordinates": [[[-81.1, 29.1], [-81.2, 29.2]]]},
+         "properties": {"id": "alert1", "event": "Flood Warning", "description": "Line one\nLine \"two\" {}",
+                        "geocode": {"UGC": ["FLC127"]}}},
+        {"id": "alert2", "geometry": None,
+         "properties": {"id": "alert2", "event": "Heat Advisory", "geocode": {"UGC": ["TXZ211"]}}}
+    ],
+    "title": "Current watches, warnings, and advisories",
+    "updated": "2025-10-22T00:00:00+00:00",
+    "pagination": {"limit": 500}
+}
+
+
+# Split the body into tiny chunks, including one that cuts a multi-byte character in half
+def make_chunks(body, size=7):
+
+    data = body.encode("utf-8")
+    return [data[i:i + size] for i in range(0, len(data), size)]
+
+
+@pytest.mark.parametrize("body, expected_ids", [
+    (json.dumps(FEED), ["alert1", "alert2"]),
+    (json.dumps(FEED, indent=2), ["alert1", "alert2"]),                             # whitespace everywhere
+    (json.dumps({"type": "FeatureCollection", "features": []}), []),                # empty feed
+    (json.dumps({**FEED, "features": [{"properties": {"id": "é°"}}]}, ensure_ascii=False), ["é°"])
+])
+def test_iter_features(body, expected_ids):
+
+    features = list(nws_client.iter_features(make_chunks(body)))
+
+    # Assertions
+    assert [feature["properties"]["id"] for feature in features] == expected_ids
+    if expected_ids == ["alert1", "alert2"]:
+        assert features == FEED["features"]                                         # parsed exactly like json.loads
+
+
+# A body cut off part way through the features array raises instead of silently ending
+def test_iter_features_truncated():
+
+    body = json.dumps(FEED)[:300]
+
+    # Assertions
+    with pytest.raises(ValueError):
+        list(nws_client.iter_features(make_chunks(body)))
+
+
+# Tests the streamed mode projects each feature and only stores validators once the feed was fully read
+def test_get_active_alerts_stream(monkeypatch):
+
+    class FakeResp:
+        status_code = 200
+        headers = {"ETag": '"abc"'}
+        closed = False
+        def raise_for_status(self): pass
+        def iter_content(self, chunk_size): return make_chunks(json.dumps(FEED), size=chunk_size % 64 + 5)
+        def close(self): FakeResp.closed = True
+
+    monkeypatch.setattr("azfunc.helpers.nws_client.nws_get", lambda *args, **kwargs: FakeResp())
+    features = nws_client.get_active_alerts(stream=True, fields=("id", "geocode"))
+
+    first = next(features)
+    assert nws_client._last_response["etag"] is None                                # not stored mid-stream
+    rest = list(features)
+
+    # Assertions
+    assert first == {"properties": {"id": "alert1", "geocode": {"UGC": ["FLC127"]}}}
+    assert rest == [{"properties": {"id": "alert2", "geocode": {"UGC": ["TXZ211"]}}}]
+    assert nws_client._last_response == {"etag": '"abc"', "last_modified": None, "features": None}
+    assert FakeResp.closed
@@ -170,6 +170,32 @@ def test_get_zone_ids(monkeypatch, fake_features, expected):
         def raise_for_status(self): pass
         def json(self): return fake_response
 
-    monkeypatch.setattr("app.routes.requests.get", lambda *args, **kwargs: FakeResp())
+    monkeypatch.setattr("app.routes.nws_get", lambda *args, **kwargs: FakeResp())
     result = routes.get_zone_ids("41.88266194873884", "-87.6233049031518", "john@smith.com")
-    assert set(result) == expected
\ No newline at end of file
+    assert set(result) == expected
+
+# A point covered by the local zone index never reaches the NWS API
+def test_get_zone_ids_local_hit(monkeypatch):
+
+    def fail(*args, **kwargs):
+        raise AssertionError("NWS API shouldn't be called")
+
+    monkeypatch.setattr("app.routes.lookup_zone_ids", lambda lat, lng: ["ILC031", "ILZ014"])
+    monkeypatch.setattr("app.routes.nws_get", fail)
+
+    # Assertions
+    assert routes.get_zone_ids("41.88", "-87.62", "john@smith.com") == ["ILC031", "ILZ014"]
+
+
+# A local miss falls back to the NWS API
+def test_get_zone_ids_local_miss(monkeypatch):
+
+    class FakeResp:
+        def raise_for_status(self): pass
+        def json(self): return {"features": [{"properties": {"id": "ABC123"}}]}
+
+    monkeypatch.setattr("app.routes.lookup_zone_ids", lambda lat, lng: [])
+    monkeypatch.setattr("app.routes.nws_get", lambda *args, **kwargs: FakeResp())
+
+    # Assertions
+    assert routes.get_zone_ids("41.88", "-87.62", "john@smith.com") == ["ABC123"]
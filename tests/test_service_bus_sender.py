@@ -1,77 +1,236 @@
 import pytest
 import json
+import asyncio
+import threading
+import weakref
 from unittest.mock import patch, AsyncMock, MagicMock
+from azure.servicebus.exceptions import MessageSizeExceededError
 from azfunc.helpers import service_bus_sender
 
 
-"""Fixture that patches ServiceBusClient and returns (mock_client, mock_sender)."""
+# Stand-in for ServiceBusMessageBatch that fills up after a fixed number of messages
+class FakeBatch:
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.messages = []
+
+    def add_message(self, message):
+        body = b"".join(message.body)
+        if len(self.messages) >= self.capacity or b"too big" in body:
+            raise MessageSizeExceededError()
+        self.messages.append(json.loads(body.decode()))
+
+
+"""Fixture that resets the cached connection between tests so each one starts cold."""
+@pytest.fixture(autouse=True)
+def reset_connection(monkeypatch):
+
+    monkeypatch.setattr(service_bus_sender, "_connections", weakref.WeakKeyDictionary())
+
+
+"""Fixture that patches ServiceBusClient and returns (mock_client_cls, mock_client, mock_sender)."""
 @pytest.fixture
 def mock_servicebus():
 
     with patch("azfunc.helpers.service_bus_sender.ServiceBusClient.from_connection_string",
                new_callable=MagicMock) as mock_client_cls:
-        mock_client = MagicMock()
+        mock_client = AsyncMock()
         mock_sender = AsyncMock()
 
-        # Make get_queue_sender return a fake sender
-        mock_client.get_queue_sender.return_value = mock_sender
-
-        # Teach the client to work as an async context manager
-        mock_client.__aenter__.return_value = mock_client
-        mock_client.__aexit__.return_value = None
+        # Make get_queue_sender return a fake sender that hands out batches of 2
+        mock_client.get_queue_sender = MagicMock(return_value=mock_sender)
+        mock_sender.create_message_batch.side_effect = lambda *args, **kwargs: FakeBatch(capacity=2)
         mock_client_cls.return_value = mock_client
 
-        # Same for sender (nested async context manager)
-        mock_sender.__aenter__.return_value = mock_sender
-        mock_sender.__aexit__.return_value = None
+        yield mock_client_cls, mock_client, mock_sender
 
-        yield mock_client, mock_sender
+
+def sent_batches(mock_sender):
+
+    return [call_arg.args[0].messages for call_arg in mock_sender.send_messages.call_args_list]
 
 
 @pytest.mark.asyncio
-async def test_send_messages_to_queue_calls_send_messages(mock_servicebus):
+async def test_send_messages_to_queue_packs_batches(mock_servicebus):
 
-    mock_client, mock_sender = mock_servicebus
-    messages = [{"id": 1}, {"id": 2}]
+    mock_client_cls, mock_client, mock_sender = mock_servicebus
+    messages = [{"id": i} for i in range(5)]
 
-    await service_bus_sender.send_messages_to_queue(messages)
+    failures = await service_bus_sender.send_messages_to_queue(messages)
 
-    assert mock_sender.send_messages.call_count == len(messages)
+    # Assertions
+    assert failures == []
+    assert mock_sender.send_messages.call_count == 3                        # 2 + 2 + 1
+    assert sorted(msg["id"] for batch in sent_batches(mock_sender) for msg in batch) == list(range(5))
 
 
 @pytest.mark.asyncio
 async def test_send_messages_to_queue_payload_are_correct(mock_servicebus):
 
-    mock_client, mock_sender = mock_servicebus
+    mock_client_cls, mock_client, mock_sender = mock_servicebus
     messages = [{"id": 1}, {"id": 2}]
 
     await service_bus_sender.send_messages_to_queue(messages)
 
-    sent_payloads = []
-    for call_arg in mock_sender.send_messages.call_args_list:
-        sb_msg = call_arg[0][0]
-        body_bytes = b"".join(sb_msg.body)
-        sent_payloads.append(json.loads(body_bytes.decode()))
-
-    assert sent_payloads == messages
+    # Assertions
+    assert sent_batches(mock_sender) == [messages]
 
 
 @pytest.mark.asyncio
 async def test_send_messages_to_queue_empty_list(mock_servicebus):
 
-    mock_client, mock_sender = mock_servicebus
+    mock_client_cls, mock_client, mock_sender = mock_servicebus
 
-    await service_bus_sender.send_messages_to_queue([])
+    failures = await service_bus_sender.send_messages_to_queue([])
 
+    # Assertions
+    assert failures == []
+    mock_client_cls.assert_not_called()
     mock_sender.send_messages.assert_not_called()
 
 
 @pytest.mark.asyncio
 async def test_send_messages_to_queue_correct_queue_name(mock_servicebus):
 
-    mock_client, mock_sender = mock_servicebus
+    mock_client_cls, mock_client, mock_sender = mock_servicebus
 
     await service_bus_sender.send_messages_to_queue([{"id": 123}])
 
     mock_client.get_queue_sender.assert_called_once_with(queue_name=service_bus_sender.QUEUE_NAME)
 
+
+# Another queue gets its own sender, closed after the send, and the cached one is left alone
+@pytest.mark.asyncio
+async def test_send_messages_to_queue_other_queue(mock_servicebus):
+
+    mock_client_cls, mock_client, mock_sender = mock_servicebus
+
+    failures = await service_bus_sender.send_messages_to_queue([{"shard": 1}], queue_name="weather_alert_shards")
+
+    # Assertions
+    assert failures == []
+    mock_client.get_queue_sender.assert_called_once_with(queue_name="weather_alert_shards")
+    assert sent_batches(mock_sender) == [[{"shard": 1}]]
+    mock_sender.close.assert_awaited_once()
+    mock_client.close.assert_awaited_once()
+    assert asyncio.get_running_loop() not in service_bus_sender._connections
+
+
+# The client and sender are opened once and reused by later calls on the same loop
+@pytest.mark.asyncio
+async def test_send_messages_to_queue_reuses_sender(mock_servicebus):
+
+    mock_client_cls, mock_client, mock_sender = mock_servicebus
+
+    await service_bus_sender.send_messages_to_queue([{"id": 1}])
+    await service_bus_sender.send_messages_to_queue([{"id": 2}])
+
+    # Assertions
+    mock_client_cls.assert_called_once()
+    mock_sender.close.assert_not_called()
+
+
+# A failed batch is reported with its messages, the other batches still go out and the sender is dropped
+@pytest.mark.asyncio
+async def test_send_messages_to_queue_reports_failed_batches(mock_servicebus):
+
+    mock_client_cls, mock_client, mock_sender = mock_servicebus
+    error = Exception("Service Bus throttled")
+
+    async def fake_send(batch):
+        if {"id": 2} in batch.messages:
+            raise error
+    mock_sender.send_messages.side_effect = fake_send
+
+    failures = await service_bus_sender.send_messages_to_queue([{"id": i} for i in range(5)])
+
+    # Assertions
+    assert failures == [{"messages": [{"id": 2}, {"id": 3}], "error": error}]
+    mock_sender.close.assert_awaited_once()
+    assert asyncio.get_running_loop() not in service_bus_sender._connections
+
+
+# A message too big for an empty batch is reported on its own
+@pytest.mark.asyncio
+async def test_send_messages_to_queue_oversized_message(mock_servicebus):
+
+    mock_client_cls, mock_client, mock_sender = mock_servicebus
+
+    failures = await service_bus_sender.send_messages_to_queue([{"id": 1}, {"id": 2, "body": "too big"}, {"id": 3}])
+
+    # Assertions
+    assert [failure["messages"] for failure in failures] == [[{"id": 2, "body": "too big"}]]
+    assert sent_batches(mock_sender) == [[{"id": 1}], [{"id": 3}]]           # the batch it didn't fit in was closed
+
+
+# No more than MAX_CONCURRENT_SENDS batches are in flight at once
+@pytest.mark.asyncio
+async def test_send_messages_to_queue_bounded_concurrency(monkeypatch, mock_servicebus):
+
+    mock_client_cls, mock_client, mock_sender = mock_servicebus
+    monkeypatch.setattr(service_bus_sender, "MAX_CONCURRENT_SENDS", 2)
+    in_flight = {"now": 0, "max": 0}
+
+    async def slow_send(batch):
+        in_flight["now"] += 1
+        in_flight["max"] = max(in_flight["max"], in_flight["now"])
+        await asyncio.sleep(0.01)
+        in_flight["now"] -= 1
+    mock_sender.send_messages.side_effect = slow_send
+
+    await service_bus_sender.send_messages_to_queue([{"id": i} for i in range(12)])
+
+    # Assertions
+    assert mock_sender.send_messages.call_count == 6
+    assert in_flight["max"] == 2
+
+
+# run_on_worker_loop() keeps the same loop between calls so the cached sender stays usable
+def test_run_on_worker_loop_reuses_loop(monkeypatch):
+
+    monkeypatch.setattr(service_bus_sender, "_worker", threading.local())
+
+    async def current_loop():
+        return asyncio.get_running_loop()
+
+    first = service_bus_sender.run_on_worker_loop(current_loop())
+    second = service_bus_sender.run_on_worker_loop(current_loop())
+
+    # Assertions
+    assert first is second
+    first.close()
+
+
+# Handlers running at the same time on different threads each get their own loop and sender
+def test_run_on_worker_loop_per_thread(monkeypatch, mock_servicebus):
+
+    mock_client_cls, mock_client, mock_sender = mock_servicebus
+    monkeypatch.setattr(service_bus_sender, "_worker", threading.local())
+    both_running = threading.Barrier(2, timeout=5)
+    results, errors = [], []
+
+    async def send(n):
+        both_running.wait()                     # the other thread's loop is running too
+        failures = await service_bus_sender.send_messages_to_queue([{"id": n}])
+        return asyncio.get_running_loop(), failures
+
+    def handler(n):
+        try:
+            results.append(service_bus_sender.run_on_worker_loop(send(n)))
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=handler, args=(n,)) for n in range(2)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    # Assertions
+    assert errors == []
+    assert [failures for _, failures in results] == [[], []]
+    assert results[0][0] is not results[1][0]
+    assert mock_client_cls.call_count == 2                          # one cached sender per loop
+    for loop, _ in results:
+        loop.close()
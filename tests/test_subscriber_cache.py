@@ -0,0 +1,122 @@
+import pytest
+from types import SimpleNamespace
+from azfunc.helpers import subscriber_cache
+
+
+"""
+Fake container with a change feed: every write is appended to a log, a continuation token is the log position.
+Reading from "Now" returns nothing, reading from a token returns what was written since.
+"""
+class FakeFeedContainer:
+
+    def __init__(self, docs):
+        self.docs = {doc["id"]: doc for doc in docs}
+        self.log = []
+        self.client_connection = SimpleNamespace(last_response_headers={})
+        self.queries = 0
+        self.feed_reads = []
+
+    def write(self, doc):
+        self.docs[doc["id"]] = doc
+        self.log.append(doc)
+
+    def query_items(self, query, enable_cross_partition_query=True):
+        self.queries += 1
+        return list(self.docs.values())
+
+    def query_items_change_feed(self, start_time=None, continuation=None):
+        self.feed_reads.append(start_time or continuation)
+        position = len(self.log) if start_time == "Now" else int(continuation)
+        self.client_connection.last_response_headers = {"etag": str(len(self.log))}
+        return list(self.log[position:])
+
+
+class FakeClock:
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+"""Fixture that points the cache at fake zone_subscriptions and users containers."""
+@pytest.fixture
+def containers(monkeypatch):
+
+    fakes = {
+        "zones_container": FakeFeedContainer([{"id": "FLC127", "user_ids": ["user1"]}]),
+        "users_container": FakeFeedContainer([{"id": "user1", "email": "user1@example.com"}]),
+    }
+    monkeypatch.setattr(subscriber_cache, "get_container", lambda name: fakes[name])
+    return fakes
+
+
+#================================= Test SubscriberCache =================================
+
+def test_resolve_loads_once_then_reads_change_feed(containers):
+
+    cache = subscriber_cache.SubscriberCache(reload_seconds=3600, clock=FakeClock())
+
+    first = cache.resolve(["FLC127", "FLC069"])
+    second = cache.resolve(["FLC127"])
+
+    # Assertions
+    assert first == ({"FLC127": ["user1"]}, {"user1": "user1@example.com"})
+    assert second == first
+    assert containers["zones_container"].queries == 1                   # full read only on load
+    assert containers["zones_container"].feed_reads == ["Now", "0"]     # then resumed from the stored token
+
+
+def test_resolve_applies_new_signups(containers):
+
+    cache = subscriber_cache.SubscriberCache(reload_seconds=3600, clock=FakeClock())
+    cache.resolve(["FLC127"])
+
+    containers["users_container"].write({"id": "user2", "email": "user2@example.com"})
+    containers["zones_container"].write({"id": "FLC127", "user_ids": ["user1", "user2"]})
+    containers["zones_container"].write({"id": "FLC069", "user_ids": ["user2"]})
+    zone_to_users, user_emails = cache.resolve(["FLC127", "FLC069"])
+
+    # Assertions
+    assert zone_to_users == {"FLC127": ["user1", "user2"], "FLC069": ["user2"]}
+    assert user_emails == {"user1": "user1@example.com", "user2": "user2@example.com"}
+    assert containers["users_container"].queries == 1                   # no second full read
+
+
+def test_resolve_reloads_after_reload_interval(containers):
+
+    clock = FakeClock()
+    cache = subscriber_cache.SubscriberCache(reload_seconds=60, clock=clock)
+    cache.resolve(["FLC127"])
+
+    # A deleted zone only disappears on a full reload
+    del containers["zones_container"].docs["FLC127"]
+    clock.now = 61
+    zone_to_users, _ = cache.resolve(["FLC127"])
+
+    # Assertions
+    assert zone_to_users == {}
+    assert containers["zones_container"].queries == 2
+
+
+def test_resolve_looks_up_unknown_emails(containers, monkeypatch):
+
+    looked_up = []
+
+    def fake_get_user_emails(user_ids):
+        looked_up.append(set(user_ids))
+        return {"user9": "user9@example.com"}
+
+    monkeypatch.setattr(subscriber_cache, "get_user_emails", fake_get_user_emails)
+    cache = subscriber_cache.SubscriberCache(reload_seconds=3600, clock=FakeClock())
+    cache.resolve([])
+
+    # Zone change seen before the user document's change
+    containers["zones_container"].write({"id": "FLC127", "user_ids": ["user1", "user9"]})
+    _, user_emails = cache.resolve(["FLC127"])
+    cache.resolve(["FLC127"])
+
+    # Assertions
+    assert user_emails == {"user1": "user1@example.com", "user9": "user9@example.com"}
+    assert looked_up == [{"user9"}]                                     # remembered after the first lookup
@@ -0,0 +1,139 @@
+import pytest
+import logging
+from unittest.mock import AsyncMock
+from opentelemetry import metrics, trace
+from opentelemetry.sdk.metrics import MeterProvider
+from opentelemetry.sdk.metrics.export import InMemoryMetricReader
+from opentelemetry.sdk.trace import TracerProvider
+from opentelemetry.sdk.trace.export import SimpleSpanProcessor
+from opentelemetry.sdk.trace.export.in_memory_span_exporter import InMemorySpanExporter
+from azfunc import alert_worker
+from azfunc.helpers import cosmos_helpers, telemetry
+from tests.test_alert_worker import make_alert
+from tests.test_cosmos_helpers import FakeReadContainer
+
+# Global providers can only be set once per process, the helpers' proxy tracer and meter bind to them
+_exporter = InMemorySpanExporter()
+_reader = InMemoryMetricReader()
+_providers = {"set": False}
+
+
+"""Fixture that installs in-memory SDK providers and gives each test an empty span list."""
+@pytest.fixture
+def spans():
+
+    if not _providers["set"]:
+        tracer_provider = TracerProvider()
+        tracer_provider.add_span_processor(SimpleSpanProcessor(_exporter))
+        trace.set_tracer_provider(tracer_provider)
+        metrics.set_meter_provider(MeterProvider(metric_readers=[_reader]))
+        _providers["set"] = True
+    _exporter.clear()
+    return _exporter
+
+
+# Current cumulative value of a counter (or count of a histogram) for the data points matching attributes
+def metric_value(name, **attributes):
+
+    total = 0
+    data = _reader.get_metrics_data()
+    for resource_metrics in data.resource_metrics if data else []:
+        for scope_metrics in resource_metrics.scope_metrics:
+            for metric in scope_metrics.metrics:
+                if metric.name != name:
+                    continue
+                for point in metric.data.data_points:
+                    if attributes.items() <= dict(point.attributes).items():
+                        total += point.value if hasattr(point, "value") else point.count
+    return total
+
+
+#================================= Test stage() =================================
+
+def test_stage_records_span_and_duration(spans):
+
+    before = metric_value("alert_worker.stage.duration", stage="fetch")
+    with telemetry.stage("fetch", zones=3):
+        pass
+    with pytest.raises(ValueError):
+        with telemetry.stage("fetch"):
+            raise ValueError("bad feed")
+
+    finished = spans.get_finished_spans()
+
+    # Assertions
+    assert [span.name for span in finished] == ["alert_worker.fetch", "alert_worker.fetch"]
+    assert finished[0].attributes["zones"] == 3
+    assert finished[1].status.status_code == trace.StatusCode.ERROR
+    assert finished[1].events[0].name == "exception"
+    assert metric_value("alert_worker.stage.duration", stage="fetch") == before + 2
+
+
+#================================= Test debug_payload() =================================
+
+def test_debug_payload_is_lazy_and_sampled(caplog):
+
+    built = []
+    def build():
+        built.append(1)
+        return {"FLC127": ["user1"]}
+
+    with caplog.at_level("INFO"):
+        skipped_info = telemetry.debug_payload("All zone ids", build, sample_rate=1.0)
+    with caplog.at_level("DEBUG"):
+        skipped_sample = telemetry.debug_payload("All zone ids", build, sample_rate=0.0)
+        logged = telemetry.debug_payload("All zone ids", build, sample_rate=1.0)
+
+    # Assertions
+    assert (skipped_info, skipped_sample, logged) == (False, False, True)
+    assert len(built) == 1                                  # only formatted when actually logged
+    assert caplog.records[-1].levelno == logging.DEBUG
+    assert "All zone ids: {'FLC127': ['user1']}" in caplog.text
+
+
+#================================= Test instrumented worker =================================
+
+def test_get_alerts_emits_stage_spans_and_counters(monkeypatch, spans):
+
+    alerts = make_alert("123", ["FLC069"]) + make_alert("456", ["FLC127"])
+    monkeypatch.setattr(alert_worker, "_tick_state", {"complete": False, "fanned_out_at": {}})
+    monkeypatch.setattr(alert_worker, "get_alert_snapshot", lambda: {"alerts": {}, "fanned_out_at": {}, "taken_at": None})
+    monkeypatch.setattr(alert_worker, "save_alert_snapshot", lambda alerts, fanned_out_at: None)
+    monkeypatch.setattr(alert_worker, "get_active_alerts", lambda *args, **kwargs: alerts)
+    monkeypatch.setattr(alert_worker, "get_zone_to_users", lambda *args, **kwargs: {"FLC069": ["user1"], "FLC127": ["user2"]})
+    monkeypatch.setattr(alert_worker, "get_user_emails", lambda *args, **kwargs: {"user1": "user1@example.com", "user2": "user2@example.com"})
+    # One new pair and one duplicate
+    monkeypatch.setattr(alert_worker, "alert_check_bulk", lambda checks: (checks[:1], checks[1:], []))
+    monkeypatch.setattr(alert_worker, "send_messages_to_queue", AsyncMock(return_value=[]))
+    created_before = metric_value("alert_worker.pairs", result="created")
+    duplicates_before = metric_value("alert_worker.pairs", result="duplicate")
+    changed_before = metric_value("alert_worker.alerts", kind="changed")
+
+    alert_worker.get_alerts()
+
+    finished = {span.name: span for span in spans.get_finished_spans()}
+    tick = finished["alert_worker.tick"]
+
+    # Assertions
+    assert set(finished) == {"alert_worker.tick", "alert_worker.fetch", "alert_worker.parse", "alert_worker.zone_query",
+                             "alert_worker.email_lookup", "alert_worker.dedup", "alert_worker.enqueue"}
+    for name, span in finished.items():
+        if name != "alert_worker.tick":
+            assert span.parent.span_id == tick.context.span_id
+    assert finished["alert_worker.dedup"].attributes["pairs"] == 2
+    assert finished["alert_worker.enqueue"].attributes["messages"] == 1
+    assert metric_value("alert_worker.pairs", result="created") == created_before + 1
+    assert metric_value("alert_worker.pairs", result="duplicate") == duplicates_before + 1
+    assert metric_value("alert_worker.alerts", kind="changed") == changed_before + 2
+
+
+def test_read_by_ids_counts_request_charge(monkeypatch, spans):
+
+    zones = {"FLC127": {"id": "FLC127", "user_ids": ["user1"]}}
+    monkeypatch.setattr(cosmos_helpers, "zones_container", FakeReadContainer(zones))
+    before = metric_value("cosmos.request_charge", container="zones_container")
+
+    cosmos_helpers.get_zone_to_users(["FLC127", "TXZ001"])
+
+    # Assertions
+    assert metric_value("cosmos.request_charge", container="zones_container") == before + 2.0   # 1 RU per id
@@ -0,0 +1,116 @@
+import pytest
+import json
+import threading
+from app import zone_lookup
+
+
+# Square ring from (min_lng, min_lat) to (max_lng, max_lat), closed like GeoJSON rings
+def square(min_lng, min_lat, max_lng, max_lat):
+
+    return [[min_lng, min_lat], [max_lng, min_lat], [max_lng, max_lat], [min_lng, max_lat], [min_lng, min_lat]]
+
+
+def feature(properties, geometry_type, coordinates):
+
+    return {"type": "Feature", "properties": properties, "geometry": {"type": geometry_type, "coordinates": coordinates}}
+
+
+"""Fixture with a county zone holding a hole, an overlapping forecast zone spanning several grid cells and a two-part zone."""
+@pytest.fixture
+def index():
+
+    index = zone_lookup.ZoneIndex(cell_degrees=0.5)
+    index.add_feature(feature({"id": "https://api.weather.gov/zones/county/FLC127"}, "Polygon",
+                              [square(-81.5, 28.5, -80.5, 29.5), square(-81.1, 28.9, -80.9, 29.1)]))
+    index.add_feature(feature({"STATE": "FL", "ZONE": "141"}, "Polygon", [square(-82.0, 28.0, -81.0, 29.0)]))
+    index.add_feature(feature({"STATE": "FL", "FIPS": "12035"}, "MultiPolygon",
+                              [[square(-80.0, 30.0, -79.9, 30.1)], [square(-79.0, 30.0, -78.9, 30.1)]]))
+    return index
+
+
+#================================= Test ZoneIndex =================================
+
+@pytest.mark.parametrize("lat, lng, expected", [
+    (29.3, -81.3, ["FLC127"]),                  # inside the county zone only
+    (28.7, -81.2, ["FLC127", "FLZ141"]),        # where the two zones overlap
+    (29.0, -81.0, []),                          # inside the hole
+    (28.2, -81.9, ["FLZ141"]),                  # far corner of the multi-cell zone
+    (30.05, -78.95, ["FLC035"]),                # second part of a multipolygon
+    (35.0, -90.0, []),                          # no local data
+])
+def test_lookup(index, lat, lng, expected):
+
+    # Assertions
+    assert index.lookup(lat, lng) == expected
+
+
+@pytest.mark.parametrize("properties, expected", [
+    ({"id": "FLZ141"}, "FLZ141"),
+    ({"id": "https://api.weather.gov/zones/forecast/FLZ141"}, "FLZ141"),
+    ({"STATE": "FL", "ZONE": "141"}, "FLZ141"),
+    ({"STATE": "FL", "FIPS": "12127"}, "FLC127"),
+    ({"NAME": "somewhere"}, None),
+])
+def test_feature_zone_id(properties, expected):
+
+    # Assertions
+    assert zone_lookup.feature_zone_id(properties) == expected
+
+
+#================================= Test load_zone_index() and lookup_zone_ids() =================================
+
+def test_lookup_zone_ids_from_data_dir(monkeypatch, tmp_path):
+
+    collection = {"type": "FeatureCollection",
+                  "features": [feature({"id": "ILZ014"}, "Polygon", [square(-88.0, 41.5, -87.5, 42.1)])]}
+    (tmp_path / "forecast.geojson").write_text(json.dumps(collection))
+    (tmp_path / "county.json").write_text(json.dumps(feature({"id": "ILC031"}, "Polygon", [square(-88.3, 41.4, -87.5, 42.2)])))
+
+    monkeypatch.setattr(zone_lookup, "ZONE_DATA_DIR", str(tmp_path))
+    monkeypatch.setattr(zone_lookup, "_zone_index", {"index": None, "loaded": False})
+
+    # Assertions
+    assert zone_lookup.lookup_zone_ids("41.88", "-87.62") == ["ILC031", "ILZ014"]
+    assert len(zone_lookup.get_zone_index()) == 2
+
+
+# A lookup while the background load holds the lock returns at once, the caller falls back to the API
+def test_lookup_zone_ids_while_loading(monkeypatch):
+
+    monkeypatch.setattr(zone_lookup, "ZONE_DATA_DIR", "/zones")
+    monkeypatch.setattr(zone_lookup, "_zone_index", {"index": None, "loaded": False})
+    monkeypatch.setattr(zone_lookup, "_zone_index_lock", threading.Lock())
+    monkeypatch.setattr(zone_lookup, "load_zone_index", lambda data_dir: pytest.fail("lookup shouldn't load the index"))
+
+    with zone_lookup._zone_index_lock:          # the startup load is running
+        zone_ids = zone_lookup.lookup_zone_ids("41.88", "-87.62")
+
+    # Assertions
+    assert zone_ids == []
+    assert not zone_lookup._zone_index["loaded"]
+
+
+# Only the forecast zone file is loaded: the point's county is unknown locally, so the API is asked
+def test_lookup_zone_ids_needs_every_zone_type(monkeypatch, tmp_path, caplog):
+
+    (tmp_path / "forecast.geojson").write_text(json.dumps(feature({"id": "FLZ141"}, "Polygon", [square(-82.0, 28.0, -81.0, 29.0)])))
+    monkeypatch.setattr(zone_lookup, "ZONE_DATA_DIR", str(tmp_path))
+    monkeypatch.setattr(zone_lookup, "_zone_index", {"index": None, "loaded": False})
+
+    with caplog.at_level("INFO"):
+        zone_ids = zone_lookup.lookup_zone_ids("28.5", "-81.5")
+
+    # Assertions
+    assert zone_ids == []
+    assert zone_lookup.get_zone_index().lookup(28.5, -81.5) == ["FLZ141"]
+    assert "by zone type: {'Z': 1}" in caplog.text
+    assert "No county zones in" in caplog.text
+
+
+def test_lookup_zone_ids_without_data(monkeypatch):
+
+    monkeypatch.setattr(zone_lookup, "ZONE_DATA_DIR", None)
+    monkeypatch.setattr(zone_lookup, "_zone_index", {"index": None, "loaded": False})
+
+    # Assertions
+    assert zone_lookup.lookup_zone_ids("41.88", "-87.62") == []